@@ -0,0 +1,95 @@
+# An example that measures tile cache throughput with memcached as the thread
+# count grows.  Each thread reads tile-sized values from the cache.  Reads
+# through the MemCache client pool are compared with the same reads made while
+# holding a single global lock, which is how the cache was used before the
+# pool existed.  This needs a memcached server, such as a local one started
+# with "memcached -m 256 -t 4".
+
+import argparse
+import random
+import threading
+import time
+
+import large_image
+
+
+def read_values(cache, keys, count, lock=None):
+    """
+    Read random values from a cache.
+
+    :param cache: the cache to read.
+    :param keys: a list of keys to choose from.
+    :param count: the number of values to read.
+    :param lock: if not None, hold this lock for each read.
+    """
+    rand = random.Random(len(keys))
+    for _ in range(count):
+        key = keys[rand.randrange(len(keys))]
+        if lock:
+            with lock:
+                cache[key]
+        else:
+            cache[key]
+
+
+def time_threads(threads, func, *args):
+    """
+    Run a function in several threads at once.
+
+    :param threads: the number of threads.
+    :param func: the function to run in each thread.
+    :returns: the time in seconds for all threads to finish.
+    """
+    threadList = [threading.Thread(target=func, args=args)
+                  for _ in range(threads)]
+    start = time.time()
+    for thread in threadList:
+        thread.start()
+    for thread in threadList:
+        thread.join()
+    return time.time() - start
+
+
+def memcached_benchmark(url, threadCounts, count=2000, valueSize=16384,
+                        numKeys=500):
+    """
+    Print the number of cache reads per second for different thread counts.
+
+    :param url: the memcached server url.
+    :param threadCounts: a list of the number of threads to use.
+    :param count: the number of reads each thread makes.
+    :param valueSize: the size in bytes of each cached value.  This is similar
+        to a JPEG tile.
+    :param numKeys: the number of distinct values in the cache.
+    """
+    cache = large_image.cache_util.MemCache(
+        url, mustBeAvailable=True, poolSize=max(threadCounts))
+    keys = ['memcached_benchmark %d' % idx for idx in range(numKeys)]
+    for key in keys:
+        cache[key] = b'\x00' * valueSize
+    lock = threading.Lock()
+    for threads in threadCounts:
+        lockedTime = time_threads(threads, read_values, cache, keys, count, lock)
+        pooledTime = time_threads(threads, read_values, cache, keys, count)
+        reads = threads * count
+        print('%3d threads  global lock: %7.0f reads/s  pool: %7.0f reads/s  '
+              'speedup: %4.2fx' % (
+                  threads, reads / lockedTime, reads / pooledTime,
+                  lockedTime / pooledTime))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time concurrent reads from a memcached tile cache')
+    parser.add_argument('url', metavar='memcached-url', type=str, nargs='?',
+                        default='127.0.0.1',
+                        help='memcached server url')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16],
+                        help='Thread counts to test')
+    parser.add_argument('-c', '--count', dest='count', type=int, default=2000,
+                        help='Number of reads per thread')
+    parser.add_argument('-s', '--size', dest='size', type=int, default=16384,
+                        help='Size in bytes of each cached value')
+    args = parser.parse_args()
+    memcached_benchmark(args.url, args.threads, args.count, args.size)
@@ -0,0 +1,111 @@
+# An example that times getRegion against assembling the same region by
+# pasting each tile into a PIL image, one tile at a time.  This was how
+# getRegion worked before it assembled regions in a numpy array with a pool of
+# threads.  Note that a 32768 x 32768 pixel region needs 4 GB of memory for
+# each copy of the region.
+
+import argparse
+import math
+import time
+
+import numpy
+import PIL.Image
+
+import large_image
+
+# Explicitly set the caching method before we request any data
+large_image.cache_util.setConfig('cache_backend', 'python')
+
+
+def paste_region(source, **kwargs):
+    """
+    Get a region as a numpy array by pasting tiles into a PIL image.
+
+    :param source: the tile source.
+    :param **kwargs: parameters for the region, as passed to getRegion.
+    :returns: a numpy array of the region.
+    """
+    iterInfo = source._tileIteratorInfo(**kwargs)
+    left = iterInfo['region']['left']
+    top = iterInfo['region']['top']
+    width = iterInfo['region']['width']
+    height = iterInfo['region']['height']
+    image = PIL.Image.frombuffer(
+        'RGBA', (width, height), b'\x00' * (width * height * 4), 'raw',
+        'RGBA', 0, 1)
+    for tile in source._tileIterator(iterInfo):
+        image.paste(tile['tile'], (tile['x'] - left, tile['y'] - top))
+    outWidth = int(math.floor(iterInfo['output']['width']))
+    outHeight = int(math.floor(iterInfo['output']['height']))
+    if outWidth != width or outHeight != height:
+        image = image.resize(
+            (outWidth, outHeight),
+            PIL.Image.BICUBIC if outWidth > width else PIL.Image.LANCZOS)
+    return numpy.asarray(image)
+
+
+def time_call(func, repeat, *args, **kwargs):
+    """
+    Call a function several times and report the fastest time.
+
+    :param func: the function to call.
+    :param repeat: the number of times to call it.
+    :returns: the result of the last call and the shortest time in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args, **kwargs)
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    return result, best
+
+
+def region_benchmark(imagePath, sizes, repeat=2):
+    """
+    Print the time to get square regions of different sizes.
+
+    :param imagePath: path of the file to use.  large_image://test uses a
+        generated image.
+    :param sizes: a list of region sizes in pixels.
+    :param repeat: the number of times to get each region.  The fastest time
+        is reported.
+    """
+    if imagePath == 'large_image://test':
+        source = large_image.getTileSource(
+            imagePath, maxLevel=8, encoding='JPEG')
+    else:
+        source = large_image.getTileSource(imagePath)
+    metadata = source.getMetadata()
+    for size in sizes:
+        region = {
+            'left': 0, 'top': 0,
+            'width': min(size, metadata['sizeX']),
+            'height': min(size, metadata['sizeY'])}
+        # Load the tiles once so that both methods use cached tiles
+        source.getRegion(
+            region=region, format=large_image.tilesource.TILE_FORMAT_NUMPY)
+        # Discard the result so only one copy of the region is held at a time
+        _, pasteTime = time_call(paste_region, repeat, source, region=region)
+        (assembled, format), regionTime = time_call(
+            source.getRegion, repeat, region=region,
+            format=large_image.tilesource.TILE_FORMAT_NUMPY)
+        print('%d x %d  paste: %5.3fs  getRegion: %5.3fs  speedup: %4.2fx' % (
+            assembled.shape[1], assembled.shape[0], pasteTime, regionTime,
+            pasteTime / regionTime))
+        assembled = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time getting regions of a tiled image')
+    parser.add_argument('path', metavar='image-path', type=str, nargs='?',
+                        default='large_image://test',
+                        help='Path of the tiled image to use')
+    parser.add_argument('-s', '--size', dest='sizes', type=int, nargs='+',
+                        default=[4096, 16384, 32768],
+                        help='Region sizes in pixels')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=2,
+                        help='Number of times to get each region')
+    args = parser.parse_args()
+    region_benchmark(args.path, args.sizes, args.repeat)
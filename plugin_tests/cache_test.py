@@ -18,7 +18,9 @@
 #############################################################################
 
 import os
+import shutil
 import six
+import tempfile
 import threading
 
 from girder import config
@@ -87,11 +89,290 @@ class LargeImageCacheTest(base.TestCase):
 
         self._testDecorator(Cache(1000))
 
+    def testEstimateSize(self):
+        import numpy
+        import PIL.Image
+        from girder.plugins.large_image.cache_util import estimateSize
+
+        self.assertEqual(estimateSize(b'\x00' * 1000), 1000)
+        self.assertEqual(estimateSize(numpy.zeros((10, 20, 3), dtype=numpy.uint8)), 600)
+        self.assertEqual(estimateSize(numpy.zeros((10, 20), dtype=numpy.uint16)), 400)
+        self.assertEqual(estimateSize(PIL.Image.new('RGB', (10, 20))), 800)
+        self.assertEqual(estimateSize(PIL.Image.new('L', (10, 20))), 200)
+        self.assertEqual(estimateSize(PIL.Image.new('I;16', (10, 20))), 400)
+        self.assertEqual(estimateSize((b'\x00' * 1000, 'image/png')), 1009)
+        self.assertEqual(estimateSize({'a': b'\x00' * 10, 'b': [b'\x00' * 5]}), 15)
+
+    def testCacheSizedByBytes(self):
+        from girder.plugins.large_image.cache_util import CacheFactory, setConfig, \
+            getConfig, estimateSize, ItemLRUCache
+
+        self.assertIsNone(CacheFactory().getCacheBytes())
+        origBackend = getConfig('cache_backend')
+        setConfig('cache_backend', 'python')
+        setConfig('cache_python_memory_bytes', 10000)
+        try:
+            self.assertEqual(CacheFactory().getCacheBytes(), 10000)
+            cache, lock = CacheFactory().getCache()
+            self.assertEqual(cache.maxsize, 10000)
+            for idx in range(10):
+                cache[idx] = b'\x00' * 3000
+            self.assertEqual(len(cache), 3)
+            self.assertEqual(cache.currsize, 9000)
+            self.assertIn(9, cache)
+            with self.assertRaises(ValueError):
+                cache['large'] = b'\x00' * 20000
+            self.assertEqual(cache.getsizeof, estimateSize)
+            # A cache with a specific number of items ignores the byte limit
+            cache, lock = CacheFactory().getCache(5)
+            self.assertEqual(cache.maxsize, 5)
+            # Without a byte limit, the tile cache is limited by items and
+            # keeps a running total of the bytes it holds
+            setConfig('cache_python_memory_bytes', None)
+            cache, lock = CacheFactory().getCache()
+            self.assertTrue(isinstance(cache, ItemLRUCache))
+            for idx in range(3):
+                cache[idx] = b'\x00' * (idx + 1) * 100
+            self.assertEqual(cache.bytes, 600)
+            cache[1] = b'\x00' * 50
+            self.assertEqual(cache.bytes, 450)
+            del cache[0]
+            self.assertEqual(cache.bytes, 350)
+            cache.clear()
+            self.assertEqual(cache.bytes, 0)
+        finally:
+            setConfig('cache_python_memory_bytes', None)
+            setConfig('cache_backend', origBackend)
+
     def testCacheMemcached(self):
         from girder.plugins.large_image.cache_util import MemCache
 
         self._testDecorator(MemCache())
 
+    def testTieredCache(self):
+        from girder.plugins.large_image.cache_util import Cache, TieredCache, \
+            estimateSize
+
+        l2 = Cache(1000)
+        cache = TieredCache(l2, 10, getsizeof=estimateSize)
+        cache['a'] = b'12345'
+        cache['b'] = b'123456'
+        # Both values are in L2, but only the most recent fits in L1
+        self.assertEqual(set(l2.keys()), {'a', 'b'})
+        self.assertEqual(list(cache.l1.keys()), ['b'])
+        self.assertEqual(cache['b'], b'123456')
+        self.assertEqual((cache.l1Hits, cache.l2Hits), (1, 0))
+        # Reading from L2 adds the value to L1
+        self.assertEqual(cache['a'], b'12345')
+        self.assertEqual((cache.l1Misses, cache.l2Hits), (1, 1))
+        self.assertEqual(list(cache.l1.keys()), ['a'])
+        with six.assertRaisesRegex(self, KeyError, 'c'):
+            cache['c']
+        self.assertEqual(cache.l2Misses, 1)
+        self.assertEqual(cache.getMany(['a', 'b', 'c']), {'a': b'12345', 'b': b'123456'})
+        cache.setMany({'d': b'1', 'e': b'22'})
+        self.assertEqual(l2['e'], b'22')
+        self.assertIn('e', cache)
+        # Clearing only clears L1
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(len(l2), 4)
+        self.assertEqual(cache['d'], b'1')
+
+        self._testDecorator(TieredCache(Cache(1000), 1000))
+
+    def testTieredCacheMemcached(self):
+        from girder.plugins.large_image.cache_util import MemCache, TieredCache
+
+        cache = TieredCache(MemCache(), 1000)
+        self._testDecorator(cache)
+        self.assertGreater(cache.l1Hits, 0)
+        cache.clear()
+        self.assertEqual(cache['(100,)'], 354224848179261915075)
+        self.assertEqual(cache.l2Hits, 1)
+
+    def testMemcachedThreads(self):
+        from girder.plugins.large_image.cache_util import MemCache
+
+        # The client pool allows using the cache from many threads without a
+        # lock, even with more threads than clients.
+        cache = MemCache(poolSize=3)
+        errors = []
+
+        def loop(idx):
+            try:
+                for x in range(200):
+                    key = 'thread_test %d %d' % (idx, x)
+                    cache[key] = x * idx
+                    self.assertEqual(cache[key], x * idx)
+                self.assertEqual(cache.getMany(['thread_test %d 5' % idx]),
+                                 {'thread_test %d 5' % idx: 5 * idx})
+            except Exception as exc:
+                errors.append(exc)
+
+        threadList = [threading.Thread(target=loop, args=(idx, )) for idx in range(8)]
+        for t in threadList:
+            t.start()
+        for t in threadList:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(cache._clientPool.qsize(), 3)
+
+    def testDiskCache(self):
+        from girder.plugins.large_image.cache_util import DiskCache
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            cache = DiskCache(tempDir, 100000, shards=2)
+            self._testDecorator(cache)
+            self.assertEqual(cache['(100,)'], 354224848179261915075)
+            cache['a'] = {'value': b'\x00' * 1000}
+            self.assertIn('a', cache)
+            self.assertEqual(cache['a'], {'value': b'\x00' * 1000})
+            with six.assertRaisesRegex(self, KeyError, 'b'):
+                cache['b']
+            with six.assertRaisesRegex(self, ValueError, 'too large'):
+                cache['b'] = b'\x00' * 60000
+            # Values persist for other cache instances
+            cache2 = DiskCache(tempDir, 100000, shards=2)
+            self.assertEqual(cache2['(100,)'], 354224848179261915075)
+            # The cache evicts values to stay within its size
+            for idx in range(200):
+                cache['value %d' % idx] = b'\x00' * 1000
+            self.assertLessEqual(cache.currsize, 100000)
+            self.assertGreater(cache.currsize, 80000)
+            self.assertLess(len(cache), 100)
+            self.assertIn('value 199', cache)
+            self.assertNotIn('value 0', cache)
+            self.assertEqual(cache.getMany(['value 199', 'value 0']),
+                             {'value 199': b'\x00' * 1000})
+            cache.setMany({'c': 1, 'd': 2})
+            self.assertEqual(cache2['d'], 2)
+            del cache['d']
+            self.assertNotIn('d', cache2)
+            cache.clear()
+            self.assertEqual(len(cache2), 0)
+            self.assertEqual(cache2.currsize, 0)
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testMethodcacheSingleFlight(self):
+        import cachetools
+        import time
+        from girder.plugins.large_image.cache_util import methodcache, setConfig, \
+            cachesInfo
+
+        self.cache = cachetools.LRUCache(10)
+        self.cache_lock = threading.Lock()
+        self.calls = 0
+
+        @methodcache(lambda x: str(x))
+        def slowDouble(self, x):
+            self.calls += 1
+            time.sleep(0.25)
+            if x < 0:
+                raise ValueError('Negative value %d' % x)
+            return x * 2
+
+        def run(x):
+            try:
+                results.append(slowDouble(self, x))
+            except ValueError as exc:
+                results.append(exc.args[0])
+
+        def runThreads(values):
+            threadList = [threading.Thread(target=run, args=(x, )) for x in values]
+            for t in threadList:
+                t.start()
+            for t in threadList:
+                t.join()
+
+        start = cachesInfo()['singleFlight']
+        # Concurrent calls for the same value compute it once
+        results = []
+        runThreads([5] * 8 + [-1] * 4)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(sorted(results, key=str), [10] * 8 + ['Negative value -1'] * 4)
+        info = cachesInfo()['singleFlight']
+        self.assertEqual(info['saved'] - start['saved'], 7)
+        self.assertEqual(info['errors'] - start['errors'], 3)
+        self.assertEqual(info['inFlight'], 0)
+        # Errors are not cached
+        results = []
+        runThreads([-1])
+        self.assertEqual(self.calls, 3)
+        # Callers that wait too long compute the value themselves
+        setConfig('cache_singleflight_timeout', 0.05)
+        try:
+            results = []
+            runThreads([6] * 3)
+        finally:
+            setConfig('cache_singleflight_timeout', None)
+        self.assertEqual(results, [12] * 3)
+        self.assertEqual(self.calls, 6)
+        self.assertEqual(cachesInfo()['singleFlight']['timeouts'] - start['timeouts'], 2)
+
+        # Instances with their own caches don't share computations, even if
+        # their keys match
+        class Doubler(object):
+            def __init__(self, factor):
+                self.cache = cachetools.LRUCache(10)
+                self.cache_lock = threading.Lock()
+                self.factor = factor
+
+            @methodcache(lambda x: str(x))
+            def slowDouble(self, x):
+                time.sleep(0.25)
+                return x * 2 * self.factor
+
+        doublers = [Doubler(1), Doubler(10)]
+        results = [None] * len(doublers)
+
+        def runDoubler(idx):
+            results[idx] = doublers[idx].slowDouble(5)
+
+        threadList = [threading.Thread(target=runDoubler, args=(idx, ))
+                      for idx in range(len(doublers))]
+        for t in threadList:
+            t.start()
+        for t in threadList:
+            t.join()
+        self.assertEqual(results, [10, 100])
+
+    def testMethodcacheStats(self):
+        import cachetools
+        from girder.plugins.large_image.cache_util import methodcache, \
+            getCacheStats, cachesMetrics
+
+        self.cache = cachetools.LRUCache(2)
+        self.cache_lock = threading.Lock()
+
+        @methodcache(lambda x: str(x))
+        def double(self, x):
+            return x * 2
+
+        start = getCacheStats().get('methodcache', {})
+        for x in [1, 2, 1, 3, 4, 4]:
+            double(self, x)
+        stats = getCacheStats()['methodcache']
+        self.assertEqual(stats['hits'] - start.get('hits', 0), 2)
+        self.assertEqual(stats['misses'] - start.get('misses', 0), 4)
+        self.assertEqual(stats['stores'] - start.get('stores', 0), 4)
+        self.assertEqual(stats['evictions'] - start.get('evictions', 0), 2)
+        self.assertGreater(stats['storedBytes'], start.get('storedBytes', 0))
+
+        metrics = cachesMetrics({
+            'a"b': {'hits': 3, 'maxsize': 10, 'units': 'items',
+                    'l1': {'hitSeconds': 0.5}}})
+        self.assertEqual(metrics.split('\n'), [
+            '# TYPE large_image_cache_hits counter',
+            'large_image_cache_hits{cache="a\\"b"} 3',
+            '# TYPE large_image_cache_l1_hit_seconds counter',
+            'large_image_cache_l1_hit_seconds{cache="a\\"b"} 0.5',
+            '# TYPE large_image_cache_maxsize gauge',
+            'large_image_cache_maxsize{cache="a\\"b"} 10',
+            ''])
+
     def testCheckCacheMemcached(self):
         from girder.plugins.large_image.cache_util import MemCache
         # go though and check if all 100 fib numbers are in cache
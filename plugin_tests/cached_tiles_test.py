@@ -216,7 +216,7 @@ class LargeImageCachedTilesTest(common.LargeImageCommonTest):
         if self.tileCacheIsReported:
             self.assertEqual(cache_util.cachesInfo()['tileCache']['used'], 0)
         else:
-            self.assertNotIn('tileCache', cache_util.cachesInfo())
+            self.assertNotIn('used', cache_util.cachesInfo().get('tileCache', {}))
         # Accessing this will add it to the loadmodelcache and the tile cache
         self.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
                      user=self.admin, isJson=False)
@@ -224,6 +224,8 @@ class LargeImageCachedTilesTest(common.LargeImageCommonTest):
         self.assertEqual(cache_util.cachesInfo()['LoadModelCache']['used'], 1)
         if self.tileCacheIsReported:
             self.assertEqual(cache_util.cachesInfo()['tileCache']['used'], 1)
+            self.assertEqual(cache_util.cachesInfo()['tileCache']['items'], 1)
+            self.assertGreater(cache_util.cachesInfo()['tileCache']['bytes'], 0)
         cache_util.cachesClear()
         self.assertEqual(cache_util.cachesInfo()['tilesource']['used'], 0)
         self.assertEqual(cache_util.cachesInfo()['LoadModelCache']['used'], 0)
@@ -241,6 +243,93 @@ class LargeImageCachedTilesTest(common.LargeImageCommonTest):
         resp = self.request(path='/large_image/cache', method='GET', user=self.admin)
         self.assertStatusOk(resp)
         self.assertEqual(resp.json['tilesource']['used'], 0)
+        self.assertEqual(resp.json['decodedTileCache']['used'], 0)
+
+    def testCacheStats(self):
+        from girder.plugins.large_image import cache_util
+        from girder.plugins.large_image.models.image_item import ImageItem
+
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        item = Item().load(itemId, user=self.admin)
+        cache_util.cachesClear()
+        ImageItem().tileSource(item)
+        ImageItem().tileSource(item)
+        start = cache_util.cachesInfo()
+        self.assertGreaterEqual(start['tilesource']['misses'], 1)
+        self.assertGreaterEqual(start['tilesource']['hits'], 1)
+        source = ImageItem().tileSource(item)
+        # The first request for a tile is a miss, the second is a hit
+        source.getTile(0, 0, 0)
+        info = cache_util.cachesInfo()
+        self.assertEqual(info['tilesource']['hits'] - start['tilesource']['hits'], 1)
+        self.assertEqual(info['tileCache']['misses'] - start['tileCache']['misses'], 1)
+        self.assertEqual(info['tileCache']['stores'] - start['tileCache']['stores'], 1)
+        self.assertGreater(info['tileCache']['storedBytes'], start['tileCache']['storedBytes'])
+        self.assertGreater(info['tileCache']['missSeconds'], start['tileCache']['missSeconds'])
+        source.getTile(0, 0, 0)
+        info2 = cache_util.cachesInfo()
+        self.assertEqual(info2['tileCache']['hits'] - info['tileCache']['hits'], 1)
+        self.assertEqual(info2['tileCache']['misses'], info['tileCache']['misses'])
+        # getTiles counts each tile
+        source.getTiles([(0, 0, 1), (1, 0, 1), (0, 0, 0)])
+        info3 = cache_util.cachesInfo()
+        self.assertEqual(info3['tileCache']['hits'] - info2['tileCache']['hits'], 1)
+        self.assertEqual(info3['tileCache']['misses'] - info2['tileCache']['misses'], 2)
+        # The counters are available via rest calls
+        resp = self.request(path='/large_image/cache', method='GET', user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['tileCache']['hits'], info3['tileCache']['hits'])
+        resp = self.request(path='/large_image/cache/metrics', method='GET',
+                            user=self.admin, isJson=False)
+        self.assertStatusOk(resp)
+        metrics = self.getBody(resp)
+        self.assertIn('# TYPE large_image_cache_hits counter', metrics)
+        self.assertIn('large_image_cache_hits{cache="tileCache"} %d' % (
+            info3['tileCache']['hits']), metrics)
+        self.assertIn('# TYPE large_image_cache_used gauge', metrics)
+        self.assertIn('large_image_cache_hit_seconds{cache="tilesource"}', metrics)
+
+    def testDecodedTileCache(self):
+        from girder.plugins.large_image import cache_util
+        from girder.plugins.large_image.models.image_item import ImageItem
+
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        item = Item().load(itemId, user=self.admin)
+        source = ImageItem().tileSource(item)
+        cache_util.cachesClear()
+        info = cache_util.cachesInfo()['decodedTileCache']
+        self.assertEqual(info['used'], 0)
+        hits, misses = info['hits'], info['misses']
+        # Overlapping tiles use each source tile up to four times, but only
+        # decode it once.
+        params = {
+            'format': 'numpy', 'region': {'width': 1000, 'height': 1000},
+            'tile_overlap': {'x': 32, 'y': 32}}
+        tiles = [tile['tile'] for tile in source.tileIterator(**params)]
+        info = cache_util.cachesInfo()['decodedTileCache']
+        self.assertEqual(info['items'], 16)
+        self.assertEqual(info['used'], 16 * 256 * 256 * 3)
+        self.assertEqual(info['misses'] - misses, 16)
+        self.assertGreater(info['hits'] - hits, 0)
+        # Iterating again doesn't decode any tiles and gives the same results
+        for tile, oldTile in zip(source.tileIterator(**params), tiles):
+            self.assertTrue((tile['tile'] == oldTile).all())
+        self.assertEqual(cache_util.cachesInfo()['decodedTileCache']['misses'],
+                         info['misses'])
+        # Retiling also uses the decoded tiles
+        params = {
+            'format': 'numpy', 'region': {'width': 1000, 'height': 1000},
+            'tile_size': {'width': 300, 'height': 300}}
+        for tile in source.tileIterator(**params):
+            self.assertEqual(tile['tile'].shape[2], 3)
+        self.assertEqual(cache_util.cachesInfo()['decodedTileCache']['misses'],
+                         info['misses'])
+        cache_util.cachesClear()
+        self.assertEqual(cache_util.cachesInfo()['decodedTileCache']['used'], 0)
 
 
 class MemcachedCache(LargeImageCachedTilesTest):
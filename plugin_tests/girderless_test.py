@@ -19,6 +19,7 @@
 
 import math
 import os
+import six
 import sys
 import unittest
 
@@ -30,6 +31,72 @@ JPEGHeader = b'\xff\xd8\xff'
 PNGHeader = b'\x89PNG'
 
 
+def _writeTiledTiff(path, data, tileSize, compression=1):
+    """
+    Write a minimal little-endian tiled TIFF file.
+
+    :param path: the file to write.
+    :param data: a height x width x samples unsigned integer numpy array.
+    :param tileSize: the width and height of the tiles.
+    :param compression: 1 for uncompressed or 8 for deflate.
+    """
+    import numpy
+    import struct
+    import zlib
+
+    height, width, samples = data.shape
+    data = data.astype(data.dtype.newbyteorder('<'))
+    tiles = []
+    for y in range(0, height, tileSize):
+        for x in range(0, width, tileSize):
+            tile = numpy.zeros((tileSize, tileSize, samples), dtype=data.dtype)
+            part = data[y:y + tileSize, x:x + tileSize]
+            tile[:part.shape[0], :part.shape[1]] = part
+            tile = tile.tobytes()
+            tiles.append(zlib.compress(tile) if compression == 8 else tile)
+    offset = 8
+    offsets = []
+    for tile in tiles:
+        offsets.append(offset)
+        offset += len(tile)
+    bitsOffset = offset
+    offset += 2 * samples
+    tileOffsetsOffset = offset
+    offset += 4 * len(tiles)
+    tileByteCountsOffset = offset
+    offset += 4 * len(tiles)
+    # tag, type, count, value; types are 3 (short) and 4 (long)
+    tags = [
+        (256, 4, 1, width),
+        (257, 4, 1, height),
+        (258, 3, samples, bitsOffset if samples > 2 else data.dtype.itemsize * 8),
+        (259, 3, 1, compression),
+        (262, 3, 1, 2 if samples >= 3 else 1),
+        (277, 3, 1, samples),
+        (284, 3, 1, 1),
+        (322, 4, 1, tileSize),
+        (323, 4, 1, tileSize),
+        (324, 4, len(tiles), tileOffsetsOffset if len(tiles) > 1 else offsets[0]),
+        (325, 4, len(tiles), tileByteCountsOffset if len(tiles) > 1 else len(tiles[0])),
+        (339, 3, 1, 1),
+    ]
+    with open(path, 'wb') as fptr:
+        fptr.write(struct.pack('<2sHI', b'II', 42, offset))
+        for tile in tiles:
+            fptr.write(tile)
+        fptr.write(struct.pack('<%dH' % samples, *([data.dtype.itemsize * 8] * samples)))
+        fptr.write(struct.pack('<%dI' % len(tiles), *offsets))
+        fptr.write(struct.pack('<%dI' % len(tiles), *[len(tile) for tile in tiles]))
+        fptr.write(struct.pack('<H', len(tags)))
+        for tag, tagType, count, value in tags:
+            # A single short is stored in the first half of the value field
+            if tagType == 3 and count == 1:
+                fptr.write(struct.pack('<HHIHH', tag, tagType, count, value, 0))
+            else:
+                fptr.write(struct.pack('<HHII', tag, tagType, count, value))
+        fptr.write(struct.pack('<I', 0))
+
+
 class LargeImageGirderlessTest(unittest.TestCase):
     def _testTilesZXY(self, source, metadata, tileParams={},
                       imgHeader=JPEGHeader):
@@ -116,6 +183,577 @@ class LargeImageGirderlessTest(unittest.TestCase):
         tileMetadata['sparse'] = 5
         self._testTilesZXY(source, tileMetadata)
 
+    def testTiffTileIndex(self):
+        import numpy
+        from large_image import tilesource
+
+        source = tilesource.AvailableTileSources['tifffile'](
+            os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        for td in source._tiffDirectories:
+            if td is None:
+                continue
+            # Tiles are located without libtiff
+            tileIndex = td._tileIndex
+            self.assertIsNotNone(tileIndex)
+            self.assertEqual(tileIndex.tilesAcross * tileIndex.tilesDown,
+                             len(tileIndex.tileOffsets))
+            self.assertEqual(td._toTileNum(tileIndex.tilesAcross - 1, 0),
+                             tileIndex.tilesAcross - 1)
+            # Raw tiles match those read by libtiff
+            present = numpy.nonzero(tileIndex.tileByteCounts)[0]
+            for tileNum in (present[0], present[-1]):
+                frame = td._readRawTile(tileNum)
+                td._tileIndex = None
+                try:
+                    self.assertEqual(td._readRawTile(tileNum), frame)
+                finally:
+                    td._tileIndex = tileIndex
+        with six.assertRaisesRegex(self, tilesource.TileSourceException,
+                                   'does not exist'):
+            source.getTile(1000, 0, 8)
+
+    def testTiffTileIndexMissingOffsets(self):
+        import numpy
+        import shutil
+        import tempfile
+        from large_image.tilesource import tiff_index
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            imagePath = os.path.join(tempDir, 'image.tiff')
+            _writeTiledTiff(imagePath, numpy.zeros((100, 100, 1), dtype=numpy.uint8), 64)
+            with open(imagePath, 'rb') as fptr:
+                data = fptr.read()
+            # Rename the TileOffsets tag so that it is missing
+            with open(imagePath, 'wb') as fptr:
+                fptr.write(data.replace(b'\x44\x01\x04\x00', b'\xe8\xfd\x04\x00'))
+            tiffFile = tiff_index.TiffFile(imagePath)
+            try:
+                with six.assertRaisesRegex(self, ValueError, 'Missing TIFF offsets'):
+                    tiffFile.directory(0)
+            finally:
+                tiffFile.close()
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testTiffCoalescedReads(self):
+        from large_image import tilesource
+
+        source = tilesource.AvailableTileSources['tifffile'](
+            os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        td = source._tiffDirectories[-1]
+        tiffFile = td._tileIndex.file
+        reads = []
+        origRead = tiffFile.read
+
+        def countRead(offset, length):
+            reads.append((offset, length))
+            return origRead(offset, length)
+
+        tiles = [(x, 20) for x in range(10, 30)]
+        tiffFile.read = countRead
+        try:
+            rawTiles = td.readRawTiles(tiles + [(1000, 0)])
+            self.assertLess(len(reads), len(tiles))
+            self.assertEqual(len(rawTiles), len(tiles))
+            for x, y in tiles:
+                tileNum = td._toTileNum(x, y)
+                self.assertEqual(rawTiles[tileNum], td._tileIndex.readTile(tileNum))
+            # Prefetched tiles aren't read again
+            td.prefetchRawTiles(tiles)
+            del reads[:]
+            tile = td.getTile(*tiles[0])
+            self.assertEqual(reads, [])
+            td.clearPrefetchedRawTiles()
+            self.assertEqual(td.getTile(*tiles[0]), tile)
+            self.assertEqual(len(reads), 1)
+        finally:
+            del tiffFile.read
+        # Getting a region gives the same result with and without reading
+        # rows of tiles together
+        params = {'region': {'left': 2500, 'top': 5000, 'width': 3000, 'height': 800},
+                  'format': tilesource.TILE_FORMAT_NUMPY}
+        region, _ = source.getRegion(**params)
+        source.cache.clear()
+        source.batchTileRows = False
+        try:
+            self.assertTrue((source.getRegion(**params)[0] == region).all())
+        finally:
+            del source.batchTileRows
+        # Rows are only read when a tile's image data is used
+        rows = []
+        origLoadTileRow = source._loadTileRow
+
+        def countLoadTileRow(*args, **kwargs):
+            rows.append(args)
+            return origLoadTileRow(*args, **kwargs)
+
+        source._loadTileRow = countLoadTileRow
+        try:
+            tiles = list(source.tileIterator(region=params['region']))
+            self.assertGreater(len(tiles), 1)
+            self.assertEqual(rows, [])
+            tiles[1]['tile']
+            tiles[0]['tile']
+            self.assertEqual(len(rows), 1)
+        finally:
+            del source._loadTileRow
+
+    def testTiffMetadataIndex(self):
+        import tempfile
+        import shutil
+        from large_image import cache_util, tilesource
+
+        indexPath = tempfile.mkdtemp()
+        cache_util.setConfig('cache_metadata_index_path', indexPath)
+        cache_util.cache._metadataIndexCacheChecked = False
+        try:
+            imagePath = os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif')
+            cache_util.cachesClear()
+            source = tilesource.AvailableTileSources['tifffile'](imagePath)
+            self.assertEqual(len(cache_util.getMetadataIndexCache()), 1)
+            tile = source.getTile(0, 0, source.levels - 1)
+            # Reopening the file uses the index without opening it with libtiff
+            cache_util.cachesClear()
+            indexed = tilesource.AvailableTileSources['tifffile'](imagePath)
+            self.assertIsNot(indexed, source)
+            self.assertIsNone(indexed._sharedFile._handle)
+            self.assertEqual(indexed.getMetadata(), source.getMetadata())
+            self.assertEqual(indexed.getAssociatedImagesList(),
+                             source.getAssociatedImagesList())
+            self.assertEqual(indexed.getTile(0, 0, indexed.levels - 1), tile)
+            # libtiff is still used when it is needed
+            td = indexed._tiffDirectories[-1]
+            self.assertEqual(td._getTileByteCountsType(),
+                             source._tiffDirectories[-1]._getTileByteCountsType())
+            self.assertIsNotNone(indexed._sharedFile._handle)
+        finally:
+            cache_util.setConfig('cache_metadata_index_path', None)
+            cache_util.cache._metadataIndexCacheChecked = False
+            cache_util.cachesClear()
+            shutil.rmtree(indexPath)
+
+    def testTiffAssociatedImages(self):
+        from large_image import tilesource
+
+        source = tilesource.AvailableTileSources['tifffile'](
+            os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        self.assertEqual(source.getAssociatedImagesList(), ['label', 'macro'])
+        # Associated images aren't decoded until they are requested
+        self.assertEqual(len(source._associatedImageCache), 0)
+        for imageKey in source._associatedImages:
+            image, mimeType = source.getAssociatedImage(imageKey)
+            self.assertEqual(mimeType, 'image/jpeg')
+            self.assertIn(imageKey, source._associatedImageCache)
+            self.assertEqual(source.getAssociatedImage(imageKey), (image, mimeType))
+        self.assertLessEqual(len(source._associatedImageCache),
+                             source.associatedImageCacheSize)
+        self.assertIsNone(source.getAssociatedImage('nosuchimage'))
+
+    def testTiffSharedFile(self):
+        from large_image import tilesource
+
+        source = tilesource.AvailableTileSources['tifffile'](
+            os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        tds = [td for td in source._tiffDirectories if td is not None]
+        # Every directory uses the same libtiff handle and raw file
+        self.assertEqual({id(td._sharedFile) for td in tds}, {id(source._sharedFile)})
+        self.assertEqual({id(td._tileIndex.file) for td in tds},
+                         {id(source._sharedFile.tiffFile())})
+        # Switching the libtiff handle between directories gives the same
+        # tiles as reading through the tile index
+        expected = [td.getTile(0, 0) for td in tds]
+        indices = [td._tileIndex for td in tds]
+        try:
+            for td in tds:
+                td._tileIndex = None
+            for _ in range(2):
+                self.assertEqual([td.getTile(0, 0) for td in tds], expected)
+        finally:
+            for td, tileIndex in zip(tds, indices):
+                td._tileIndex = tileIndex
+
+    def testOMETiffFrameDirectories(self):
+        from large_image import cache_util, tilesource
+
+        source = tilesource.AvailableTileSources['ometifffile'](
+            os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample.ome.tif'))
+        numFrames = len(source.getMetadata()['frames'])
+        self.assertGreater(numFrames, 2)
+        z = source.levels - 1
+        self.assertEqual(len(source._frameDirectoryTable[z]), numFrames)
+        # The first frame uses the level's own directory
+        self.assertIs(source._getFrameDirectory(z, 0), source._tiffDirectories[z])
+        # Other frames are cached and share the open file
+        td = source._getFrameDirectory(z, 1)
+        self.assertIs(source._getFrameDirectory(z, '1'), td)
+        self.assertIs(td._sharedFile, source._sharedFile)
+        self.assertEqual(td._directoryNum, source._frameDirectoryTable[z][1])
+        with self.assertRaises(tilesource.TileSourceException):
+            source._getFrameDirectory(z, numFrames)
+        # Scrubbing through more frames than are cached keeps the most
+        # recently used directories
+        source._directoryCache = cache_util.LRUCache(2)
+        tiles = [source._getFrameDirectory(z, frame).getTile(0, 0)
+                 for frame in range(numFrames)]
+        self.assertEqual(len(source._directoryCache), 2)
+        self.assertIn(source._frameDirectoryTable[z][-1], source._directoryCache)
+        handle = source._sharedFile._handle
+        for frame in range(numFrames - 1, -1, -1):
+            self.assertEqual(source._getFrameDirectory(z, frame).getTile(0, 0), tiles[frame])
+        self.assertIs(source._sharedFile._handle, handle)
+
+    def testOMETiffTileStackIterator(self):
+        import numpy
+        from large_image import tilesource
+
+        source = tilesource.AvailableTileSources['ometifffile'](
+            os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample.ome.tif'))
+        frames = [0, 2, 1]
+        for params in (
+                {'scale': {'magnification': 5}},
+                {'region': {'left': 100, 'top': 50, 'width': 700, 'height': 500},
+                 'tile_size': {'width': 300}, 'tile_overlap': {'x': 20}}):
+            stacks = list(source.tileStackIterator(frames=frames, workers=2, **params))
+            perFrame = [list(source.tileIterator(
+                format=tilesource.TILE_FORMAT_NUMPY, resample=False, frame=frame, **params))
+                for frame in frames]
+            self.assertGreater(len(stacks), 1)
+            self.assertEqual(len(stacks), len(perFrame[0]))
+            for idx, stack in enumerate(stacks):
+                self.assertEqual(stack['frames'], frames)
+                self.assertEqual(stack['format'], tilesource.TILE_FORMAT_NUMPY)
+                self.assertEqual(stack['tile_position'], perFrame[0][idx]['tile_position'])
+                self.assertEqual(stack['tile'].shape[0], len(frames))
+                for frameIdx in range(len(frames)):
+                    self.assertTrue(numpy.array_equal(
+                        stack['tile'][frameIdx], perFrame[frameIdx][idx]['tile']))
+        # All frames are used by default, and stopping early is not a problem
+        tileIter = source.tileStackIterator(scale={'magnification': 5})
+        stack = next(tileIter)
+        self.assertEqual(stack['frames'], list(range(len(source.getMetadata()['frames']))))
+        tileIter.close()
+
+    def testOMETiffComposite(self):
+        import json
+        import numpy
+        from large_image import tilesource
+
+        path = os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample.ome.tif')
+        composite = {'channels': [
+            {'frame': 0, 'color': '#0000FF'},
+            {'frame': 1, 'color': [0, 255, 0], 'min': 10, 'max': 200, 'gamma': 2},
+            {'frame': 2, 'color': 'red', 'max': 128}]}
+        source = tilesource.AvailableTileSources['ometifffile'](
+            path, composite=json.dumps(composite))
+        plain = tilesource.AvailableTileSources['ometifffile'](path)
+        region = {'left': 100, 'top': 50, 'width': 600, 'height': 400}
+        # Combine the frames as the composite should
+        expected = numpy.zeros((400, 600, 3))
+        for channel in source._composite:
+            data, _ = plain.getRegion(
+                format=tilesource.TILE_FORMAT_NUMPY, frame=channel['frame'], region=region)
+            if len(data.shape) == 3:
+                data = data[:, :, 0]
+            high = channel['max'] or numpy.iinfo(data.dtype).max
+            value = numpy.clip((data.astype(float) - (channel['min'] or 0)) /
+                               (high - (channel['min'] or 0)), 0, 1)
+            expected += value[:, :, numpy.newaxis] ** (1.0 / channel['gamma']) * channel['color']
+        expected = numpy.clip(expected, 0, 1) * 255
+        result, _ = source.getRegion(format=tilesource.TILE_FORMAT_NUMPY, region=region)
+        self.assertEqual(result.shape[:2], (400, 600))
+        self.assertLessEqual(numpy.abs(result[:, :, :3] - expected).max(), 1)
+        for tile in source.tileIterator(format=tilesource.TILE_FORMAT_NUMPY, region=region):
+            self.assertTrue(numpy.array_equal(
+                tile['tile'], result[tile['y'] - 50:tile['y'] - 50 + tile['height'],
+                                     tile['x'] - 100:tile['x'] - 100 + tile['width']]))
+        self.assertEqual(source.getTile(0, 0, source.levels - 1)[:len(JPEGHeader)], JPEGHeader)
+        # The composite is part of the source's cache keys
+        self.assertNotEqual(source.getState(), plain.getState())
+        self.assertNotEqual(source.getTile(0, 0, source.levels - 1),
+                            plain.getTile(0, 0, source.levels - 1))
+        # The tiles of the frames that are composited aren't cached as tiles
+        # of the composite source
+        tileKwargs = {'pilImageAllowed': True, 'sparseFallback': False}
+        self.assertTrue(numpy.array_equal(
+            numpy.asarray(source.getTile(1, 1, source.levels - 1, frame=0, **tileKwargs)),
+            numpy.asarray(source.getTile(1, 1, source.levels - 1, **tileKwargs))))
+        for composite in ('not json', {'channels': []},
+                          {'channels': [{'color': 'red'}]},
+                          {'channels': [{'frame': 1000}]},
+                          {'channels': [{'frame': 0, 'gamma': 0}]}):
+            with self.assertRaises(tilesource.TileSourceException):
+                tilesource.AvailableTileSources['ometifffile'](path, composite=composite)
+
+    def testOMETiffMetadataFrames(self):
+        from large_image import tilesource
+
+        source = tilesource.AvailableTileSources['ometifffile'](
+            os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample.ome.tif'))
+        # The OME metadata isn't converted until it is asked for
+        self.assertIsNone(source._omeinfo)
+        metadata = source.getMetadata(framesLimit=0, omeinfo=False)
+        self.assertNotIn('omeinfo', metadata)
+        self.assertIsNone(source._omeinfo)
+        self.assertEqual(metadata['frameCount'], 3)
+        self.assertEqual(metadata['frames'], [])
+        page = source.getMetadata(framesOffset=1, framesLimit=1, omeinfo=False)
+        self.assertIsNone(source._omeinfo)
+        self.assertEqual(page['frameCount'], 3)
+        self.assertEqual(page['framesOffset'], 1)
+        self.assertEqual(len(page['frames']), 1)
+        self.assertEqual(page['frames'][0]['Frame'], 1)
+        self.assertEqual(page['frames'][0]['IFD'], source._frameDirectoryTable[-1][1])
+        self.assertEqual(source.getMetadata(framesOffset=5)['frames'], [])
+        compact = source.getMetadata(framesOffset=0, omeinfo=False)['frames']
+        self.assertEqual(compact[1:2], page['frames'])
+        # By default, frames are the OME Plane or TiffData records
+        metadata = source.getMetadata()
+        omeinfo = metadata['omeinfo']
+        pixels = omeinfo['Image'][0]['Pixels']
+        self.assertEqual(len(pixels['TiffData']), 3)
+        self.assertEqual(metadata['frameCount'], 3)
+        self.assertEqual(metadata['frames'], pixels.get('Plane', pixels['TiffData']))
+        for frame, plane in zip(compact, metadata['frames']):
+            for key in ('TheC', 'TheZ', 'TheT'):
+                self.assertEqual(
+                    frame[key], int(plane.get(key, plane.get(key.replace('The', 'First'), 0))))
+        self.assertIs(source.getMetadata(framesLimit=0)['omeinfo'], omeinfo)
+
+    def testTiffConcurrentReads(self):
+        import random
+        import threading
+        from large_image import tilesource
+
+        source = tilesource.AvailableTileSources['tifffile'](
+            os.path.join(os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        tiles = []
+        for td in source._tiffDirectories:
+            if td is not None:
+                tiles.extend([
+                    (td, x, y)
+                    for x in range(min(8, int(math.ceil(float(td.imageWidth) / td.tileWidth))))
+                    for y in range(min(8, int(math.ceil(float(td.imageHeight) / td.tileHeight))))])
+
+        def readTile(td, x, y):
+            try:
+                return td.getTile(x, y)
+            except Exception as exc:
+                # Missing tiles should fail the same way every time
+                return type(exc)
+
+        def run(seed):
+            rand = random.Random(seed)
+            for _ in range(200):
+                idx = rand.randrange(len(tiles))
+                if readTile(*tiles[idx]) != expected[idx]:
+                    errors.append(tiles[idx][1:])
+
+        indices = {td: td._tileIndex for td, _, _ in tiles}
+        try:
+            # Read through the tile index and then through libtiff
+            for useIndex in (True, False):
+                for td in indices:
+                    td._tileIndex = indices[td] if useIndex else None
+                expected = [readTile(*tile) for tile in tiles]
+                errors = []
+                threadList = [threading.Thread(target=run, args=(seed, ))
+                              for seed in range(8)]
+                for thread in threadList:
+                    thread.start()
+                for thread in threadList:
+                    thread.join()
+                self.assertEqual(errors, [])
+        finally:
+            for td in indices:
+                td._tileIndex = indices[td]
+
+    def testTiffNativeTiles(self):
+        import numpy
+        import shutil
+        import tempfile
+        from large_image import tilesource
+
+        data = (numpy.arange(150 * 200 * 3, dtype=numpy.uint32) * 7 % 65536).astype(
+            numpy.uint16).reshape(150, 200, 3)
+        tempDir = tempfile.mkdtemp()
+        try:
+            for compression, samples in ((1, 3), (8, 3), (1, 1)):
+                imagePath = os.path.join(tempDir, 'image%d_%d.tiff' % (compression, samples))
+                _writeTiledTiff(imagePath, data[:, :, :samples], 64, compression)
+                source = tilesource.AvailableTileSources['tifffile'](imagePath)
+                td = source._tiffDirectories[-1]
+                self.assertTrue(td.hasTileArrays)
+                tile = td.getTileArray(1, 1)
+                self.assertEqual(tile.dtype, numpy.uint16)
+                self.assertTrue((tile.reshape(64, 64, samples) ==
+                                 data[64:128, 64:128, :samples]).all())
+                # Numpy regions and tiles keep 16 bits per sample
+                region = {'left': 30, 'top': 20, 'width': 150, 'height': 100}
+                result, format = source.getRegion(
+                    region=region, format=tilesource.TILE_FORMAT_NUMPY)
+                self.assertEqual(format, tilesource.TILE_FORMAT_NUMPY)
+                self.assertEqual(result.dtype, numpy.uint16)
+                self.assertTrue((result.reshape(100, 150, samples) ==
+                                 data[20:120, 30:180, :samples]).all())
+                for tile in source.tileIterator(region=region, format=tilesource.TILE_FORMAT_NUMPY):
+                    self.assertEqual(tile['tile'].dtype, numpy.uint16)
+                # Images still have 8 bits per sample
+                image, format = source.getRegion(region=region, format=tilesource.TILE_FORMAT_PIL)
+                image = numpy.asarray(image)
+                self.assertEqual(image.dtype, numpy.uint8)
+                self.assertTrue((image[:, :, 0] == data[20:120, 30:180, 0] >> 8).all())
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testArrayToUint8(self):
+        import numpy
+        from large_image.tilesource.base import arrayToUint8
+
+        for dtype, values, expected in (
+                (numpy.uint8, [0, 1, 255], [0, 1, 255]),
+                (numpy.uint16, [0, 255, 256, 65535], [0, 0, 1, 255]),
+                (numpy.int8, [-128, -1, 0, 1, 64, 127], [0, 0, 0, 2, 128, 254]),
+                (numpy.int16, [-32768, -1, 0, 128, 32767], [0, 0, 0, 1, 255]),
+                (numpy.int32, [-1, 1 << 23, 2 ** 31 - 1], [0, 1, 255]),
+                (numpy.float32, [-0.5, 0, 0.5, 1, 2], [0, 0, 128, 255, 255])):
+            result = arrayToUint8(numpy.array(values, dtype=dtype))
+            self.assertEqual(result.dtype, numpy.uint8)
+            self.assertEqual(result.tolist(), expected)
+
+    def testPasteTileIntoArray(self):
+        import numpy
+        import PIL.Image
+        from large_image.tilesource.base import _pasteTileIntoArray
+
+        data = (numpy.arange(20 * 30 * 4) % 251).astype(numpy.uint8).reshape(20, 30, 4)
+        for mode, bands in (('L', [0]), ('LA', [0, 3]), ('RGB', [0, 1, 2]),
+                            ('RGBA', [0, 1, 2, 3])):
+            tileData = data[:, :, bands]
+            if len(bands) == 1:
+                tileData = tileData[:, :, 0]
+            # Compare with pasting the tile into an RGBA image, with the tile
+            # partly off of the top left of the region
+            expected = PIL.Image.new('RGBA', (40, 25))
+            expected.paste(PIL.Image.fromarray(tileData, mode), (-5, -3))
+            for tile in (tileData, PIL.Image.fromarray(tileData, mode)):
+                array = numpy.zeros((25, 40, 4), dtype=numpy.uint8)
+                _pasteTileIntoArray(array, {'tile': tile, 'x': 95, 'y': 197}, 100, 200)
+                self.assertTrue(numpy.array_equal(array, numpy.asarray(expected)))
+
+    def testTiffVirtualTiles(self):
+        import numpy
+        import PIL.Image
+        from large_image import cache_util, tilesource
+
+        imagePath = os.path.join(os.path.dirname(__file__), 'test_files', 'grey10kx5k.tif')
+        cache_util.cachesClear()
+        source = tilesource.AvailableTileSources['tifffile'](imagePath)
+        tileMetadata = source.getMetadata()
+        self.assertEqual(tileMetadata['tileWidth'], 256)
+        self.assertEqual(tileMetadata['tileHeight'], 256)
+        self.assertEqual(tileMetadata['sizeX'], 10000)
+        self.assertEqual(tileMetadata['sizeY'], 5000)
+        self.assertEqual(tileMetadata['levels'], 7)
+        td = source._tiffDirectories[-1]
+        self.assertIsInstance(td, tilesource.tiff_reader.StrippedTiffDirectory)
+        self.assertEqual(source._tiffDirectories[:-1], [None] * 6)
+        self._testTilesZXY(source, tileMetadata)
+
+        # Only the strips that intersect a tile are decoded
+        cache_util.cachesClear()
+        decodedCache, _ = cache_util.getDecodedTileCache()
+        tile = td.getTileArray(1, 2)
+        strips = sorted(key[-1] for key in decodedCache if key[0] == 'tiffstrip')
+        self.assertEqual(strips, list(range(512 // 64, 768 // 64)))
+        image = numpy.asarray(PIL.Image.open(imagePath))
+        self.assertTrue((tile == image[512:768, 256:512]).all())
+        region, _ = source.getRegion(
+            region={'left': 9900, 'top': 4900, 'width': 100, 'height': 100},
+            format=tilesource.TILE_FORMAT_NUMPY)
+        self.assertTrue((region[:, :, 0] == image[4900:, 9900:]).all())
+        # Lower levels average the full resolution pixels
+        reduced = source._readNativeTile(1, 0, source.levels - 2)
+        expected = numpy.rint(image[:512, 512:1024].reshape(256, 2, 256, 2).mean(axis=(1, 3)))
+        self.assertTrue((reduced == expected).all())
+        thumbnail, mimeType = source.getThumbnail(encoding='PNG')
+        self.assertEqual(thumbnail[:len(PNGHeader)], PNGHeader)
+
+    def testTiffByteSources(self):
+        import numpy
+        import shutil
+        import tempfile
+        import threading
+        from six.moves import BaseHTTPServer
+        from large_image import cache_util, tilesource
+
+        byte_source = tilesource.byte_source
+        tempDir = tempfile.mkdtemp()
+
+        class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with open(os.path.join(tempDir, self.path.lstrip('/')), 'rb') as fptr:
+                    data = fptr.read()
+                start, end = [int(val) for val in self.headers['Range'].split('=')[1].split('-')]
+                end = min(end, len(data) - 1)
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+                self.send_header('Content-Length', str(end + 1 - start))
+                self.end_headers()
+                self.wfile.write(data[start:end + 1])
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            data = (numpy.arange(300 * 400 * 3) % 251).astype(numpy.uint8).reshape(300, 400, 3)
+            imagePath = os.path.join(tempDir, 'image.tiff')
+            _writeTiledTiff(imagePath, data, 64, 8)
+            with open(imagePath, 'rb') as fptr:
+                fileData = fptr.read()
+            url = 'http://127.0.0.1:%d/image.tiff' % server.server_address[1]
+            # All kinds of byte sources read the same bytes
+            sources = [
+                byte_source.FileByteSource(imagePath),
+                byte_source.MmapByteSource(imagePath),
+                byte_source.BlockCachedByteSource(
+                    byte_source.FileByteSource(imagePath), blockSize=1024, maxBytes=8192),
+                byte_source.openByteSource(url),
+            ]
+            for offset, length in ((0, 8), (1000, 5000), (len(fileData) - 10, 100),
+                                   (1100, 300), (1200, 100), (len(fileData) + 10, 10)):
+                for source in sources:
+                    self.assertEqual(source.read(offset, length),
+                                     fileData[offset:offset + length])
+            stats = sources[2].getStats()
+            self.assertGreater(stats['hits'], 0)
+            self.assertLess(stats['bytesFetched'], len(fileData) + 8192)
+            # A tile source can read a file over HTTP without libtiff
+            cache_util.cachesClear()
+            source = tilesource.AvailableTileSources['tifffile'](url)
+            self.assertFalse(source._sharedFile.isLocal)
+            self.assertIsNone(source._sharedFile._handle)
+            tileMetadata = source.getMetadata()
+            self.assertEqual(tileMetadata['sizeX'], 400)
+            self.assertEqual(tileMetadata['sizeY'], 300)
+            self._testTilesZXY(source, tileMetadata)
+            region, _ = source.getRegion(
+                region={'left': 30, 'top': 20, 'width': 150, 'height': 100},
+                format=tilesource.TILE_FORMAT_NUMPY)
+            self.assertTrue((region[:, :, :3] == data[20:120, 30:180]).all())
+            self.assertIsNone(source._sharedFile._handle)
+            stats = cache_util.cachesInfo()['byteSource']
+            self.assertGreater(stats['bytesServed'], 0)
+            self.assertGreater(stats['bytesFetched'], 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tempDir)
+
     def testTilesFromSVS(self):
         from large_image import tilesource
 
@@ -146,6 +784,97 @@ class LargeImageGirderlessTest(unittest.TestCase):
             '01A-01-TS1.e8eb65de-d63e-42db-af6f-14fefbbdf7bd.svs'), **params)
         self._testTilesZXY(source, tileMetadata, params, PNGHeader)
 
+    def testSVSRegions(self):
+        import functools
+        import numpy
+        from large_image import cache_util, tilesource
+
+        source = tilesource.AvailableTileSources['svsfile'](os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_svs_image.TCGA-DU-6399-'
+            '01A-01-TS1.e8eb65de-d63e-42db-af6f-14fefbbdf7bd.svs'))
+        readRegion = source._openslide.read_region
+        calls = []
+
+        def countedReadRegion(*args):
+            calls.append(args)
+            return readRegion(*args)
+
+        source._openslide.read_region = countedReadRegion
+        try:
+            for params in (
+                    {'region': {'left': 1000, 'top': 700, 'width': 3000, 'height': 2000}},
+                    {'region': {'left': 5000, 'top': 3000, 'width': 9000, 'height': 6000},
+                     'scale': {'magnification': 5}},
+                    {'output': {'maxWidth': 800}}):
+                cache_util.cachesClear()
+                del calls[:]
+                region, _ = source.getRegion(format=tilesource.TILE_FORMAT_NUMPY, **params)
+                regionCalls = len(calls)
+                # Assemble the same region from tiles read through OpenSlide,
+                # as the base class does
+                jpegDirectories = source._jpegDirectories
+                source._jpegDirectories = [None] * source.levels
+                source._fillRegionArray = functools.partial(
+                    tilesource.TileSource._fillRegionArray, source)
+                try:
+                    cache_util.cachesClear()
+                    del calls[:]
+                    tiled, _ = source.getRegion(format=tilesource.TILE_FORMAT_NUMPY, **params)
+                finally:
+                    del source._fillRegionArray
+                    source._jpegDirectories = jpegDirectories
+                self.assertLessEqual(regionCalls, len(calls))
+                self.assertTrue(numpy.array_equal(region, tiled))
+        finally:
+            source._openslide.read_region = readRegion
+        # Blocks of levels that are scaled from an SVS level match the tiles,
+        # even when they aren't aligned to tiles
+        z = max(z for z in range(source.levels) if source._svslevels[z]['scale'] != 1)
+        left, top, width, height = 37, 21, 600, 400
+        region = numpy.zeros((height, width, 4), numpy.uint8)
+        source._readRegionBlock(region, z, left, top, left, top, width, height)
+        for ty in range(top // source.tileHeight, (top + height - 1) // source.tileHeight + 1):
+            for tx in range(left // source.tileWidth, (left + width - 1) // source.tileWidth + 1):
+                tile = numpy.asarray(source.getTile(tx, ty, z, pilImageAllowed=True))
+                x0, y0 = max(tx * source.tileWidth, left), max(ty * source.tileHeight, top)
+                x1 = min((tx + 1) * source.tileWidth, left + width)
+                y1 = min((ty + 1) * source.tileHeight, top + height)
+                self.assertTrue(numpy.array_equal(
+                    region[y0 - top:y1 - top, x0 - left:x1 - left],
+                    tile[y0 - ty * source.tileHeight:y1 - ty * source.tileHeight,
+                         x0 - tx * source.tileWidth:x1 - tx * source.tileWidth]))
+
+    def testSVSJpegPassthrough(self):
+        import numpy
+        import PIL.Image
+        from large_image import tilesource
+
+        source = tilesource.AvailableTileSources['svsfile'](os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_svs_image.TCGA-DU-6399-'
+            '01A-01-TS1.e8eb65de-d63e-42db-af6f-14fefbbdf7bd.svs'))
+        z = source.levels - 1
+        self.assertIsNotNone(source._jpegDirectories[z])
+        # Levels that are made from a higher resolution SVS level are read
+        # through OpenSlide
+        for level, svslevel in enumerate(source._svslevels):
+            if svslevel['scale'] != 1:
+                self.assertIsNone(source._jpegDirectories[level])
+        td, marker = source._jpegDirectories[z]
+        tile = source.getTile(2, 1, z)
+        self.assertEqual(tile[:2], b'\xff\xd8')
+        self.assertEqual(tile, td.getTile(2, 1)[:2] + marker + td.getTile(2, 1)[2:])
+        # The stored tile looks the same as the tile decoded by OpenSlide
+        image = numpy.asarray(PIL.Image.open(six.BytesIO(tile)).convert('RGB')).astype(int)
+        expected = numpy.asarray(source._openslide.read_region(
+            (2 * source.tileWidth, source.tileHeight), source._svslevels[z]['svslevel'],
+            (source.tileWidth, source.tileHeight)).convert('RGB')).astype(int)
+        self.assertLess(numpy.abs(image - expected).mean(), 1)
+        # Tiles in other encodings are decoded and encoded again
+        source = tilesource.AvailableTileSources['svsfile'](os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_svs_image.TCGA-DU-6399-'
+            '01A-01-TS1.e8eb65de-d63e-42db-af6f-14fefbbdf7bd.svs'), encoding='PNG')
+        self.assertEqual(source.getTile(2, 1, z)[:len(PNGHeader)], PNGHeader)
+
     def testGetTileSource(self):
         from large_image import getTileSource, tilesource
 
@@ -392,6 +392,44 @@ class LargeImageSourcesTest(common.LargeImageCommonTest):
                              21 if tile['level_y'] < 3 else 0)
         self.assertEqual(tileCount, 60)
 
+    def testTileIteratorPrefetch(self):
+        from girder.plugins.large_image import tilesource
+        from girder.plugins.large_image.models.image_item import ImageItem
+
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        item = Item().load(itemId, user=self.admin)
+        source = ImageItem().tileSource(item)
+
+        # Prefetched tiles should match lazily loaded tiles, including when
+        # resampling and retiling with overlap.
+        for params in (
+                {'scale': {'magnification': 2.5}},
+                {'scale': {'magnification': 2}, 'resample': True},
+                {'scale': {'magnification': 2.5},
+                 'tile_size': {'width': 300, 'height': 275},
+                 'tile_overlap': {'x': 51, 'y': 41, 'edges': True}}):
+            tiles = list(source.tileIterator(
+                format=tilesource.TILE_FORMAT_NUMPY, **params))
+            prefetched = list(source.tileIterator(
+                format=tilesource.TILE_FORMAT_NUMPY, prefetch=4, workers=3,
+                **params))
+            self.assertEqual(len(tiles), len(prefetched))
+            for tile, prefetchedTile in zip(tiles, prefetched):
+                self.assertEqual(tile['tile_position'],
+                                 prefetchedTile['tile_position'])
+                self.assertEqual(tile['width'], prefetchedTile['width'])
+                self.assertEqual(tile['height'], prefetchedTile['height'])
+                self.assertTrue(numpy.array_equal(
+                    tile['tile'], prefetchedTile['tile']))
+        # Stopping early should not be a problem
+        tileIter = source.tileIterator(
+            scale={'magnification': 2.5}, prefetch=8)
+        tile = next(tileIter)
+        self.assertEqual(tile['tile_position']['position'], 0)
+        tileIter.close()
+
     def testTileIteratorSingleTile(self):
         from girder.plugins.large_image.models.image_item import ImageItem
 
@@ -481,6 +519,21 @@ class LargeImageSourcesTest(common.LargeImageCommonTest):
         self.assertEqual(imageFormat, tilesource.TILE_FORMAT_PIL)
         self.assertEqual(image.width, 1438)
         self.assertEqual(image.height, 1447)
+        # Regions have an alpha channel whether or not the encoding uses it
+        self.assertEqual(image.mode, 'RGBA')
+
+        # An unscaled region is assembled directly as a numpy array, and
+        # should match the PIL image of the same region.
+        region = {'left': 1000, 'top': 1500, 'width': 1301, 'height': 997}
+        image, imageFormat = source.getRegion(
+            region=region, format=tilesource.TILE_FORMAT_NUMPY)
+        self.assertEqual(imageFormat, tilesource.TILE_FORMAT_NUMPY)
+        self.assertEqual(image.shape, (997, 1301, 4))
+        self.assertEqual(image.dtype, numpy.uint8)
+        pilImage, imageFormat = source.getRegion(
+            region=region, format=tilesource.TILE_FORMAT_PIL)
+        self.assertEqual(imageFormat, tilesource.TILE_FORMAT_PIL)
+        self.assertTrue(numpy.array_equal(image, numpy.asarray(pilImage)))
 
     def testConvertRegionScale(self):
         from girder.plugins.large_image import tilesource
@@ -639,6 +692,43 @@ class LargeImageSourcesTest(common.LargeImageCommonTest):
         self.assertEqual(tile['iterator_range']['region_y_max'], 3)
         self.assertEqual(tile['iterator_range']['position'], 33)
 
+    def testGetTiles(self):
+        from girder.plugins.large_image import tilesource
+        from girder.plugins.large_image.models.image_item import ImageItem
+
+        file = self._uploadFile(os.path.join(
+            os.environ['LARGE_IMAGE_DATA'], 'sample_image.ptif'))
+        itemId = str(file['itemId'])
+        item = Item().load(itemId, user=self.admin)
+        source = ImageItem().tileSource(item)
+
+        # Tiles are returned in the requested order, including duplicates and
+        # tiles from sparse levels.
+        tileList = [(3, 1, 6), (0, 0, 0), (1, 1, 2), (3, 1, 6), (100, 20, 8),
+                    (0, 0, 4, None)]
+        tiles = source.getTiles(tileList)
+        self.assertEqual(len(tiles), len(tileList))
+        for tile, entry in zip(tiles, tileList):
+            self.assertEqual(tile[:len(common.JPEGHeader)], common.JPEGHeader)
+            self.assertEqual(tile, source.getTile(*entry[:3]))
+        # A second request is served from the cache
+        self.assertEqual(source.getTiles(tileList[::-1]), tiles[::-1])
+        # Parameters are passed to every tile
+        tiles = source.getTiles(tileList[:3], pilImageAllowed=True)
+        for tile in tiles:
+            self.assertTrue(isinstance(tile, PIL.Image.Image))
+        self.assertEqual(source.getTiles([]), [])
+        with six.assertRaisesRegex(self, tilesource.TileSourceException,
+                                   'does not exist'):
+            source.getTiles([(0, 0, 0), (0, 0, 20)])
+
+        source = tilesource.getTileSource(
+            'large_image://test', maxLevel=6, encoding='PNG')
+        tileList = [(x, y, z) for z in range(4) for y in range(2 ** z)
+                    for x in range(2 ** z)]
+        tiles = source.getTiles(tileList)
+        self.assertEqual(tiles, [source.getTile(*entry) for entry in tileList])
+
     def testGetPixel(self):
         from girder.plugins.large_image.models.image_item import ImageItem
 
@@ -436,11 +436,14 @@ class LargeImageTilesTest(common.LargeImageCommonTest):
         self.assertIsNone(result)
 
     def testTilesFromGreyscale(self):
+        # Stripped TIFF files are read as virtual tiles without being
+        # converted
         file = self._uploadFile(os.path.join(
             os.path.dirname(__file__), 'test_files', 'grey10kx5k.tif'))
         itemId = str(file['itemId'])
-        fileId = str(file['_id'])
-        tileMetadata = self._postTileViaHttp(itemId, fileId)
+        resp = self.request(path='/item/%s/tiles' % itemId, user=self.admin)
+        self.assertStatusOk(resp)
+        tileMetadata = resp.json
         self.assertEqual(tileMetadata['tileWidth'], 256)
         self.assertEqual(tileMetadata['tileHeight'], 256)
         self.assertEqual(tileMetadata['sizeX'], 10000)
@@ -664,7 +667,18 @@ class LargeImageTilesTest(common.LargeImageCommonTest):
         self.assertEqual(tileMetadata['sizeY'], 2016)
         self.assertEqual(tileMetadata['levels'], 3)
         self.assertEqual(len(tileMetadata['frames']), 3)
+        self.assertEqual(tileMetadata['frameCount'], 3)
+        self.assertIn('omeinfo', tileMetadata)
         self._testTilesZXY(itemId, tileMetadata)
+        # The frames can be listed in pages without the OME metadata
+        resp = self.request(path='/item/%s/tiles' % itemId, user=self.admin, params={
+            'framesOffset': 1, 'framesLimit': 1, 'omeinfo': 'false'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['frameCount'], 3)
+        self.assertEqual(resp.json['framesOffset'], 1)
+        self.assertEqual(len(resp.json['frames']), 1)
+        self.assertEqual(resp.json['frames'][0]['Frame'], 1)
+        self.assertNotIn('omeinfo', resp.json)
         # Test that we can get frames via either tiles/zxy or tiles/fzxy and
         # that the frames are different
         resp = self.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
@@ -18,26 +18,39 @@
 ###############################################################################
 
 import atexit
+import re
+import six
 
 try:
     from .. import loadmodelcache
 except ImportError:
     loadmodelcache = None
-from .cache import LruCacheMetaclass, strhash, methodcache, getTileCache
+from .cache import LruCacheMetaclass, strhash, methodcache, methodcacheKey, \
+    cacheGetMany, cacheSetMany, getTileCache, getDecodedTileCache, singleFlightInfo, \
+    updateCacheStats, getCacheStats, getMetadataIndexCache
 try:
     from .memcache import MemCache
 except ImportError:
     MemCache = None
-from .cachefactory import CacheFactory, pickAvailableCache, setConfig, getConfig
+from .diskcache import DiskCache
+from .tieredcache import TieredCache
+from .cachefactory import CacheFactory, pickAvailableCache, setConfig, getConfig, \
+    estimateSize, ItemLRUCache
 from cachetools import cached, Cache, LRUCache
 
 
+# cachesInfo values that are reported as gauges rather than counters by
+# cachesMetrics, since they can go down.
+MetricGauges = {'maxsize', 'used', 'items', 'bytes', 'inFlight'}
+
+
 @atexit.register
 def cachesClear(*args, **kwargs):
     """
-    Clear the tilesource caches and the load model cache.  Note that this does
-    not clear memcached (which could be done with tileCache._client.flush_all,
-    but that can affect programs other than this one).
+    Clear the tilesource caches, the decoded tile cache, and the load model
+    cache.  Note that this does not clear memcached (which could be done with
+    tileCache._client.flush_all, but that can affect programs other than this
+    one).
     """
     if loadmodelcache:
         loadmodelcache.invalidateLoadModelCache()
@@ -51,6 +64,11 @@ def cachesClear(*args, **kwargs):
                 tileCache.clear()
         except Exception:
             pass
+    elif isinstance(tileCache, TieredCache):
+        tileCache.clear()
+    decodedCache, decodedLock = getDecodedTileCache()
+    with decodedLock:
+        decodedCache.clear()
 
 
 def cachesInfo(*args, **kwargs):
@@ -58,7 +76,22 @@ def cachesInfo(*args, **kwargs):
     Report on each cache.
 
     :returns: a dictionary with the cache names as the keys and values that
-        include 'maxsize' and 'used', if known.
+        include 'maxsize' and 'used', if known.  The python tile cache also
+        reports 'units' (whether maxsize and used are counts of items or
+        bytes), 'items', and the estimated memory used in 'bytes'.  When
+        memcached has an in-process cache in front of it, that cache is
+        reported as the tileCache, along with the hits and misses of each
+        tier in 'l1' and 'l2'.  The disk cache reports its usage in bytes and
+        the number of values this process has evicted.  Caches used by
+        methodcache or LruCacheMetaclass also report their 'hits', 'misses',
+        'stores', 'evictions', the estimated bytes of stored values
+        ('storedBytes'), and the total seconds spent serving hits
+        ('hitSeconds') and computing misses ('missSeconds').  When memcached
+        is used, 'memcached' reports the hits, misses, stores, errors, and
+        read and write times seen by this process.
+        'singleFlight' reports how many methodcache computations are running,
+        and how many waits for another thread's computation got its value
+        ('saved'), got its exception ('errors'), or timed out ('timeouts').
     """
     info = {}
     if loadmodelcache:
@@ -80,17 +113,110 @@ def cachesInfo(*args, **kwargs):
     if isinstance(tileCache, LRUCache):
         try:
             with tileLock:
+                sizedByBytes = getattr(tileCache, 'getsizeof', None) is estimateSize
                 info['tileCache'] = {
                     'maxsize': tileCache.maxsize,
-                    'used': tileCache.currsize
+                    'used': tileCache.currsize,
+                    'items': len(tileCache),
+                    'bytes': tileCache.currsize if sizedByBytes else getattr(
+                        tileCache, 'bytes', None),
+                    'units': 'bytes' if sizedByBytes else 'items',
                 }
         except Exception:
             pass
-    # It would be nice to include memcached, but pylibmc's client.get_stats()
-    # doesn't seem to work.
+    elif isinstance(tileCache, TieredCache):
+        with tileCache._l1Lock:
+            info['tileCache'] = {
+                'maxsize': tileCache.l1.maxsize,
+                'used': tileCache.l1.currsize,
+                'items': len(tileCache.l1),
+                'bytes': tileCache.l1.currsize,
+                'units': 'bytes',
+                'l1': {'hits': tileCache.l1Hits, 'misses': tileCache.l1Misses},
+                'l2': {'hits': tileCache.l2Hits, 'misses': tileCache.l2Misses},
+            }
+    elif isinstance(tileCache, DiskCache):
+        try:
+            info['tileCache'] = {
+                'maxsize': tileCache.maxsize,
+                'used': tileCache.currsize,
+                'items': len(tileCache),
+                'bytes': tileCache.currsize,
+                'units': 'bytes',
+                'path': tileCache.path,
+                'evictions': tileCache.evictions,
+            }
+        except Exception:
+            pass
+    decodedCache, decodedLock = getDecodedTileCache()
+    with decodedLock:
+        info['decodedTileCache'] = {
+            'maxsize': decodedCache.maxsize,
+            'used': decodedCache.currsize,
+            'items': len(decodedCache),
+            'hits': decodedCache.hits,
+            'misses': decodedCache.misses,
+        }
+    for name, stats in six.iteritems(getCacheStats()):
+        info.setdefault(name, {}).update(stats)
+    memcache = tileCache.l2 if isinstance(tileCache, TieredCache) else tileCache
+    if MemCache and isinstance(memcache, MemCache):
+        # pylibmc's client.get_stats() doesn't seem to work, so report what
+        # this process has seen instead.
+        info['memcached'] = memcache.getStats()
+    info['singleFlight'] = singleFlightInfo()
     return info
 
 
-__all__ = ('CacheFactory', 'getTileCache', 'MemCache', 'strhash',
-           'LruCacheMetaclass', 'pickAvailableCache', 'cached', 'Cache',
-           'LRUCache', 'methodcache', 'setConfig', 'getConfig')
+def _metricName(key):
+    """
+    Convert a camelCase counter name to a Prometheus metric name.
+
+    :param key: the counter name.
+    :returns: the metric name.
+    """
+    return 'large_image_cache_' + re.sub('([A-Z])', r'_\1', key).lower()
+
+
+def cachesMetrics(info=None):
+    """
+    Report on each cache in the Prometheus text exposition format.  Each
+    numeric value from cachesInfo is a metric with the cache name as a label;
+    values in nested dictionaries, such as the tiers of the tile cache, are
+    prefixed with the name of the dictionary.
+
+    :param info: the results of cachesInfo.  If None, cachesInfo is called.
+    :returns: the metrics as a string.
+    """
+    if info is None:
+        info = cachesInfo()
+    metrics = {}
+    metricTypes = {}
+
+    def addValues(cacheName, values, prefix=''):
+        for key, value in six.iteritems(values):
+            if isinstance(value, dict):
+                addValues(cacheName, value, prefix + key + '_')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                metric = _metricName(prefix + key)
+                metrics.setdefault(metric, []).append((cacheName, value))
+                metricTypes[metric] = 'gauge' if key in MetricGauges else 'counter'
+
+    for cacheName, values in six.iteritems(info):
+        if isinstance(values, dict):
+            addValues(cacheName, values)
+    lines = []
+    for metric in sorted(metrics):
+        lines.append('# TYPE %s %s' % (metric, metricTypes[metric]))
+        for cacheName, value in sorted(metrics[metric]):
+            cacheName = cacheName.replace('\\', '\\\\').replace('"', '\\"')
+            lines.append('%s{cache="%s"} %s' % (metric, cacheName, repr(value)))
+    return '\n'.join(lines) + '\n'
+
+
+__all__ = ('CacheFactory', 'getTileCache', 'getDecodedTileCache', 'MemCache',
+           'TieredCache', 'DiskCache', 'strhash', 'LruCacheMetaclass',
+           'pickAvailableCache', 'cached', 'Cache', 'LRUCache', 'methodcache',
+           'methodcacheKey', 'cacheGetMany', 'cacheSetMany', 'setConfig',
+           'getConfig', 'estimateSize', 'ItemLRUCache', 'updateCacheStats',
+           'getCacheStats', 'cachesMetrics', 'getMetadataIndexCache')
@@ -17,22 +17,47 @@
 #  limitations under the License.
 ###############################################################################
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
 try:
     import resource
 except ImportError:
     resource = None
 import hashlib
 import six
+import sys
+import threading
+import time
 
 try:
     from girder import logger
 except ImportError:
     import logging as logger
-from .cachefactory import CacheFactory, pickAvailableCache
+from cachetools import LRUCache
+from .cachefactory import CacheFactory, pickAvailableCache, getConfig, estimateSize
 
 
 _tileCache = None
 _tileLock = None
+_decodedTileCache = None
+_decodedTileLock = None
+_metadataIndexCache = None
+_metadataIndexCacheChecked = False
+
+# Computations that methodcache is currently running, keyed by the cache,
+# function, and cache key, and counts of how waiting for them went.
+_inFlight = {}
+_inFlightLock = threading.Lock()
+singleFlightStats = {'saved': 0, 'errors': 0, 'timeouts': 0}
+
+# Counters for methodcache and LruCacheMetaclass caches, keyed by cache name.
+# Times are the total seconds spent serving hits and computing misses.
+CacheStatKeys = ('hits', 'misses', 'stores', 'evictions', 'storedBytes',
+                 'hitSeconds', 'missSeconds')
+_cacheStats = {}
+_cacheStatsLock = threading.Lock()
 
 
 # If we have a resource module, ask to use as many file handles as the hard
@@ -44,10 +69,16 @@ if resource:
         SoftNoFile, HardNoFile = resource.getrlimit(resource.RLIMIT_NOFILE)
         resource.setrlimit(resource.RLIMIT_NOFILE, (HardNoFile, HardNoFile))
         SoftNoFile, HardNoFile = resource.getrlimit(resource.RLIMIT_NOFILE)
-        # Reserve some file handles for general use, and expect that tile
-        # sources could use many handles each.  This is conservative, since
-        # running out of file handles breaks the program in general.
-        MaximumTileSources = max(3, (SoftNoFile - 10) / 20)
+        # Reserve some file handles for general use.  TIFF tile sources use
+        # two handles for all of their directories (a libtiff handle and one
+        # for positional reads).  OpenSlide keeps a handle for each thread
+        # that reads a slide at once, which is up to one per cpu when regions
+        # are read in parallel, and SVS sources that serve stored JPEG tiles
+        # also use the two TIFF handles.  Allow enough for either kind of
+        # tile source, since running out of file handles breaks the program
+        # in general.
+        cpus = (psutil.cpu_count(logical=True) if psutil else None) or 1
+        MaximumTileSources = max(3, (SoftNoFile - 10) // max(4, cpus + 2))
     except Exception:
         pass
 
@@ -79,6 +110,187 @@ def strhash(*args, **kwargs):
     return '%r' % (args, )
 
 
+def methodcacheKey(self, args, kwargs, key=None):
+    """
+    Get the key that methodcache uses to store the result of a method call.
+
+    :param self: the instance the method is called on.
+    :param args: a tuple of the arguments passed to the method.
+    :param kwargs: a dictionary of the keyword arguments passed to the method.
+    :param key: if a function, use that for the key, otherwise use self.wrapKey.
+    :returns: the key used in the cache and the unhashed key.
+    """
+    k = key(*args, **kwargs) if key else self.wrapKey(*args, **kwargs)
+    if hasattr(self, '_classkey'):
+        k = self._classkey + ' ' + k
+    # hash the key to make sure it isn't particularly long.  We can't use
+    # Python's hash(), as it may not be the same between runs.
+    hashed_k = hashlib.sha256(k.encode('utf8')).hexdigest() if len(k) > 200 else k
+    return hashed_k, k
+
+
+def cacheGetMany(cache, lock, keys):
+    """
+    Get multiple values from a cache at once.  If the cache has a getMany
+    method, that is used; otherwise each key is looked up while holding the
+    lock once.
+
+    :param cache: the cache to query.
+    :param lock: a lock to use when accessing the cache or None.
+    :param keys: a list of keys.
+    :returns: a dictionary of the keys that were found and their values.
+    """
+    results = {}
+    if lock:
+        lock.acquire()
+    try:
+        if hasattr(cache, 'getMany'):
+            return cache.getMany(keys)
+        for k in keys:
+            try:
+                results[k] = cache[k]
+            except KeyError:
+                pass  # key not found
+            except ValueError:
+                # this can happen if a different version of python wrote the
+                # record
+                pass
+    finally:
+        if lock:
+            lock.release()
+    return results
+
+
+def cacheSetMany(cache, lock, items):
+    """
+    Store multiple values in a cache at once.  If the cache has a setMany
+    method, that is used; otherwise each value is stored while holding the
+    lock once.
+
+    :param cache: the cache to update.
+    :param lock: a lock to use when accessing the cache or None.
+    :param items: a dictionary of keys and values to store.
+    """
+    if lock:
+        lock.acquire()
+    try:
+        if hasattr(cache, 'setMany'):
+            cache.setMany(items)
+            return
+        for k, v in six.iteritems(items):
+            try:
+                cache[k] = v
+            except ValueError:
+                pass  # value too large
+            except KeyError:
+                # the key was refused for some reason
+                logger.debug('Had a cache KeyError while trying to store a '
+                             'value to key %r' % (k, ))
+    finally:
+        if lock:
+            lock.release()
+
+
+class _InFlightCall(object):
+    """
+    A computation that is being run for a methodcache key.  Other callers for
+    the same key wait for it rather than repeating the computation.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.excInfo = None
+
+
+def _waitForInFlightCall(call):
+    """
+    Wait for another thread's computation of a methodcache value.
+
+    :param call: the _InFlightCall to wait for.
+    :returns: True if the call finished, False if the wait timed out.
+    """
+    try:
+        timeout = float(getConfig('cache_singleflight_timeout') or 30)
+    except (TypeError, ValueError):
+        timeout = 30
+    finished = call.event.wait(timeout if timeout > 0 else None)
+    with _inFlightLock:
+        if not finished:
+            singleFlightStats['timeouts'] += 1
+        elif call.excInfo:
+            singleFlightStats['errors'] += 1
+        else:
+            singleFlightStats['saved'] += 1
+    return finished
+
+
+def updateCacheStats(name, **kwargs):
+    """
+    Add to the counters for a cache.
+
+    :param name: the name of the cache.
+    :param **kwargs: amounts to add to counters listed in CacheStatKeys or to
+        counters specific to the cache.
+    """
+    with _cacheStatsLock:
+        stats = _cacheStats.get(name)
+        if stats is None:
+            stats = _cacheStats[name] = dict.fromkeys(CacheStatKeys, 0)
+        for key, value in six.iteritems(kwargs):
+            stats[key] = stats.get(key, 0) + value
+
+
+def getCacheStats():
+    """
+    Get the counters for all caches that have been used by methodcache or
+    LruCacheMetaclass.
+
+    :returns: a dictionary with cache names as keys and dictionaries of
+        counters as values.
+    """
+    with _cacheStatsLock:
+        return {name: dict(stats) for name, stats in six.iteritems(_cacheStats)}
+
+
+def _storeInCache(cache, lock, key, value):
+    """
+    Store a value in a cache, returning the number of values evicted to make
+    room for it.  Evictions are only counted for LRUCache caches.
+
+    :param cache: the cache.
+    :param lock: a lock to use when accessing the cache or None.
+    :param key: the key to store.
+    :param value: the value to store.
+    :returns: the number of evicted values.
+    """
+    if lock:
+        lock.acquire()
+    try:
+        if isinstance(cache, LRUCache):
+            before = len(cache) + (0 if key in cache else 1)
+            cache[key] = value
+            return max(0, before - len(cache))
+        cache[key] = value
+        return 0
+    finally:
+        if lock:
+            lock.release()
+
+
+def singleFlightInfo():
+    """
+    Report on methodcache computations that other threads waited for.
+
+    :returns: a dictionary with the number of computations in progress
+        ('inFlight') and the number of waits that got the other thread's value
+        ('saved'), got its exception ('errors'), or timed out ('timeouts').
+    """
+    with _inFlightLock:
+        info = dict(singleFlightStats)
+        info['inFlight'] = len(_inFlight)
+    return info
+
+
 def methodcache(key=None):
     """
     Decorator to wrap a function with a memoizing callable that saves results
@@ -86,52 +298,109 @@ def methodcache(key=None):
     from self.cache rather than a passed value.  If self.cache_lock is
     present and not none, a lock is used.
 
+    If a value isn't in the cache and another thread is already computing it,
+    this waits for that thread and uses its result (or raises its exception)
+    rather than computing it again.  If the other thread takes longer than the
+    cache_singleflight_timeout config value (30 seconds by default), this
+    computes the value itself.
+
     :param key: if a function, use that for the key, otherwise use self.wrapKey.
     """
     def decorator(func):
         @six.wraps(func)
         def wrapper(self, *args, **kwargs):
-            k = key(*args, **kwargs) if key else self.wrapKey(*args, **kwargs)
-            if hasattr(self, '_classkey'):
-                k = self._classkey + ' ' + k
-            # hash the key to make sure it isn't particularly long.  We can't
-            # use Python's hash(), as it may not be the same between runs.
-            hashed_k = hashlib.sha256(k.encode('utf8')).hexdigest() if len(k) > 200 else k
+            start = time.time()
+            hashed_k, k = methodcacheKey(self, args, kwargs, key)
             lock = getattr(self, 'cache_lock', None)
+            statsName = 'tileCache' if self.cache is _tileCache else 'methodcache'
             try:
                 if lock:
                     with self.cache_lock:
-                        return self.cache[hashed_k]
+                        v = self.cache[hashed_k]
                 else:
-                    return self.cache[hashed_k]
+                    v = self.cache[hashed_k]
+                updateCacheStats(statsName, hits=1, hitSeconds=time.time() - start)
+                return v
             except KeyError:
                 pass  # key not found
             except ValueError:
                 # this can happen if a different version of python wrote the record
                 pass
-            v = func(self, *args, **kwargs)
+            # Instances can have their own caches with keys that don't
+            # identify the instance, so the cache is part of the key.
+            flightKey = (id(self.cache), func, hashed_k)
+            with _inFlightLock:
+                call = _inFlight.get(flightKey)
+                leader = call is None
+                if leader:
+                    call = _inFlight[flightKey] = _InFlightCall()
+            if not leader and _waitForInFlightCall(call):
+                updateCacheStats(statsName, misses=1, missSeconds=time.time() - start)
+                if call.excInfo:
+                    six.reraise(*call.excInfo)
+                return call.value
             try:
-                if lock:
-                    with self.cache_lock:
-                        self.cache[hashed_k] = v
-                else:
-                    self.cache[hashed_k] = v
-            except ValueError:
-                pass  # value too large
-            except KeyError:
-                # the key was refused for some reason
-                logger.debug('Had a cache KeyError while trying to store a '
-                             'value to key %r (%r)' % (hashed_k, k))
+                v = func(self, *args, **kwargs)
+                updateCacheStats(statsName, misses=1, missSeconds=time.time() - start)
+                try:
+                    evicted = _storeInCache(self.cache, lock, hashed_k, v)
+                    updateCacheStats(statsName, stores=1, evictions=evicted,
+                                     storedBytes=estimateSize(v))
+                except ValueError:
+                    pass  # value too large
+                except KeyError:
+                    # the key was refused for some reason
+                    logger.debug('Had a cache KeyError while trying to store a '
+                                 'value to key %r (%r)' % (hashed_k, k))
+                if leader:
+                    call.value = v
+            except BaseException:
+                if leader:
+                    call.excInfo = sys.exc_info()
+                raise
+            finally:
+                # Waiting callers are released after the value is in the
+                # cache, so later callers find it there.
+                if leader:
+                    with _inFlightLock:
+                        del _inFlight[flightKey]
+                    call.event.set()
             return v
         return wrapper
     return decorator
 
 
+class DecodedTileCache(LRUCache):
+    """
+    An LRU cache of decoded tiles that is limited by the number of bytes of
+    the stored values rather than the number of values.  Values must have an
+    nbytes attribute, such as numpy arrays.  The number of hits and misses are
+    recorded.
+    """
+    def __init__(self, maxsize):
+        super(DecodedTileCache, self).__init__(maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, key):
+        try:
+            value = super(DecodedTileCache, self).__getitem__(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def getsizeof(self, value):
+        return value.nbytes
+
+
 class LruCacheMetaclass(type):
     """
     """
     namedCaches = {}
     classCaches = {}
+    classCacheNames = {}
 
     def __new__(metacls, name, bases, namespace, **kwargs):  # noqa - N804
         # Get metaclass parameters by finding and removing them from the class
@@ -171,6 +440,8 @@ class LruCacheMetaclass(type):
         # cls is hashable though, so use it to lookup the cache, in case an
         # identically-named class gets redefined
         LruCacheMetaclass.classCaches[cls] = (cache, cacheLock)
+        LruCacheMetaclass.classCacheNames[cls] = (
+            cacheName if isinstance(cacheName, six.string_types) else name)
 
         return cls
 
@@ -183,12 +454,17 @@ class LruCacheMetaclass(type):
         else:
             key = strhash(args[0], kwargs)
         key = cls.__name__ + ' ' + key
+        statsName = LruCacheMetaclass.classCacheNames[cls]
+        start = time.time()
         with cacheLock:
             try:
                 instance = cache[key]
+                updateCacheStats(statsName, hits=1, hitSeconds=time.time() - start)
             except KeyError:
                 instance = super(LruCacheMetaclass, cls).__call__(*args, **kwargs)
-                cache[key] = instance
+                updateCacheStats(statsName, misses=1, missSeconds=time.time() - start)
+                evicted = _storeInCache(cache, None, key, instance)
+                updateCacheStats(statsName, stores=1, evictions=evicted)
                 instance._classkey = key
 
         return instance
@@ -206,3 +482,34 @@ def getTileCache():
         # Decide whether to use Memcached or cachetools
         _tileCache, _tileLock = CacheFactory().getCache()
     return _tileCache, _tileLock
+
+
+def getDecodedTileCache():
+    """
+    Get the cache and lock used for decoded tiles.  This is always an
+    in-process cache, regardless of the backend used for the tile cache.
+
+    :returns: decodedTileCache and decodedTileLock.
+    """
+    global _decodedTileCache, _decodedTileLock
+
+    if _decodedTileCache is None:
+        _decodedTileCache = DecodedTileCache(
+            CacheFactory().getDecodedCacheSize())
+        _decodedTileLock = threading.Lock()
+    return _decodedTileCache, _decodedTileLock
+
+
+def getMetadataIndexCache():
+    """
+    Get the persistent cache used for the metadata indices of image files
+    (see CacheFactory.getMetadataIndexCache).  This handles its own locking.
+
+    :returns: the cache or None if metadata indices are not used.
+    """
+    global _metadataIndexCache, _metadataIndexCacheChecked
+
+    if not _metadataIndexCacheChecked:
+        _metadataIndexCache = CacheFactory().getMetadataIndexCache()
+        _metadataIndexCacheChecked = True
+    return _metadataIndexCache
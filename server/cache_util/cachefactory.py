@@ -18,8 +18,12 @@
 #############################################################################
 
 
-import threading
 import math
+import os
+import six
+import sys
+import tempfile
+import threading
 # attempt to import girder config
 try:
     from girder import logprint, logger
@@ -34,6 +38,8 @@ try:
 except ImportError:
     MemCache = None
 from cachetools import LRUCache
+from .diskcache import DiskCache
+from .tieredcache import TieredCache
 
 try:
     import psutil
@@ -97,6 +103,64 @@ def pickAvailableCache(sizeEach, portion=8, maxItems=None):
     return numItems
 
 
+def estimateSize(value):
+    """
+    Estimate the number of bytes of memory used by a cached value.  Bytes,
+    numpy arrays, and PIL images are measured by their data; tuples, lists,
+    and dictionaries are the sum of their contents.
+
+    :param value: the value to measure.
+    :returns: the estimated size in bytes.
+    """
+    if isinstance(value, (six.binary_type, six.text_type)):
+        return len(value)
+    if hasattr(value, 'nbytes'):
+        # numpy arrays
+        return value.nbytes
+    if hasattr(value, 'getbands') and hasattr(value, 'size'):
+        # PIL images store multi-band images with 4 bytes per pixel
+        if len(value.getbands()) > 1 or value.mode in ('I', 'F'):
+            pixelSize = 4
+        elif value.mode.startswith('I;16'):
+            pixelSize = 2
+        else:
+            pixelSize = 1
+        return value.size[0] * value.size[1] * pixelSize
+    if isinstance(value, (tuple, list)):
+        return sum(estimateSize(entry) for entry in value)
+    if isinstance(value, dict):
+        return sum(estimateSize(entry) for entry in six.itervalues(value))
+    return sys.getsizeof(value)
+
+
+class ItemLRUCache(LRUCache):
+    """
+    An LRU cache that is limited by the number of items it holds and keeps a
+    running total of the estimated bytes of its values, so the memory used
+    can be reported without reading every value (which would also change
+    the order in which values are evicted).
+    """
+    def __init__(self, maxsize):
+        super(ItemLRUCache, self).__init__(maxsize)
+        self.bytes = 0
+        self._bytesByKey = {}
+
+    def __setitem__(self, key, value):
+        super(ItemLRUCache, self).__setitem__(key, value)
+        size = estimateSize(value)
+        self.bytes += size - self._bytesByKey.get(key, 0)
+        self._bytesByKey[key] = size
+
+    def __delitem__(self, key):
+        super(ItemLRUCache, self).__delitem__(key)
+        self.bytes -= self._bytesByKey.pop(key, 0)
+
+    def clear(self):
+        super(ItemLRUCache, self).clear()
+        self.bytes = 0
+        self._bytesByKey.clear()
+
+
 class CacheFactory(object):
     logged = False
 
@@ -112,6 +176,111 @@ class CacheFactory(object):
             numItems = pickAvailableCache(256**2 * 4 * 2, portion)
         return numItems
 
+    def getCacheBytes(self):
+        """
+        Get the number of bytes the python tile cache may use, as set by the
+        cache_python_memory_bytes config value.
+
+        :returns: the maximum size in bytes, or None to limit the cache by the
+            number of items instead.
+        """
+        try:
+            maxBytes = int(getConfig('cache_python_memory_bytes', 0) or 0)
+        except ValueError:
+            maxBytes = 0
+        return maxBytes if maxBytes > 0 else None
+
+    def getDiskCachePath(self):
+        """
+        Get the directory used by the disk cache, as set by the
+        cache_disk_path config value.
+
+        :returns: the directory path.
+        """
+        return getConfig('cache_disk_path') or os.path.join(
+            tempfile.gettempdir(), 'large_image_cache')
+
+    def getDiskCacheBytes(self):
+        """
+        Get the number of bytes the disk cache may use, as set by the
+        cache_disk_bytes config value.
+
+        :returns: the maximum size in bytes.
+        """
+        try:
+            maxBytes = int(getConfig('cache_disk_bytes', 0) or 0)
+        except ValueError:
+            maxBytes = 0
+        return maxBytes if maxBytes > 0 else 4 * 1024 ** 3
+
+    def getMetadataIndexCache(self):
+        """
+        Get the persistent cache used to store the parsed structure of image
+        files so that they can be reopened quickly.  This is only used if the
+        cache_metadata_index_path config value is set to a directory.  Its
+        size is set by the cache_metadata_index_bytes config value.
+
+        :returns: a DiskCache or None if there is no metadata index.
+        """
+        path = getConfig('cache_metadata_index_path')
+        if not path:
+            return None
+        try:
+            maxBytes = int(getConfig('cache_metadata_index_bytes', 0) or 0)
+        except ValueError:
+            maxBytes = 0
+        try:
+            return DiskCache(
+                path, maxBytes if maxBytes > 0 else 256 * 1024 ** 2, shards=1)
+        except Exception:
+            logger.exception('Cannot use the metadata index.')
+            return None
+
+    def getMemcachedPoolSize(self):
+        """
+        Get the number of memcached clients to use, as set by the
+        cache_memcached_pool_size config value.  This limits the number of
+        concurrent memcached requests.
+
+        :returns: the number of clients.
+        """
+        try:
+            poolSize = int(getConfig('cache_memcached_pool_size', 0) or 0)
+        except ValueError:
+            poolSize = 0
+        return poolSize if poolSize > 0 else 10
+
+    def getMemcachedL1Bytes(self):
+        """
+        Get the number of bytes of the in-process cache used in front of
+        memcached, as set by the cache_memcached_l1_bytes config value.
+
+        :returns: the maximum size in bytes, or None to not use an in-process
+            cache with memcached.
+        """
+        try:
+            maxBytes = int(getConfig('cache_memcached_l1_bytes', 0) or 0)
+        except ValueError:
+            maxBytes = 0
+        return maxBytes if maxBytes > 0 else None
+
+    def getDecodedCacheSize(self):
+        """
+        Get the number of bytes that can be used to cache decoded tiles.  This
+        is a portion of the total memory, which can be set with the
+        cache_decoded_memory_portion config value.
+
+        :returns: the maximum size in bytes.
+        """
+        defaultPortion = 16 if config else 32
+        try:
+            portion = int(getConfig('cache_decoded_memory_portion', defaultPortion))
+            if portion < 3:
+                portion = 3
+        except ValueError:
+            portion = defaultPortion
+        return pickAvailableCache(1, portion)
+
     def getCache(self, numItems=None):
         curConfig = getConfig()
         # memcached is the fallback default, if available.
@@ -120,8 +289,9 @@ class CacheFactory(object):
             cacheBackend = str(cacheBackend).lower()
         cache = None
         if cacheBackend == 'memcached' and MemCache and numItems is None:
-            # lock needed because pylibmc(memcached client) is not threadsafe
-            cacheLock = threading.Lock()
+            # MemCache uses a pool of clients and TieredCache locks its
+            # in-process cache, so no lock is needed around the cache.
+            cacheLock = None
 
             # check if credentials and location exist for girder otherwise
             # assume location is 127.0.0.1 (localhost) with no password
@@ -136,13 +306,33 @@ class CacheFactory(object):
                 memcachedPassword = None
             try:
                 cache = MemCache(url, memcachedUsername, memcachedPassword,
-                                 mustBeAvailable=True)
+                                 mustBeAvailable=True,
+                                 poolSize=self.getMemcachedPoolSize())
             except Exception:
                 logger.info('Cannot use memcached for caching.')
                 cache = None
+            l1Bytes = self.getMemcachedL1Bytes()
+            if cache is not None and l1Bytes:
+                cache = TieredCache(cache, l1Bytes, getsizeof=estimateSize)
+        if cacheBackend == 'disk' and numItems is None:
+            try:
+                cache = DiskCache(
+                    self.getDiskCachePath(), self.getDiskCacheBytes(),
+                    shards=curConfig.get('cache_disk_shards') or 8)
+                # The disk cache handles its own locking
+                cacheLock = None
+            except Exception:
+                logger.exception('Cannot use the disk for caching.')
+                cache = None
         if cache is None:  # fallback backend
             cacheBackend = 'python'
-            cache = LRUCache(self.getCacheSize(numItems))
+            maxBytes = self.getCacheBytes() if numItems is None else None
+            if maxBytes:
+                cache = LRUCache(maxBytes, getsizeof=estimateSize)
+            elif numItems is None:
+                cache = ItemLRUCache(self.getCacheSize(numItems))
+            else:
+                cache = LRUCache(self.getCacheSize(numItems))
             cacheLock = threading.Lock()
         if numItems is None and not CacheFactory.logged:
             logprint.info('Using %s for large_image caching' % cacheBackend)
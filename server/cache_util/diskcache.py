@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import cachetools
+import hashlib
+import os
+import six
+import sqlite3
+import threading
+import time
+from six.moves import cPickle as pickle
+
+try:
+    from girder import logprint
+except ImportError:
+    import logging as logprint
+
+
+class DiskCache(cachetools.Cache):
+    """
+    Use sharded SQLite databases on disk as the backing cache, so that cached
+    values persist when the process restarts and are shared by all processes
+    using the same directory.  Each shard has an equal part of the byte
+    budget and evicts its least recently used values when it is over budget.
+
+    SQLite's file locking makes this safe to use from multiple processes;
+    each thread in each process uses its own database connections.
+    """
+
+    # Access times are only updated when they are older than this many
+    # seconds, so that most cache hits don't need to write to the database.
+    accessResolution = 10
+    # When a shard is over budget, evict values until it is at this fraction
+    # of its budget, so that eviction isn't done on every store.
+    evictionTarget = 0.9
+
+    def __init__(self, path, maxBytes, shards=8, getsizeof=None):
+        """
+        Create a disk cache.
+
+        :param path: the directory for the cache files.  This is created if
+            it does not exist.
+        :param maxBytes: the maximum size of the cached values in bytes.
+        :param shards: the number of database files to use.  More shards
+            allow more concurrent writes.
+        :param getsizeof: unused; values are measured by their pickled size.
+        """
+        super(DiskCache, self).__init__(0, getsizeof=getsizeof)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Another process may have made the directory
+                if not os.path.isdir(path):
+                    raise
+        self.path = path
+        self.shards = max(1, int(shards))
+        self.shardMaxBytes = int(maxBytes) // self.shards
+        self._local = threading.local()
+        self._evictionsLock = threading.Lock()
+        # The number of values this process has evicted
+        self.evictions = 0
+        for shard in range(self.shards):
+            self._connection(shard)
+
+    def __repr__(self):
+        return 'DiskCache(%r, %d bytes)' % (self.path, self.maxsize)
+
+    @property
+    def maxsize(self):
+        return self.shardMaxBytes * self.shards
+
+    @property
+    def currsize(self):
+        return sum(self._query(shard, 'SELECT total FROM stats').fetchone()[0]
+                   for shard in range(self.shards))
+
+    def __len__(self):
+        return sum(self._query(shard, 'SELECT COUNT(*) FROM cache').fetchone()[0]
+                   for shard in range(self.shards))
+
+    def __iter__(self):
+        for shard in range(self.shards):
+            for row in self._query(shard, 'SELECT key FROM cache').fetchall():
+                yield row[0]
+
+    def __contains__(self, key):
+        return self._query(
+            self._shard(key), 'SELECT 1 FROM cache WHERE key = ?', (key, )
+        ).fetchone() is not None
+
+    def _connection(self, shard):
+        """
+        Get the database connection for a shard for the current thread and
+        process, opening it if needed.
+
+        :param shard: the shard number.
+        :returns: a sqlite3 connection.
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            # Connections must not be shared with a forked process.
+            self._local.pid = pid
+            self._local.connections = {}
+        conn = self._local.connections.get(shard)
+        if conn is None:
+            conn = sqlite3.connect(
+                os.path.join(self.path, 'cache_%d.sqlite' % shard),
+                timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                    'value BLOB, size INTEGER, accessed REAL)')
+                conn.execute(
+                    'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+                conn.execute('CREATE TABLE IF NOT EXISTS stats (total INTEGER)')
+                if conn.execute('SELECT total FROM stats').fetchone() is None:
+                    conn.execute('INSERT INTO stats (total) VALUES (0)')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            self._local.connections[shard] = conn
+        return conn
+
+    def _shard(self, key):
+        """
+        Get the shard used for a key.
+
+        :param key: the cache key.
+        :returns: the shard number.
+        """
+        return int(hashlib.sha1(key.encode('utf8')).hexdigest()[:8], 16) % self.shards
+
+    def _query(self, shard, sql, params=()):
+        return self._connection(shard).execute(sql, params)
+
+    def _store(self, conn, key, data):
+        """
+        Store a pickled value in a shard.  This must be called inside a write
+        transaction.
+
+        :param conn: the shard's connection.
+        :param key: the cache key.
+        :param data: the pickled value.
+        """
+        old = conn.execute('SELECT size FROM cache WHERE key = ?', (key, )).fetchone()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (key, value, size, accessed) '
+            'VALUES (?, ?, ?, ?)',
+            (key, sqlite3.Binary(data), len(data), time.time()))
+        conn.execute('UPDATE stats SET total = total + ?',
+                     (len(data) - (old[0] if old else 0), ))
+
+    def _evict(self, conn):
+        """
+        If a shard is over its byte budget, remove the least recently used
+        values.  This must be called inside a write transaction.
+
+        :param conn: the shard's connection.
+        """
+        total = conn.execute('SELECT total FROM stats').fetchone()[0]
+        if total <= self.shardMaxBytes:
+            return
+        target = int(self.shardMaxBytes * self.evictionTarget)
+        evicted = 0
+        while total > target:
+            rows = conn.execute(
+                'SELECT key, size FROM cache ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                conn.execute('DELETE FROM cache WHERE key = ?', (key, ))
+                total -= size
+                evicted += 1
+                if total <= target:
+                    break
+        conn.execute('UPDATE stats SET total = ?', (max(0, total), ))
+        with self._evictionsLock:
+            self.evictions += evicted
+
+    def _write(self, shard, items):
+        """
+        Store values in a shard in a single transaction.
+
+        :param shard: the shard number.
+        :param items: a list of (key, pickled value) tuples.
+        """
+        conn = self._connection(shard)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for key, data in items:
+                self._store(conn, key, data)
+            self._evict(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _read(self, shard, keys):
+        """
+        Read values from a shard.
+
+        :param shard: the shard number.
+        :param keys: a list of keys.
+        :returns: a dictionary of the keys that were found and their values.
+        """
+        conn = self._connection(shard)
+        results = {}
+        stale = []
+        now = time.time()
+        for key in keys:
+            row = conn.execute(
+                'SELECT value, accessed FROM cache WHERE key = ?', (key, )).fetchone()
+            if row is None:
+                continue
+            try:
+                results[key] = pickle.loads(bytes(row[0]))
+            except Exception:
+                # This can happen if a different version of python wrote the
+                # record; treat it as a miss.
+                continue
+            if row[1] < now - self.accessResolution:
+                stale.append(key)
+        if stale:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.executemany(
+                        'UPDATE cache SET accessed = ? WHERE key = ?',
+                        [(now, key) for key in stale])
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error:
+                # Failing to record the access only affects eviction order
+                pass
+        return results
+
+    def __getitem__(self, key):
+        try:
+            results = self._read(self._shard(key), [key])
+        except sqlite3.Error:
+            logprint.exception('Failed to read from the disk cache')
+            results = {}
+        if key not in results:
+            return self.__missing__(key)
+        return results[key]
+
+    def __setitem__(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.shardMaxBytes:
+            raise ValueError('value too large')
+        try:
+            self._write(self._shard(key), [(key, data)])
+        except sqlite3.Error:
+            logprint.exception('Failed to write to the disk cache')
+
+    def __delitem__(self, key):
+        shard = self._shard(key)
+        conn = self._connection(shard)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            old = conn.execute('SELECT size FROM cache WHERE key = ?', (key, )).fetchone()
+            if old is not None:
+                conn.execute('DELETE FROM cache WHERE key = ?', (key, ))
+                conn.execute('UPDATE stats SET total = total - ?', (old[0], ))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if old is None:
+            raise KeyError(key)
+
+    def clear(self):
+        """
+        Remove all values from the cache.  This affects all processes using
+        the cache directory.
+        """
+        for shard in range(self.shards):
+            conn = self._connection(shard)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM cache')
+                conn.execute('UPDATE stats SET total = 0')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _byShard(self, keys):
+        shards = {}
+        for key in keys:
+            shards.setdefault(self._shard(key), []).append(key)
+        return shards
+
+    def getMany(self, keys):
+        """
+        Get multiple values, reading each shard once.
+
+        :param keys: a list of keys.
+        :returns: a dictionary of the keys that were found and their values.
+        """
+        results = {}
+        for shard, shardKeys in six.iteritems(self._byShard(keys)):
+            try:
+                results.update(self._read(shard, shardKeys))
+            except sqlite3.Error:
+                logprint.exception('Failed to read from the disk cache')
+        return results
+
+    def setMany(self, items):
+        """
+        Store multiple values, writing each shard in one transaction.  Values
+        that are too large for the cache are skipped.
+
+        :param items: a dictionary of keys and values to store.
+        """
+        data = {}
+        for key, value in six.iteritems(items):
+            pickled = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(pickled) <= self.shardMaxBytes:
+                data[key] = pickled
+        for shard, shardKeys in six.iteritems(self._byShard(list(data))):
+            try:
+                self._write(shard, [(key, data[key]) for key in shardKeys])
+            except sqlite3.Error:
+                logprint.exception('Failed to write to the disk cache')
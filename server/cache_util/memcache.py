@@ -21,6 +21,7 @@ import cachetools
 import hashlib
 import pylibmc
 import six
+import threading
 import time
 
 try:
@@ -30,10 +31,27 @@ except ImportError:
 
 
 class MemCache(cachetools.Cache):
-    """Use memcached as the backing cache."""
+    """
+    Use memcached as the backing cache.  pylibmc clients are not thread-safe,
+    so each request reserves a client from a pool.  This allows concurrent
+    requests without a lock around the cache.
+    """
 
     def __init__(self, url='127.0.0.1', username=None, password=None,
-                 getsizeof=None, mustBeAvailable=False):
+                 getsizeof=None, mustBeAvailable=False, poolSize=10):
+        """
+        Create a memcached cache.
+
+        :param url: a memcached server url or a list of urls.
+        :param username: an optional username for the memcached servers.
+        :param password: an optional password for the memcached servers.
+        :param getsizeof: unused; memcached manages its own size.
+        :param mustBeAvailable: if True, raise an exception if the server
+            cannot be reached.
+        :param poolSize: the number of memcached clients to create.  This is
+            the maximum number of concurrent requests; further requests wait
+            for a client to be available.
+        """
         super(MemCache, self).__init__(0, getsizeof=getsizeof)
         if isinstance(url, six.string_types):
             url = [url]
@@ -58,8 +76,30 @@ class MemCache(cachetools.Cache):
             # Try to set a value; this will throw an error if the server is
             # unreachable, so we don't bother trying to user it.
             self._client['large_image_cache_test'] = time.time()
+        self._clientPool = pylibmc.ClientPool(self._client, max(1, int(poolSize)))
         self.lastError = {}
         self.throttleErrors = 10  # seconds between logging errors
+        self._statsLock = threading.Lock()
+        self._stats = {
+            'hits': 0, 'misses': 0, 'stores': 0, 'errors': 0,
+            'readSeconds': 0, 'writeSeconds': 0}
+
+    def _updateStats(self, **kwargs):
+        with self._statsLock:
+            for key, value in six.iteritems(kwargs):
+                self._stats[key] += value
+
+    def getStats(self):
+        """
+        Get counters of this process's memcached requests.
+
+        :returns: a dictionary with the number of values found ('hits') and
+            not found ('misses'), the number of values stored ('stores'), the
+            number of failed requests ('errors'), and the total time in
+            seconds spent reading and writing.
+        """
+        with self._statsLock:
+            return dict(self._stats)
 
     def __repr__(self):
         return 'Memcache doesn\'t list its keys'
@@ -77,7 +117,9 @@ class MemCache(cachetools.Cache):
         return None
 
     def __delitem__(self, key):
-        del self._client[key]
+        hexVal = hashlib.sha512(key.encode()).hexdigest()
+        with self._clientPool.reserve(block=True) as client:
+            del client[hexVal]
 
     def logError(self, err, func, msg):
         """
@@ -106,41 +148,121 @@ class MemCache(cachetools.Cache):
         hashObject = hashlib.sha512(key.encode())
         hexVal = hashObject.hexdigest()
 
+        start = time.time()
         try:
-            return self._client[hexVal]
+            with self._clientPool.reserve(block=True) as client:
+                value = client[hexVal]
+            self._updateStats(hits=1, readSeconds=time.time() - start)
+            return value
         except KeyError:
+            self._updateStats(misses=1, readSeconds=time.time() - start)
             return self.__missing__(key)
         except pylibmc.ServerDown:
+            self._updateStats(misses=1, errors=1, readSeconds=time.time() - start)
             self.logError(pylibmc.ServerDown, logprint.info,
                           'Memcached ServerDown')
             return self.__missing__(key)
         except pylibmc.Error:
+            self._updateStats(misses=1, errors=1, readSeconds=time.time() - start)
             self.logError(pylibmc.Error, logprint.exception,
                           'pylibmc exception')
             return self.__missing__(key)
 
+    def getMany(self, keys):
+        """
+        Get multiple values from memcached in a single request.
+
+        :param keys: a list of keys.
+        :returns: a dictionary of the keys that were found and their values.
+        """
+        hexKeys = {}
+        for key in keys:
+            assert (isinstance(key, str))
+            hexKeys[hashlib.sha512(key.encode()).hexdigest()] = key
+        start = time.time()
+        try:
+            with self._clientPool.reserve(block=True) as client:
+                values = client.get_multi(list(hexKeys))
+        except pylibmc.ServerDown:
+            self._updateStats(misses=len(hexKeys), errors=1,
+                              readSeconds=time.time() - start)
+            self.logError(pylibmc.ServerDown, logprint.info,
+                          'Memcached ServerDown')
+            return {}
+        except pylibmc.Error:
+            self._updateStats(misses=len(hexKeys), errors=1,
+                              readSeconds=time.time() - start)
+            self.logError(pylibmc.Error, logprint.exception,
+                          'pylibmc exception')
+            return {}
+        self._updateStats(hits=len(values), misses=len(hexKeys) - len(values),
+                          readSeconds=time.time() - start)
+        return {hexKeys[hexVal]: value for hexVal, value in six.iteritems(values)}
+
+    def setMany(self, items):
+        """
+        Store multiple values in memcached in a single request.
+
+        :param items: a dictionary of keys and values to store.
+        """
+        hexItems = {}
+        for key, value in six.iteritems(items):
+            assert (isinstance(key, str))
+            hexItems[hashlib.sha512(key.encode()).hexdigest()] = value
+        start = time.time()
+        try:
+            # This returns a list of keys that were not stored, such as values
+            # larger than memcached's item size limit, which are not counted.
+            with self._clientPool.reserve(block=True) as client:
+                failed = client.set_multi(hexItems)
+            self._updateStats(stores=len(hexItems) - len(failed or []),
+                              writeSeconds=time.time() - start)
+        except TypeError:
+            self._updateStats(errors=1, writeSeconds=time.time() - start)
+            self.logError(
+                TypeError, logprint.error,
+                'Failed to save %d values' % len(hexItems))
+        except pylibmc.ServerDown:
+            self._updateStats(errors=1, writeSeconds=time.time() - start)
+            self.logError(pylibmc.ServerDown, logprint.info,
+                          'Memcached ServerDown')
+        except pylibmc.Error as exc:
+            # memcached won't cache items larger than 1 Mb, but this returns a
+            # 'SUCCESS' error.  Raise other errors.
+            if 'SUCCESS' not in repr(exc.args):
+                self._updateStats(errors=1, writeSeconds=time.time() - start)
+                self.logError(pylibmc.Error, logprint.exception,
+                              'pylibmc exception')
+
     def __setitem__(self, key, value):
         assert (isinstance(key, str))
 
         hashObject = hashlib.sha512(key.encode())
         hexVal = hashObject.hexdigest()
 
+        start = time.time()
         try:
-            self._client[hexVal] = value
+            with self._clientPool.reserve(block=True) as client:
+                client[hexVal] = value
+            self._updateStats(stores=1, writeSeconds=time.time() - start)
         except TypeError:
+            self._updateStats(errors=1, writeSeconds=time.time() - start)
             self.logError(
                 TypeError, logprint.error,
                 'Failed to save value %r with key %s' % (value, hexVal))
         except KeyError:
+            self._updateStats(errors=1, writeSeconds=time.time() - start)
             self.logError(
                 KeyError, logprint.error,
                 'Failed to save value %s with key %s' % (value, hexVal))
         except pylibmc.ServerDown:
+            self._updateStats(errors=1, writeSeconds=time.time() - start)
             self.logError(pylibmc.ServerDown, logprint.info,
                           'Memcached ServerDown')
         except pylibmc.Error as exc:
             # memcached won't cache items larger than 1 Mb, but this returns a
             # 'SUCCESS' error.  Raise other errors.
             if 'SUCCESS' not in repr(exc.args):
+                self._updateStats(errors=1, writeSeconds=time.time() - start)
                 self.logError(pylibmc.Error, logprint.exception,
                               'pylibmc exception')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import cachetools
+import six
+import threading
+
+
+class TieredCache(cachetools.Cache):
+    """
+    An in-process LRU cache (L1) in front of a shared cache such as memcached
+    (L2).  Reads check L1 first and copy L2 hits into L1; writes go to both.
+    Hits and misses are counted separately for each tier.  The in-process
+    cache has its own lock, so the shared cache can be accessed concurrently
+    if it is thread-safe.
+    """
+
+    def __init__(self, l2, l1MaxSize, getsizeof=None):
+        """
+        Create a tiered cache.
+
+        :param l2: the backing cache.  This is usually a MemCache.
+        :param l1MaxSize: the maximum size of the in-process cache, measured
+            by getsizeof.
+        :param getsizeof: a function to compute the size of a value in the
+            in-process cache.  If None, each value has a size of 1.
+        """
+        super(TieredCache, self).__init__(0)
+        self.l1 = cachetools.LRUCache(l1MaxSize, getsizeof=getsizeof)
+        self.l2 = l2
+        self.l1Hits = 0
+        self.l1Misses = 0
+        self.l2Hits = 0
+        self.l2Misses = 0
+        self._l1Lock = threading.Lock()
+
+    def __repr__(self):
+        return 'TieredCache(%r, %r)' % (self.l1, self.l2)
+
+    def __iter__(self):
+        with self._l1Lock:
+            return iter(list(self.l1))
+
+    def __len__(self):
+        return len(self.l1)
+
+    def __contains__(self, key):
+        return key in self.l1
+
+    def __delitem__(self, key):
+        with self._l1Lock:
+            self.l1.pop(key, None)
+        del self.l2[key]
+
+    def _storeL1(self, key, value):
+        with self._l1Lock:
+            try:
+                self.l1[key] = value
+            except ValueError:
+                pass  # value too large for the in-process cache
+
+    def __getitem__(self, key):
+        with self._l1Lock:
+            try:
+                value = self.l1[key]
+                self.l1Hits += 1
+                return value
+            except KeyError:
+                self.l1Misses += 1
+        try:
+            value = self.l2[key]
+        except KeyError:
+            with self._l1Lock:
+                self.l2Misses += 1
+            return self.__missing__(key)
+        with self._l1Lock:
+            self.l2Hits += 1
+        self._storeL1(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._storeL1(key, value)
+        self.l2[key] = value
+
+    def clear(self):
+        """
+        Clear the in-process cache.  The shared cache is left alone, since it
+        may be used by other processes.
+        """
+        with self._l1Lock:
+            self.l1.clear()
+
+    def getMany(self, keys):
+        """
+        Get multiple values.  Keys that aren't in the in-process cache are
+        requested from the shared cache together if it supports getMany.
+
+        :param keys: a list of keys.
+        :returns: a dictionary of the keys that were found and their values.
+        """
+        results = {}
+        missing = []
+        with self._l1Lock:
+            for key in keys:
+                try:
+                    results[key] = self.l1[key]
+                except KeyError:
+                    missing.append(key)
+            self.l1Hits += len(results)
+            self.l1Misses += len(missing)
+        if not missing:
+            return results
+        if hasattr(self.l2, 'getMany'):
+            found = self.l2.getMany(missing)
+        else:
+            found = {}
+            for key in missing:
+                try:
+                    found[key] = self.l2[key]
+                except KeyError:
+                    pass
+        with self._l1Lock:
+            self.l2Hits += len(found)
+            self.l2Misses += len(missing) - len(found)
+        for key, value in six.iteritems(found):
+            self._storeL1(key, value)
+        results.update(found)
+        return results
+
+    def setMany(self, items):
+        """
+        Store multiple values in both tiers.
+
+        :param items: a dictionary of keys and values to store.
+        """
+        for key, value in six.iteritems(items):
+            self._storeL1(key, value)
+        if hasattr(self.l2, 'setMany'):
+            self.l2.setMany(items)
+        else:
+            for key, value in six.iteritems(items):
+                self.l2[key] = value
@@ -209,8 +209,11 @@ class ImageItem(Item):
         return tileSource
 
     def getMetadata(self, item, **kwargs):
+        # These select parts of the metadata rather than the tile source
+        options = {key: kwargs.pop(key) for key in (
+            'framesOffset', 'framesLimit', 'omeinfo') if key in kwargs}
         tileSource = self._loadTileSource(item, **kwargs)
-        return tileSource.getMetadata()
+        return tileSource.getMetadata(**options)
 
     def getTile(self, item, x, y, z, mayRedirect=False, **kwargs):
         tileSource = self._loadTileSource(item, **kwargs)
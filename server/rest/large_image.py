@@ -27,7 +27,7 @@ from six.moves import range
 from girder import logger
 from girder.api import access
 from girder.api.describe import describeRoute, Description
-from girder.api.rest import Resource
+from girder.api.rest import Resource, setRawResponse, setResponseHeader
 from girder.exceptions import RestException
 from girder.models.setting import Setting
 from girder.models.file import File
@@ -215,6 +215,7 @@ class LargeImageResource(Resource):
 
         self.resourceName = 'large_image'
         self.route('GET', ('cache', ), self.cacheInfo)
+        self.route('GET', ('cache', 'metrics'), self.cacheMetrics)
         self.route('PUT', ('cache', 'clear'), self.cacheClear)
         self.route('GET', ('settings',), self.getPublicSettings)
         self.route('GET', ('thumbnails',), self.countThumbnails)
@@ -242,6 +243,16 @@ class LargeImageResource(Resource):
     def cacheInfo(self, params):
         return cache_util.cachesInfo()
 
+    @describeRoute(
+        Description('Get cache counters in the Prometheus text format.')
+        .produces('text/plain')
+    )
+    @access.admin
+    def cacheMetrics(self, params):
+        setResponseHeader('Content-Type', 'text/plain; version=0.0.4')
+        setRawResponse()
+        return cache_util.cachesMetrics()
+
     @describeRoute(
         Description('Get public settings for large image display.')
     )
@@ -241,13 +241,27 @@ class TilesItemResource(ItemResource):
     @describeRoute(
         Description('Get large image metadata.')
         .param('itemId', 'The ID of the item.', paramType='path')
+        .param('framesOffset', 'For images with multiple frames, only list '
+               'frames starting with this frame number.  If this or '
+               'framesLimit is specified, frames are listed as compact '
+               'records of the Frame, IFD, TheC, TheZ, and TheT.',
+               required=False, dataType='int')
+        .param('framesLimit', 'For images with multiple frames, list at most '
+               'this many frames.  Use 0 to only get the frameCount.',
+               required=False, dataType='int')
+        .param('omeinfo', 'For OME Tiff images, false to omit the OME '
+               'metadata.', required=False, dataType='boolean', default=True)
         .errorResponse('ID was invalid.')
         .errorResponse('Read access was denied for the item.', 403)
     )
     @access.public
     @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
     def getTilesInfo(self, item, params):
-        # TODO: parse params?
+        params = self._parseParams(params, True, [
+            ('framesOffset', int),
+            ('framesLimit', int),
+            ('omeinfo', bool),
+        ])
         return self._getTilesInfo(item, params)
 
     @describeRoute(
@@ -17,11 +17,19 @@
 #  limitations under the License.
 #############################################################################
 
+import collections
+import concurrent.futures
 import math
 import os
+import psutil
+import threading
+import time
 from six import BytesIO
+from six.moves import zip
 
-from ..cache_util import getTileCache, strhash, methodcache
+from ..cache_util import getTileCache, getDecodedTileCache, strhash, \
+    methodcache, methodcacheKey, cacheGetMany, cacheSetMany, updateCacheStats, \
+    estimateSize
 from ..constants import SourcePriority
 
 try:
@@ -32,6 +40,7 @@ try:
     from girder.models.item import Item
     from ..models.base import TileGeneralException
     from girder.models.model_base import AccessType
+    from .byte_source import girderFileByteSource
 except ImportError:
     import logging as logger
     logger.getLogger().setLevel(logger.INFO)
@@ -79,6 +88,10 @@ TileOutputMimeTypes = {
 TileOutputPILFormat = {
     'JFIF': 'JPEG'
 }
+# Decoded tiles in these modes are kept in the decoded tile cache as numpy
+# arrays.  PIL.Image.fromarray recreates an image of the same mode.
+DecodedTileModes = {'L', 'LA', 'RGB', 'RGBA'}
+
 TileInputUnits = {
     None: 'base_pixels',
     'base': 'base_pixels',
@@ -175,6 +188,80 @@ def _letterboxImage(image, width, height, fill):
     return result
 
 
+def arrayToUint8(array):
+    """
+    Convert a numpy array of image samples to 8 bits per sample.  Integer
+    samples keep their most significant bits; negative values are treated as
+    zero.  Floating point samples are expected to be in the range [0-1].
+
+    :param array: a numpy array.
+    :returns: a uint8 numpy array.  If the array was already uint8, it is
+        returned unchanged.
+    """
+    if array.dtype == numpy.uint8:
+        return array
+    if array.dtype.kind == 'f':
+        return (numpy.clip(array, 0, 1) * 255).round().astype(numpy.uint8)
+    bits = array.dtype.itemsize * 8
+    if array.dtype.kind == 'i':
+        if bits == 8:
+            # There are only 7 bits of positive values, so shift them up
+            return numpy.clip(array, 0, None).astype(numpy.uint8) << 1
+        return (numpy.clip(array, 0, None) >> (bits - 9)).astype(numpy.uint8)
+    return (array >> (bits - 8)).astype(numpy.uint8)
+
+
+def _pasteTileIntoArray(array, tile, left, top):
+    """
+    Load a tile's image data and copy it into an RGBA numpy array.  This has
+    the same effect as pasting the tile into an RGBA PIL image.  Since each
+    tile covers a distinct part of the array, this may be called for
+    different tiles from multiple threads at once.
+
+    :param array: a height x width x 4 uint8 numpy array, or a height x width
+        x bands array of another data type that tiles are copied into without
+        conversion (see getRegion).
+    :param tile: a LazyTileDict.  Its 'tile' value must be a PIL image or a
+        numpy array.
+    :param left: the left coordinate of the array in level pixels.
+    :param top: the top coordinate of the array in level pixels.
+    """
+    tileData = tile['tile']
+    if not isinstance(tileData, numpy.ndarray):
+        if tileData.mode not in ('L', 'RGB', 'RGBA'):
+            tileData = tileData.convert('RGBA')
+        tileData = numpy.asarray(tileData)
+    elif array.dtype == numpy.uint8:
+        tileData = arrayToUint8(tileData)
+    x = int(tile['x'] - left)
+    y = int(tile['y'] - top)
+    # Crop the tile to the part that lies within the array
+    x0 = max(0, -x)
+    y0 = max(0, -y)
+    x1 = min(tileData.shape[1], array.shape[1] - x)
+    y1 = min(tileData.shape[0], array.shape[0] - y)
+    if x1 <= x0 or y1 <= y0:
+        return
+    tileData = tileData[y0:y1, x0:x1]
+    dest = array[y + y0:y + y1, x + x0:x + x1]
+    if array.dtype != numpy.uint8:
+        if len(tileData.shape) == 2:
+            tileData = tileData[:, :, numpy.newaxis]
+        dest[:, :, :] = tileData[:, :, :array.shape[2]]
+    elif len(tileData.shape) == 2:
+        dest[:, :, :3] = tileData[:, :, numpy.newaxis]
+        dest[:, :, 3] = 255
+    elif tileData.shape[2] == 4:
+        dest[:, :, :] = tileData
+    elif tileData.shape[2] == 2:
+        # Luminance and alpha
+        dest[:, :, :3] = tileData[:, :, :1]
+        dest[:, :, 3] = tileData[:, :, 1]
+    else:
+        dest[:, :, :3] = tileData[:, :, :3]
+        dest[:, :, 3] = 255
+
+
 def nearPowerOfTwo(val1, val2, tolerance=0.02):
     """
     Check if two values are different by nearly a power of two.
@@ -194,6 +281,65 @@ def nearPowerOfTwo(val1, val2, tolerance=0.02):
     return abs(log2ratio - round(log2ratio)) < tolerance
 
 
+def _prefetchTiles(tiles, prefetch, workers=None):
+    """
+    Given an iterator of LazyTileDict objects, load the image data of upcoming
+    tiles in a pool of threads, yielding the tiles in their original order.
+    Each tile is fully loaded before it is yielded.
+
+    :param tiles: an iterator of LazyTileDict objects.  Any setFormat calls
+        must have already been made on these tiles.
+    :param prefetch: the maximum number of tiles that are loaded ahead of the
+        tile being yielded.  This bounds the number of decoded tiles held by
+        the iterator.
+    :param workers: the number of threads to use.  If None or less than 1,
+        this is the smaller of prefetch and the number of cpus.
+    :yields: the loaded tiles.
+    """
+    prefetch = max(1, int(prefetch))
+    if not workers or int(workers) < 1:
+        workers = min(prefetch, psutil.cpu_count(logical=True) or 1)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=int(workers))
+    pending = collections.deque()
+    try:
+        for tile in tiles:
+            pending.append((tile, pool.submit(tile.__getitem__, 'tile')))
+            if len(pending) > prefetch:
+                tile, future = pending.popleft()
+                # This raises any exception that occurred while loading
+                future.result()
+                yield tile
+        while len(pending):
+            tile, future = pending.popleft()
+            future.result()
+            yield tile
+    finally:
+        # If the iteration was stopped early, discard tasks that haven't
+        # started yet.
+        for tile, future in pending:
+            future.cancel()
+        pool.shutdown(False)
+
+
+class _TileRowLoader(object):
+    """
+    Read a row of tiles into the tile cache with the source's _loadTileRow the
+    first time that the image data of any tile of the row is needed.
+    """
+    def __init__(self, source, xmin, xmax, y, level, frame=None):
+        self.source = source
+        self.args = (xmin, xmax, y, level, frame)
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        # Other threads loading tiles of the row wait for the row to be read
+        with self.lock:
+            if not self.loaded:
+                self.loaded = True
+                self.source._loadTileRow(*self.args)
+
+
 class LazyTileDict(dict):
     """
     Tiles returned from the tile iterator and dictioaries of information with
@@ -213,7 +359,8 @@ class LazyTileDict(dict):
         load the tile image.  ang and kwargs are as for the dict() class.
 
         :param tileInfo: a dictionary of x, y, level, format, encoding, crop,
-            and source, used for fetching the tile image.
+            and source, used for fetching the tile image.  If it has a
+            rowLoader, that is called before the tile image is fetched.
         """
         self.x = tileInfo['x']
         self.y = tileInfo['y']
@@ -227,6 +374,7 @@ class LazyTileDict(dict):
         self.requestedScale = tileInfo.get('requestedScale')
         self.metadata = tileInfo.get('metadata')
         self.retile = tileInfo.get('retile') and self.metadata
+        self.rowLoader = tileInfo.get('rowLoader')
 
         self.deferredKeys = ('tile', 'format')
         self.alwaysAllowPIL = True
@@ -302,11 +450,10 @@ class LazyTileDict(dict):
         ymax = int((self['y'] + self.height - 1) // self.metadata['tileHeight'] + 1)
         for x in range(xmin, xmax):
             for y in range(ymin, ymax):
-                tileData = self.source.getTile(
-                    x, y, self.level,
-                    pilImageAllowed=True, sparseFallback=True, frame=self.frame)
+                tileData = self.source._getDecodedTile(
+                    x, y, self.level, frame=self.frame)
                 if not isinstance(tileData, PIL.Image.Image):
-                    tileData = PIL.Image.open(BytesIO(tileData))
+                    tileData = PIL.Image.fromarray(tileData)
                 if retile is None:
                     retile = PIL.Image.new(
                         tileData.mode, (self.width, self.height))
@@ -328,27 +475,55 @@ class LazyTileDict(dict):
             # tile's own values.
             self.loaded = True
 
-            if not self.retile:
+            tileData = None
+            if (numpy and not self.retile and self.format and
+                    TILE_FORMAT_NUMPY in self.format and self.resample in (False, None) and
+                    self.source._getNativeTileFormat(self.level, self.frame) is not None):
+                # Use the source's own data type if it has one.
+                tileData = self.source._getNativeTile(
+                    self.x, self.y, self.level, frame=self.frame)
+            if tileData is not None:
+                if self.crop:
+                    tileData = tileData[self.crop[1]:self.crop[3], self.crop[0]:self.crop[2]]
+                self['tile'] = tileData
+                self['format'] = TILE_FORMAT_NUMPY
+                return super(LazyTileDict, self).__getitem__(key, *args, **kwargs)
+            if self.rowLoader:
+                self.rowLoader()
+            if self.retile:
+                tileData = self._retileTile()
+            elif self.format and TILE_FORMAT_IMAGE in self.format and not self.crop:
+                # The encoded tile may be usable as is, so don't decode it
+                # unless we have to.
                 tileData = self.source.getTile(
                     self.x, self.y, self.level,
                     pilImageAllowed=True, sparseFallback=True, frame=self.frame)
             else:
-                tileData = self._retileTile()
+                tileData = self.source._getDecodedTile(
+                    self.x, self.y, self.level, frame=self.frame)
             tileFormat = TILE_FORMAT_PIL
             # If the tile isn't in PIL format, and it is not in an image format
             # that is the same as a desired output format and encoding, convert
             # it to PIL format.
-            if not isinstance(tileData, PIL.Image.Image):
+            if numpy and isinstance(tileData, numpy.ndarray):
+                # Decoded tiles can be used directly if they don't need to be
+                # modified.
+                if (not self.alwaysAllowPIL and TILE_FORMAT_NUMPY in self.format and
+                        not self.crop and self.resample in (False, None)):
+                    tileFormat = TILE_FORMAT_NUMPY
+                else:
+                    tileData = PIL.Image.fromarray(tileData)
+            elif not isinstance(tileData, PIL.Image.Image):
                 pilData = PIL.Image.open(BytesIO(tileData))
-                if (self.format and TILE_FORMAT_IMAGE in self.format and
-                        pilData.format == self.encoding):
+                if pilData.format == self.encoding:
                     tileFormat = TILE_FORMAT_IMAGE
                 else:
-                    tileData = pilData
-            else:
-                pilData = tileData
+                    tileData = self.source._storeDecodedTile(
+                        pilData, self.x, self.y, self.level, frame=self.frame)
+                    if not isinstance(tileData, PIL.Image.Image):
+                        tileData = PIL.Image.fromarray(tileData)
             if self.crop and not self.retile:
-                tileData = pilData.crop(self.crop)
+                tileData = tileData.crop(self.crop)
                 tileFormat = TILE_FORMAT_PIL
 
             # resample if needed
@@ -393,6 +568,15 @@ class TileSource(object):
         None: SourcePriority.FALLBACK
     }
 
+    # If False, tiles are only ever loaded from one thread at a time, since
+    # the source's file access can't be shared between threads.
+    threadSafeTiles = True
+
+    # If True, the tile iterator reads each row of tiles with getTiles before
+    # the tiles are used, so sources that can read several tiles at once
+    # efficiently can do so.
+    batchTileRows = False
+
     def __init__(self, jpegQuality=95, jpegSubsampling=0,
                  encoding='JPEG', edge=False, tiffCompression='raw', *args,
                  **kwargs):
@@ -934,7 +1118,14 @@ class TileSource(object):
         retile = (tileSize['width'] != metadata['tileWidth'] or
                   tileSize['height'] != metadata['tileHeight'] or
                   tileOverlap['x'] or tileOverlap['y'])
+        # Rows of tiles are read together when the first tile of the row is
+        # used.  Tiles that are read as native arrays don't use the tile cache.
+        batchRows = (self.batchTileRows and iterInfo.get('batchTileRows', True) and
+                     not retile and xmax - xmin > 1 and
+                     self._getNativeTileFormat(level, iterInfo.get('frame')) is None)
         for y in range(ymin, ymax):
+            rowLoader = _TileRowLoader(
+                self, xmin, xmax, y, level, iterInfo.get('frame')) if batchRows else None
             for x in range(xmin, xmax):
                 crop = None
                 posX = int(x * tileSize['width'] - tileOverlap['x'] // 2 +
@@ -978,6 +1169,7 @@ class TileSource(object):
                     'retile': retile,
                     'metadata': metadata,
                     'source': self,
+                    'rowLoader': rowLoader,
                 }, {
                     'x': posX + left,
                     'y': posY + top,
@@ -1129,7 +1321,16 @@ class TileSource(object):
         """
         return False
 
-    def getMetadata(self):
+    def getMetadata(self, **kwargs):
+        """
+        Return a dictionary of metadata containing levels, sizeX, sizeY,
+        tileWidth, tileHeight, magnification, mm_x, and mm_y.
+
+        :param **kwargs: options for optional parts of the metadata, such as
+            the framesOffset, framesLimit, and omeinfo of OME Tiff sources.
+            Sources ignore options they don't use.
+        :returns: metadata dictionary.
+        """
         mag = self.getNativeMagnification()
         return {
             'levels': self.levels,
@@ -1146,6 +1347,232 @@ class TileSource(object):
     def getTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False, frame=None):
         raise NotImplementedError()
 
+    def getTiles(self, tiles, **kwargs):
+        """
+        Get multiple tiles at once.  The tile cache is queried for all of the
+        tiles together, and only the tiles that aren't in the cache are read
+        from the source.  These are read grouped by level and frame (see
+        _tileReadOrder).  This returns the same values that calling getTile
+        for each tile would, and uses the same cache entries.
+
+        :param tiles: a list of (x, y, z) or (x, y, z, frame) tuples.  A frame
+            of None is the same as not specifying a frame.
+        :param **kwargs: optional arguments passed to getTile for every tile,
+            such as pilImageAllowed or sparseFallback.
+        :returns: a list of tiles in the same order as requested.
+        """
+        requests = []
+        for entry in tiles:
+            tileKwargs = kwargs.copy()
+            if len(entry) > 3 and entry[3] is not None:
+                tileKwargs['frame'] = entry[3]
+            requests.append((tuple(entry[:3]), tileKwargs))
+        keys = [methodcacheKey(self, args, tileKwargs)[0]
+                for args, tileKwargs in requests]
+        start = time.time()
+        results = cacheGetMany(self.cache, self.cache_lock, list(set(keys)))
+        statsName = 'tileCache' if self.cache is getTileCache()[0] else 'methodcache'
+        updateCacheStats(statsName, hits=len(results), hitSeconds=time.time() - start)
+        missing = collections.OrderedDict()
+        for key, request in zip(keys, requests):
+            if key not in results and key not in missing:
+                missing[key] = request
+        if len(missing):
+            start = time.time()
+            loaded = dict(zip(missing, self._getTilesFromSource(
+                list(missing.values()))))
+            updateCacheStats(statsName, misses=len(loaded),
+                             missSeconds=time.time() - start)
+            cacheSetMany(self.cache, self.cache_lock, loaded)
+            updateCacheStats(statsName, stores=len(loaded),
+                             storedBytes=estimateSize(loaded))
+            results.update(loaded)
+        return [results[key] for key in keys]
+
+    def _loadTileRow(self, xmin, xmax, y, level, frame=None):
+        """
+        Read a row of tiles into the tile cache with getTiles, using the same
+        parameters that the tile iterator uses to get each tile.
+
+        :param xmin: the first column of the row.
+        :param xmax: one more than the last column of the row.
+        :param y: the row.
+        :param level: the tile level.
+        :param frame: the frame number or None.
+        """
+        try:
+            self.getTiles([(x, y, level) for x in range(xmin, xmax)],
+                          pilImageAllowed=True, sparseFallback=True, frame=frame)
+        except TileSourceException:
+            # Tiles that can't be read will raise the same exception when
+            # they are used.
+            pass
+
+    def _loadTiles(self, tiles):
+        """
+        Load the image data of tiles from _tileIterator in the current thread.
+        The tiles are all on the same row of the same level and frame, so
+        they are read together where possible.
+
+        :param tiles: a list of LazyTileDict objects.  Any setFormat calls
+            must have already been made on these tiles.
+        :returns: a list of the image data of the tiles.
+        """
+        # Tiles that are read as native arrays don't use the tile cache
+        if (self.batchTileRows and len(tiles) > 1 and not tiles[0].retile and
+                self._getNativeTileFormat(tiles[0].level, tiles[0].frame) is None):
+            self._loadTileRow(tiles[0].x, tiles[-1].x + 1, tiles[0].y,
+                              tiles[0].level, tiles[0].frame)
+        return [tile['tile'] for tile in tiles]
+
+    def _tileReadOrder(self, args, kwargs):
+        """
+        Get a value used to sort tile requests so that tiles that are stored
+        together are read together.  By default, this groups tiles by level
+        and frame, and then orders them by row and column.
+
+        :param args: a tuple of the x, y, z arguments to getTile.
+        :param kwargs: a dictionary of keyword arguments to getTile.
+        :returns: a sortable value.
+        """
+        x, y, z = args
+        return (z, str(kwargs.get('frame')), y, x)
+
+    def _getTilesFromSource(self, requests):
+        """
+        Read tiles that were not in the tile cache without checking or
+        updating the cache.  The tiles are read in the order specified by
+        _tileReadOrder.
+
+        :param requests: a list of ((x, y, z), kwargs) tuples, where kwargs
+            are passed to getTile.
+        :returns: a list of tiles in the same order as the requests.
+        """
+        # This is the undecorated getTile method, if there is one
+        getTile = getattr(self.getTile, '__wrapped__', None)
+        results = [None] * len(requests)
+        for idx in sorted(range(len(requests)),
+                          key=lambda idx: self._tileReadOrder(*requests[idx])):
+            args, tileKwargs = requests[idx]
+            if getTile:
+                results[idx] = getTile(self, *args, **tileKwargs)
+            else:
+                results[idx] = self.getTile(*args, **tileKwargs)
+        return results
+
+    def _getDecodedTile(self, x, y, z, frame=None):
+        """
+        Get a tile as decoded pixel data.  The decoded tile cache is checked
+        first; if the tile isn't there, it is fetched with getTile (allowing
+        PIL images and sparse fallback) and decoded.  Tiles that getTile
+        returns as PIL images are already decoded and are not added to the
+        decoded tile cache.
+
+        :param x: the 0-based x position of the tile on the level.
+        :param y: the 0-based y position of the tile on the level.
+        :param z: the tile level.
+        :param frame: the frame number or None.
+        :returns: a read-only numpy array or, if the tile's mode doesn't
+            round-trip through numpy, a PIL image.
+        """
+        key = methodcacheKey(self, (x, y, z), {'frame': frame})[0]
+        cache, lock = getDecodedTileCache()
+        try:
+            with lock:
+                return cache[key]
+        except KeyError:
+            pass
+        tileData = self.getTile(
+            x, y, z, pilImageAllowed=True, sparseFallback=True, frame=frame)
+        return self._storeDecodedTile(tileData, x, y, z, frame)
+
+    def _storeDecodedTile(self, tileData, x, y, z, frame=None):
+        """
+        Decode a tile and add it to the decoded tile cache.
+
+        :param tileData: the tile as returned by getTile: either encoded image
+            data or a PIL image.  PIL images are returned unchanged.
+        :param x: the 0-based x position of the tile on the level.
+        :param y: the 0-based y position of the tile on the level.
+        :param z: the tile level.
+        :param frame: the frame number or None.
+        :returns: a read-only numpy array or, if the tile's mode doesn't
+            round-trip through numpy, a PIL image.
+        """
+        if isinstance(tileData, PIL.Image.Image):
+            return tileData
+        tileData = PIL.Image.open(BytesIO(tileData))
+        if not numpy or tileData.mode not in DecodedTileModes:
+            return tileData
+        tileData = numpy.asarray(tileData)
+        tileData.flags.writeable = False
+        key = methodcacheKey(self, (x, y, z), {'frame': frame})[0]
+        cache, lock = getDecodedTileCache()
+        try:
+            with lock:
+                cache[key] = tileData
+        except ValueError:
+            pass  # value too large
+        return tileData
+
+    def _getNativeTile(self, x, y, z, frame=None):
+        """
+        Get a tile as a numpy array with the data type and number of samples
+        per pixel that the source stores, if the source can provide one (see
+        _readNativeTile).  These are kept in the decoded tile cache.
+
+        :param x: the 0-based x position of the tile on the level.
+        :param y: the 0-based y position of the tile on the level.
+        :param z: the tile level.
+        :param frame: the frame number or None.
+        :returns: a read-only numpy array or None if the tile isn't available
+            in this form.
+        """
+        key = methodcacheKey(self, (x, y, z), {'frame': frame, 'native': True})[0]
+        cache, lock = getDecodedTileCache()
+        try:
+            with lock:
+                return cache[key]
+        except KeyError:
+            pass
+        tileData = self._readNativeTile(x, y, z, frame)
+        if tileData is None:
+            return None
+        tileData.flags.writeable = False
+        try:
+            with lock:
+                cache[key] = tileData
+        except ValueError:
+            pass  # value too large
+        return tileData
+
+    def _readNativeTile(self, x, y, z, frame=None):
+        """
+        Read a tile as a numpy array with the data type and number of samples
+        per pixel that the source stores.  Sources whose data can be more than
+        8 bits per sample override this and _getNativeTileFormat.
+
+        :param x: the 0-based x position of the tile on the level.
+        :param y: the 0-based y position of the tile on the level.
+        :param z: the tile level.
+        :param frame: the frame number or None.
+        :returns: a numpy array with the same dimensions as the tile or None
+            if the tile isn't available in this form.
+        """
+        return None
+
+    def _getNativeTileFormat(self, z, frame=None):
+        """
+        Get the data type and number of samples per pixel of the arrays from
+        _readNativeTile for a level.
+
+        :param z: the tile level.
+        :param frame: the frame number or None.
+        :returns: a tuple of a numpy dtype and the number of samples per
+            pixel, or None if native tiles aren't available.
+        """
+        return None
+
     def getTileMimeType(self):
         return TileOutputMimeTypes.get(self.encoding, 'image/jpeg')
 
@@ -1329,45 +1756,90 @@ class TileSource(object):
         regionHeight = iterInfo['region']['height']
         top = iterInfo['region']['top']
         left = iterInfo['region']['left']
-        mode = iterInfo['mode']
-        outWidth = iterInfo['output']['width']
-        outHeight = iterInfo['output']['height']
-        # We can construct an image using PIL.Image.new:
-        #   image = PIL.Image.new('RGB', (regionWidth, regionHeight))
-        # but, for large images (larger than 4 Megapixels), PIL allocates one
-        # memory region per line.  Although it frees this, the memory manager
-        # often fails to reuse these smallish pieces.  By allocating the data
-        # memory ourselves in one block, the memory manager does a better job.
-        # Furthermode, if the source buffer isn't in RGBA format, the memory is
-        # still often inaccessible.
+        outWidth = int(math.floor(iterInfo['output']['width']))
+        outHeight = int(math.floor(iterInfo['output']['height']))
+        maxWidth = kwargs.get('output', {}).get('maxWidth')
+        maxHeight = kwargs.get('output', {}).get('maxHeight')
+        if not isinstance(format, tuple):
+            format = (format, )
+        numpyResult = (
+            outWidth == regionWidth and outHeight == regionHeight and
+            TILE_FORMAT_NUMPY in format and TILE_FORMAT_PIL not in format and
+            not (kwargs.get('fill') and maxWidth and maxHeight))
+        # If a numpy array is wanted and the source has data that isn't 8 bits
+        # per sample, return it in its own data type and number of samples.
+        nativeFormat = None
+        if numpyResult:
+            nativeFormat = self._getNativeTileFormat(iterInfo['level'], iterInfo.get('frame'))
+            if nativeFormat is not None and nativeFormat[0] == numpy.uint8:
+                nativeFormat = None
+        # Assemble the region in a single RGBA numpy array.  Allocating the
+        # memory in one block lets the memory manager reuse it (PIL allocates
+        # large images one line at a time), and the array can be returned
+        # directly or shared with PIL without copying.  Regions have always
+        # been RGBA regardless of iterInfo['mode'], since PIL makes an image
+        # with the mode of the raw buffer, and JPEG encoding drops the alpha
+        # channel.
         try:
-            image = PIL.Image.frombuffer(
-                mode, (regionWidth, regionHeight),
-                # PIL will reallocate buffers that aren't in 'raw', RGBA, 0, 1.
-                # See PIL documentation and code for more details.
-                b'\x00' * (regionWidth * regionHeight * 4), 'raw', 'RGBA', 0, 1)
+            if nativeFormat is not None:
+                regionData = numpy.zeros(
+                    (regionHeight, regionWidth, nativeFormat[1]), dtype=nativeFormat[0])
+            else:
+                regionData = numpy.zeros(
+                    (regionHeight, regionWidth, 4), dtype=numpy.uint8)
         except MemoryError:
             raise TileSourceException(
                 'Insufficient memory to get region of %d x %d pixels.' % (
                     regionWidth, regionHeight))
-        for tile in self._tileIterator(iterInfo):
-            # Add each tile to the image.  PIL crops these if they are off the
-            # edge.
-            image.paste(tile['tile'], (tile['x'] - left, tile['y'] - top))
+        self._fillRegionArray(regionData, iterInfo, left, top)
+        if nativeFormat is not None and nativeFormat[1] == 1:
+            regionData = regionData[:, :, 0]
+        if numpyResult:
+            return regionData, TILE_FORMAT_NUMPY
+        image = PIL.Image.frombuffer(
+            'RGBA', (regionWidth, regionHeight), regionData, 'raw', 'RGBA', 0, 1)
         # Scale if we need to
-        outWidth = int(math.floor(outWidth))
-        outHeight = int(math.floor(outHeight))
         if outWidth != regionWidth or outHeight != regionHeight:
             image = image.resize(
                 (outWidth, outHeight),
                 PIL.Image.BICUBIC if outWidth > regionWidth else
                 PIL.Image.LANCZOS)
-        maxWidth = kwargs.get('output', {}).get('maxWidth')
-        maxHeight = kwargs.get('output', {}).get('maxHeight')
         if kwargs.get('fill') and maxWidth and maxHeight:
             image = _letterboxImage(image, maxWidth, maxHeight, kwargs['fill'])
         return _encodeImage(image, format=format, **kwargs)
 
+    def _fillRegionArray(self, regionData, iterInfo, left, top):
+        """
+        Load the tiles of a region and copy them into a numpy array.  Tiles
+        are loaded and copied in a pool of threads if the source allows it.
+
+        :param regionData: a height x width x 4 uint8 numpy array or an array
+            of the source's native data type (see _pasteTileIntoArray).
+        :param iterInfo: tile iterator information.  See _tileIteratorInfo.
+        :param left: the left coordinate of the array in level pixels.
+        :param top: the top coordinate of the array in level pixels.
+        """
+        tileCount = (iterInfo['xmax'] - iterInfo['xmin']) * (
+            iterInfo['ymax'] - iterInfo['ymin'])
+        workers = min(tileCount, psutil.cpu_count(logical=True) or 1)
+        if workers <= 1 or not self.threadSafeTiles:
+            for tile in self._tileIterator(iterInfo):
+                _pasteTileIntoArray(regionData, tile, left, top)
+            return
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        tasks = []
+        try:
+            for tile in self._tileIterator(iterInfo):
+                tasks.append(pool.submit(
+                    _pasteTileIntoArray, regionData, tile, left, top))
+            for task in tasks:
+                # This raises any exception that occurred in a task
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            pool.shutdown(False)
+
     def getRegionAtAnotherScale(self, sourceRegion, sourceScale=None,
                                 targetScale=None, targetUnits=None, **kwargs):
         """
@@ -1493,7 +1965,7 @@ class TileSource(object):
         return level
 
     def tileIterator(self, format=(TILE_FORMAT_NUMPY, ), resample=True,
-                     **kwargs):
+                     prefetch=None, workers=None, **kwargs):
         """
         Iterate on all tiles in the specifed region at the specified scale.
         Each tile is returned as part of a dictionary that includes
@@ -1620,6 +2092,16 @@ class TileSource(object):
             JPEG.
         :param tiffCompression: the compression format when encoding a TIFF.
             This is usually 'raw', 'tiff_lzw', 'jpeg', or 'tiff_adobe_deflate'.
+        :param prefetch: if a positive integer, the image data of up to this
+            many upcoming tiles is loaded in a pool of threads while earlier
+            tiles are being processed.  Tiles are still yielded in the same
+            order, but each tile's image data is loaded before it is yielded.
+            This is also the maximum number of loaded tiles that the iterator
+            holds at one time.  If None or 0, tiles are loaded lazily when
+            their 'tile' or 'format' values are first accessed.  This is
+            ignored by sources that can't load tiles from several threads.
+        :param workers: if prefetch is used, the number of threads to use.  If
+            None, this is the smaller of prefetch and the number of cpus.
         :param **kwargs: optional arguments.
         :yields: an iterator that returns a dictionary as listed above.
         """
@@ -1640,10 +2122,120 @@ class TileSource(object):
         if (resample in (False, None) or
                 round(iterInfo['requestedScale'], 2) == 1.0):
             resample = False
-        for tile in self._tileIterator(iterInfo):
-            tile.setFormat(format, resample, kwargs)
+
+        def formattedTiles():
+            for tile in self._tileIterator(iterInfo):
+                tile.setFormat(format, resample, kwargs)
+                yield tile
+
+        tiles = formattedTiles()
+        if prefetch and self.threadSafeTiles:
+            tiles = _prefetchTiles(tiles, prefetch, workers)
+        for tile in tiles:
             yield tile
 
+    def tileStackIterator(self, frames=None, prefetch=4, workers=None, **kwargs):
+        """
+        Iterate on the tiles in the specified region at the specified scale,
+        yielding each tile position once with the tile's image data from
+        several frames stacked into a single numpy array.  This is the same as
+        calling tileIterator with format TILE_FORMAT_NUMPY for each frame and
+        stacking the matching tiles, except that the region is only computed
+        once and each frame's tiles in a row are read together in a pool of
+        threads.
+
+        Each tile is a dictionary with the same values as from tileIterator
+        (other than those added by resampling), plus
+            frames: the list of frames in the stack.
+        and tile is a numpy array of (frames, height, width) or (frames,
+        height, width, bands).  Tiles are not resampled.
+
+        :param frames: a list of frame numbers to stack.  If None, this is
+            every frame of the source.
+        :param prefetch: the maximum number of tile positions in a row that
+            are read together.  The next group of tile positions is loaded
+            while a group is being yielded.
+        :param workers: the number of threads to use.  If None, this is the
+            smaller of the number of frames and the number of cpus.
+        :param **kwargs: optional arguments as for tileIterator, except
+            format, resample, and frame.
+        :yields: an iterator that returns a dictionary as listed above.
+        """
+        if frames is None:
+            metadata = self.getMetadata(framesLimit=0, omeinfo=False)
+            frames = list(range(
+                metadata.get('frameCount') or len(metadata.get('frames') or [0])))
+        frames = list(frames)
+        kwargs.pop('frame', None)
+        iterInfo = self._tileIteratorInfo(
+            format=(TILE_FORMAT_NUMPY, ), resample=False, **kwargs)
+        if not iterInfo or not len(frames):
+            return
+        # Rows are read by _loadTiles, not when their first tile is used
+        iterInfo['batchTileRows'] = False
+
+        def positionGroups():
+            iterators = [
+                self._tileIterator(dict(iterInfo, frame=frame)) for frame in frames]
+            group = []
+            for frameTiles in zip(*iterators):
+                if len(group) and (len(group) >= prefetch or
+                                   frameTiles[0]['level_y'] != group[0][0]['level_y']):
+                    yield group
+                    group = []
+                for tile in frameTiles:
+                    tile.setFormat((TILE_FORMAT_NUMPY, ), False, kwargs)
+                group.append(frameTiles)
+            if len(group):
+                yield group
+
+        def submitGroup(group):
+            return group, [
+                pool.submit(self._loadTiles, [frameTiles[idx] for frameTiles in group])
+                for idx in range(len(frames))]
+
+        prefetch = max(1, int(prefetch or 1))
+        if not workers or int(workers) < 1:
+            workers = min(len(frames), psutil.cpu_count(logical=True) or 1)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=int(workers))
+        pending = collections.deque()
+        try:
+            for group in positionGroups():
+                pending.append(submitGroup(group))
+                if len(pending) > 1:
+                    for tile in self._stackTiles(frames, *pending.popleft()):
+                        yield tile
+            while len(pending):
+                for tile in self._stackTiles(frames, *pending.popleft()):
+                    yield tile
+        finally:
+            for group, futures in pending:
+                for future in futures:
+                    future.cancel()
+            pool.shutdown(False)
+
+    def _stackTiles(self, frames, group, futures):
+        """
+        Combine the tiles of several frames loaded by _loadTiles into stacked
+        tiles for tileStackIterator.
+
+        :param frames: the list of frames that were loaded.
+        :param group: a list with the tiles of every frame at each tile
+            position.
+        :param futures: a future with the image data of each frame's tiles.
+        :returns: a list of tile dictionaries.
+        """
+        # This raises any exception that occurred while loading
+        frameData = [future.result() for future in futures]
+        tiles = []
+        for idx, frameTiles in enumerate(group):
+            tile = dict(frameTiles[0])
+            tile['tile'] = numpy.stack([data[idx] for data in frameData])
+            tile['format'] = TILE_FORMAT_NUMPY
+            tile['frames'] = frames
+            tiles.append(tile)
+        return tiles
+
     def tileIteratorAtAnotherScale(self, sourceRegion, sourceScale=None,
                                    targetScale=None, targetUnits=None,
                                    **kwargs):
@@ -1778,7 +2370,7 @@ class FileTileSource(TileSource):
             kwargs.get('edge'))
 
     def getState(self):
-        return self._getLargeImagePath() + ',' + str(self.encoding) + ',' + \
+        return str(self._getLargeImagePath()) + ',' + str(self.encoding) + ',' + \
             str(self.jpegQuality) + ',' + str(self.jpegSubsampling) + ',' + \
             str(self.tiffCompression) + ',' + str(self.edge)
 
@@ -1806,6 +2398,9 @@ class FileTileSource(TileSource):
 if girder:  # noqa - the whole class is allowed to exceed complexity rules
     class GirderTileSource(FileTileSource):
         girderSource = True
+        # Sources that can read a ByteSource instead of a local path set this
+        # to True to read files in assetstores without local paths.
+        byteSourceAllowed = False
 
         def __init__(self, item, *args, **kwargs):
             """
@@ -1861,7 +2456,21 @@ if girder:  # noqa - the whole class is allowed to exceed complexity rules
                     except FilePathException:
                         pass
                 if not largeImagePath:
-                    largeImagePath = File().getLocalFilePath(largeImageFile)
+                    try:
+                        largeImagePath = File().getLocalFilePath(largeImageFile)
+                    except FilePathException as exc:
+                        if not self.byteSourceAllowed:
+                            raise TileSourceAssetstoreException(
+                                'The large image file is not on a local file system: %s' %
+                                exc.args[0])
+                        if getattr(self, '_largeImageByteSource', None) is None:
+                            try:
+                                self._largeImageByteSource = girderFileByteSource(
+                                    largeImageFile)
+                            except (IOError, OSError) as exc:
+                                raise TileSourceAssetstoreException(
+                                    'Cannot read the large image file: %s' % exc)
+                        largeImagePath = self._largeImageByteSource
                 return largeImagePath
             except (TileSourceAssetstoreException, FilePathException):
                 raise
@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import mmap
+import os
+import re
+import six
+import threading
+import time
+
+from six.moves import range
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
+
+from ..cache_util import LRUCache, getConfig, updateCacheStats
+
+try:
+    import girder
+    from girder.models.file import File
+except ImportError:
+    girder = None
+
+
+# The name used to report the block caches of byte sources in cachesInfo
+ByteSourceStatsName = 'byteSource'
+
+
+def isRemotePath(path):
+    """
+    Check if a path is a URL that is read with HTTP range requests.
+
+    :param path: a path, URL, or ByteSource.
+    :returns: True if the path is an http or https URL.
+    """
+    return isinstance(path, six.string_types) and bool(
+        re.match(r'^https?://', path, re.IGNORECASE))
+
+
+def openByteSource(source):
+    """
+    Get a byte source for a path or URL.  Local files are read with
+    positional reads or, if the tiff_byte_source config value is 'mmap',
+    through a memory map.  http and https URLs are read with range requests
+    through a block cache.
+
+    :param source: a local path, an http or https URL, or a ByteSource, which
+        is returned unchanged.
+    :returns: a ByteSource.
+    :raises: IOError or OSError if the source can't be opened.
+    """
+    if isinstance(source, ByteSource):
+        return source
+    if isRemotePath(source):
+        return BlockCachedByteSource(HttpByteSource(source))
+    if getConfig('tiff_byte_source') == 'mmap':
+        return MmapByteSource(source)
+    return FileByteSource(source)
+
+
+class ByteSource(object):
+    """
+    A readable sequence of bytes, such as a file.  Reads are positional, so a
+    byte source can be used by many threads at once.
+    """
+
+    # The path of the bytes on the local file system, if there is one.
+    # libtiff can only read local files.
+    path = None
+
+    def __init__(self, name):
+        """
+        :param name: a name for the source, used in messages and cache keys.
+        """
+        self.name = name
+        # The total size in bytes, if known.
+        self.size = None
+        # A string that changes if the contents of the source change, or None
+        # if this isn't known.
+        self.identity = None
+        self._statsLock = threading.Lock()
+        self._reads = 0
+        self._bytesServed = 0
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.name)
+
+    def __str__(self):
+        return str(self.name)
+
+    def read(self, offset, length):
+        """
+        Read bytes from the source.
+
+        :param offset: the position in the source to start reading.
+        :param length: the number of bytes to read.
+        :returns: the bytes read.  This is shorter than length if the end of
+            the source is reached.
+        """
+        data = self._read(offset, length) if length > 0 else b''
+        with self._statsLock:
+            self._reads += 1
+            self._bytesServed += len(data)
+        return data
+
+    def _read(self, offset, length):
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Release anything held open by the source.
+        """
+        pass
+
+    def getStats(self):
+        """
+        Report how much has been read.
+
+        :returns: a dictionary with the number of reads from the source
+            ('reads'), the bytes they returned ('bytesServed'), and the number
+            of requests to the underlying storage ('fetches') and the bytes
+            they returned ('bytesFetched').  Without a cache, every read is a
+            fetch.
+        """
+        with self._statsLock:
+            return {
+                'reads': self._reads,
+                'bytesServed': self._bytesServed,
+                'fetches': self._reads,
+                'bytesFetched': self._bytesServed,
+            }
+
+
+class FileByteSource(ByteSource):
+    """
+    A local file read with positional reads.
+    """
+
+    def __init__(self, path):
+        """
+        Open a local file.
+
+        :param path: the path of the file.
+        :raises: IOError or OSError if the file can't be opened.
+        """
+        super(FileByteSource, self).__init__(path)
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        stat = os.fstat(self._fd)
+        self.size = stat.st_size
+        self.identity = '%d %r' % (stat.st_size, stat.st_mtime)
+        # Without os.pread (Python 2 and Windows), reads seek and then read, so
+        # they must be serialized.
+        self._readLock = None if hasattr(os, 'pread') else threading.Lock()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Close the file descriptor.
+        """
+        fd, self._fd = getattr(self, '_fd', None), None
+        if fd is not None:
+            os.close(fd)
+
+    def _read(self, offset, length):
+        if self._readLock is None:
+            data = os.pread(self._fd, length, offset)
+            # pread may return fewer bytes than requested before the end of
+            # the file, so keep reading until we have everything.
+            while len(data) < length:
+                more = os.pread(self._fd, length - len(data), offset + len(data))
+                if not more:
+                    break
+                data += more
+            return data
+        with self._readLock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            data = b''
+            while len(data) < length:
+                more = os.read(self._fd, length - len(data))
+                if not more:
+                    break
+                data += more
+            return data
+
+
+class MmapByteSource(ByteSource):
+    """
+    A local file read through a memory map, so that reads are served from
+    the operating system's page cache without a system call.
+    """
+
+    def __init__(self, path):
+        """
+        Map a local file into memory.
+
+        :param path: the path of the file.
+        :raises: IOError or OSError if the file can't be opened, or ValueError
+            if it is empty.
+        """
+        super(MmapByteSource, self).__init__(path)
+        self.path = path
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            stat = os.fstat(fd)
+            self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            # The map keeps its own reference to the file.
+            os.close(fd)
+        self.size = stat.st_size
+        self.identity = '%d %r' % (stat.st_size, stat.st_mtime)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Unmap the file.
+        """
+        fileMap, self._map = getattr(self, '_map', None), None
+        if fileMap is not None:
+            fileMap.close()
+
+    def _read(self, offset, length):
+        return self._map[offset:offset + length]
+
+
+class HttpByteSource(ByteSource):
+    """
+    A file on a web server that supports HTTP range requests.
+    """
+
+    def __init__(self, url, headers=None, timeout=60):
+        """
+        Check that a URL can be read with range requests and get its size.
+
+        :param url: the http or https URL.
+        :param headers: a dictionary of additional headers sent with each
+            request, such as authorization.
+        :param timeout: the timeout of each request in seconds.
+        :raises: IOError if the URL can't be read or the server doesn't
+            support range requests.
+        """
+        super(HttpByteSource, self).__init__(url)
+        self.url = url
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        # Ask for the first byte; the response says how big the file is.
+        response = self._request(0, 1)
+        try:
+            contentRange = response.info().get('Content-Range') or ''
+            match = re.match(r'^bytes\s+\d+-\d+/(\d+)', contentRange.strip())
+            if not match:
+                raise IOError('Cannot determine the size of %s' % url)
+            self.size = int(match.group(1))
+            version = (response.info().get('ETag') or
+                       response.info().get('Last-Modified'))
+            if version:
+                self.identity = '%d %s' % (self.size, version)
+        finally:
+            response.close()
+
+    def _request(self, offset, length):
+        """
+        Make a range request.
+
+        :param offset: the first byte to request.
+        :param length: the number of bytes to request.
+        :returns: the response, whose status is 206 (Partial Content).
+        :raises: IOError if the request fails or the server ignores the range.
+        """
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%d-%d' % (offset, offset + length - 1)
+        response = urlopen(Request(self.url, headers=headers), timeout=self.timeout)
+        if response.getcode() != 206:
+            response.close()
+            raise IOError('%s does not support range requests' % self.url)
+        return response
+
+    def _read(self, offset, length):
+        if self.size is not None:
+            length = min(length, self.size - offset)
+            if length <= 0:
+                return b''
+        try:
+            response = self._request(offset, length)
+        except HTTPError as exc:
+            # Range Not Satisfiable: the offset is past the end of the file
+            if exc.code == 416:
+                return b''
+            raise IOError('Failed to read %s: %s' % (self.url, exc))
+        try:
+            return response.read(length)
+        finally:
+            response.close()
+
+
+class BlockCachedByteSource(ByteSource):
+    """
+    Read another byte source in fixed size blocks, keeping the most recently
+    used blocks in memory.  When reads are sequential, the blocks that follow
+    a missing block are fetched with it.  Reads that are too large to cache
+    are passed to the other source directly.  The size of the cache is set by
+    the cache_byte_source_bytes config value.
+    """
+
+    def __init__(self, source, blockSize=65536, readAheadBlocks=4, maxBytes=None):
+        """
+        :param source: the ByteSource to read.
+        :param blockSize: the size of each cached block in bytes.
+        :param readAheadBlocks: the number of extra blocks fetched after a
+            missing block when reads are sequential.
+        :param maxBytes: the size of the cache in bytes.  If None, this is
+            the cache_byte_source_bytes config value (16 MB by default).
+        """
+        super(BlockCachedByteSource, self).__init__(source.name)
+        self.source = source
+        self.path = source.path
+        self.size = source.size
+        self.identity = source.identity
+        self.blockSize = int(blockSize)
+        self.readAheadBlocks = int(readAheadBlocks)
+        if maxBytes is None:
+            try:
+                maxBytes = int(getConfig('cache_byte_source_bytes', 0) or 0)
+            except ValueError:
+                maxBytes = 0
+            maxBytes = maxBytes if maxBytes > 0 else 16 * 1024 ** 2
+        self.maxBytes = max(int(maxBytes), self.blockSize)
+        self._cache = LRUCache(self.maxBytes, getsizeof=len)
+        self._cacheLock = threading.Lock()
+        # The end of the previous read, used to detect sequential reads
+        self._lastEnd = None
+        self._hits = 0
+        self._misses = 0
+
+    def close(self):
+        """
+        Close the other source and discard the cached blocks.
+        """
+        self.source.close()
+        with self._cacheLock:
+            self._cache.clear()
+
+    def _read(self, offset, length):
+        if self.size is not None:
+            length = min(length, self.size - offset)
+            if length <= 0:
+                return b''
+        sequential = self._lastEnd is not None and (
+            self._lastEnd // self.blockSize <= offset // self.blockSize <=
+            self._lastEnd // self.blockSize + 1)
+        self._lastEnd = offset + length
+        if length > self.maxBytes // 4:
+            data = self._fetch(offset, length)
+            updateCacheStats(ByteSourceStatsName, bytesServed=len(data))
+            return data
+        first = offset // self.blockSize
+        last = (offset + length - 1) // self.blockSize
+        blocks = {}
+        with self._cacheLock:
+            for block in range(first, last + 1):
+                data = self._cache.get(block)
+                if data is not None:
+                    blocks[block] = data
+        hits = len(blocks)
+        misses = last + 1 - first - hits
+        block = first
+        while block <= last:
+            if block in blocks:
+                block += 1
+                continue
+            end = block
+            while end < last and end + 1 not in blocks:
+                end += 1
+            if sequential:
+                end = self._readAheadEnd(end)
+            self._fetchBlocks(block, end, blocks)
+            if block not in blocks:
+                # The source ended
+                break
+            block = end + 1
+        with self._statsLock:
+            self._hits += hits
+            self._misses += misses
+        data = []
+        for block in range(first, last + 1):
+            if block not in blocks:
+                break
+            data.append(blocks[block])
+        data = b''.join(data)
+        start = offset - first * self.blockSize
+        data = data[start:start + length]
+        updateCacheStats(ByteSourceStatsName, hits=hits, misses=misses, bytesServed=len(data))
+        return data
+
+    def _readAheadEnd(self, end):
+        """
+        Get the last block to fetch when reading ahead from a block.  This
+        stops before blocks that are already cached and at the end of the
+        source.
+
+        :param end: the last block that is needed.
+        :returns: the last block to fetch.
+        """
+        lastBlock = None
+        if self.size is not None:
+            lastBlock = max(0, (self.size - 1) // self.blockSize)
+        with self._cacheLock:
+            for _ in range(self.readAheadBlocks):
+                if (lastBlock is not None and end >= lastBlock) or end + 1 in self._cache:
+                    break
+                end += 1
+        return end
+
+    def _fetch(self, offset, length):
+        """
+        Read from the other source, recording the time it took.
+
+        :param offset: the position to start reading.
+        :param length: the number of bytes to read.
+        :returns: the bytes read.
+        """
+        startTime = time.time()
+        data = self.source.read(offset, length)
+        updateCacheStats(
+            ByteSourceStatsName, fetches=1, bytesFetched=len(data),
+            missSeconds=time.time() - startTime)
+        return data
+
+    def _fetchBlocks(self, first, last, blocks):
+        """
+        Fetch a run of blocks from the other source with a single read and
+        cache them.
+
+        :param first: the first block to fetch.
+        :param last: the last block to fetch.
+        :param blocks: a dictionary to add the fetched blocks to.
+        """
+        data = self._fetch(first * self.blockSize, (last + 1 - first) * self.blockSize)
+        stores = storedBytes = evictions = 0
+        with self._cacheLock:
+            for block in range(first, last + 1):
+                start = (block - first) * self.blockSize
+                blockData = data[start:start + self.blockSize]
+                if not blockData:
+                    break
+                blocks[block] = blockData
+                before = len(self._cache) + (0 if block in self._cache else 1)
+                self._cache[block] = blockData
+                evictions += max(0, before - len(self._cache))
+                stores += 1
+                storedBytes += len(blockData)
+        updateCacheStats(
+            ByteSourceStatsName, stores=stores, storedBytes=storedBytes,
+            evictions=evictions)
+
+    def getStats(self):
+        """
+        Report how much has been read.  See ByteSource.getStats.
+
+        :returns: a dictionary of statistics.  Fetches are the reads of the
+            other source.  This also includes the number of cached blocks that
+            were used ('hits') and that had to be fetched ('misses').
+        """
+        stats = super(BlockCachedByteSource, self).getStats()
+        sourceStats = self.source.getStats()
+        stats['fetches'] = sourceStats['reads']
+        stats['bytesFetched'] = sourceStats['bytesServed']
+        with self._statsLock:
+            stats['hits'] = self._hits
+            stats['misses'] = self._misses
+        return stats
+
+
+if girder:
+    class GirderFileByteSource(ByteSource):
+        """
+        A Girder file read through its assetstore, so that files that aren't
+        on a local file system can be read without downloading all of them.
+        """
+
+        def __init__(self, file):
+            """
+            :param file: the Girder file document.
+            """
+            super(GirderFileByteSource, self).__init__('girder_file://%s' % file['_id'])
+            self.file = file
+            self.size = file.get('size')
+            self.identity = '%s %s' % (self.size, file.get('sha512') or file.get('created'))
+
+        def _read(self, offset, length):
+            if self.size is not None:
+                length = min(length, self.size - offset)
+                if length <= 0:
+                    return b''
+            stream = File().download(
+                self.file, offset=offset, headers=False, endByte=offset + length)
+            return b''.join(stream())
+
+    def girderFileByteSource(file):
+        """
+        Get a cached byte source for a Girder file.  Files that are links to
+        URLs are read from the URL with range requests.
+
+        :param file: the Girder file document.
+        :returns: a ByteSource.
+        :raises: IOError if a linked URL can't be read.
+        """
+        if file.get('linkUrl'):
+            return openByteSource(file['linkUrl'])
+        return BlockCachedByteSource(GirderFileByteSource(file))
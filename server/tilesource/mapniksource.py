@@ -412,7 +412,7 @@ class MapnikTileSource(FileTileSource):
             self._bandInfo = infoSet
         return self._bandInfo
 
-    def getMetadata(self):
+    def getMetadata(self, **kwargs):
         metadata = {
             'geospatial': bool(self.dataset.GetProjection()),
             'levels': self.levels,
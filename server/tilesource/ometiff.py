@@ -17,16 +17,23 @@
 #  limitations under the License.
 ##############################################################################
 
+import concurrent.futures
+import json
 import math
+import numpy
+import psutil
 import six
-from six.moves import range
+import threading
+from six import BytesIO
+from six.moves import range, zip
+from xml.etree import cElementTree
 
 from .base import TileSourceException
-from ..cache_util import LruCacheMetaclass, methodcache
+from ..cache_util import LruCacheMetaclass, LRUCache, methodcache, strhash
 from ..constants import SourcePriority
 from .tiff import TiffFileTileSource
 from .tiff_reader import TiledTiffDirectory, InvalidOperationTiffException, \
-    TiffException, IOTiffException
+    TiffException, IOTiffException, SharedTiffFile, etreeToDict
 
 try:
     import girder
@@ -40,6 +47,7 @@ from .base import TILE_FORMAT_PIL
 
 try:
     import PIL.Image
+    import PIL.ImageColor
 except ImportError:
     PIL = None
 
@@ -69,6 +77,107 @@ _omeUnitsToMeters = {
     u'\u00c5': 1e-10,
 }
 
+# Colors of composited channels that don't specify a color and don't have one
+# in the OME metadata, used in order
+_compositeColors = [
+    '#FF0000', '#00FF00', '#0000FF', '#00FFFF', '#FF00FF', '#FFFF00', '#FFFFFF']
+
+# The channels of composited tiles are read in this pool of threads
+_compositePool = None
+_compositePoolLock = threading.Lock()
+
+
+def _getCompositePool():
+    """
+    Get the pool of threads used to read the channels of composited tiles,
+    creating it if needed.
+
+    :returns: a concurrent.futures.ThreadPoolExecutor.
+    """
+    global _compositePool
+
+    with _compositePoolLock:
+        if _compositePool is None:
+            _compositePool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=psutil.cpu_count(logical=True) or 1)
+        return _compositePool
+
+
+def _localTag(tag):
+    """
+    Remove the schema from an xml tag or attribute name.
+
+    :param tag: the tag.
+    :returns: the tag without its schema.
+    """
+    return tag.split('}', 1)[1] if tag.startswith('{') else tag
+
+
+def _parseOMEXml(xml):
+    """
+    Read the records of an OME xml document that are needed to find the
+    frames of each image.  The document is parsed incrementally and the
+    TiffData and Plane records are discarded once they have been read, so that
+    documents that list a great many planes don't have to be held as a tree.
+
+    :param xml: the OME xml document as utf8 bytes.
+    :returns: a list with a dictionary for each Image record.  These contain
+        Pixels, the attributes of the Pixels record; Channel, a list of the
+        attributes of its Channel records; files, the set of file names of its
+        TiffData records; frames, a numpy integer array with one row of
+        IFD, C, Z, and T for each TiffData record; and planeCount, the number
+        of Plane records, or of TiffData records if there are no Plane
+        records.  The planes of each row are those of the matching Plane
+        record, if there is one for each TiffData record, and otherwise those
+        of the TiffData record.
+    :raises: TileSourceException if an expected record is missing.
+    """
+    images = []
+    channels, files, tiffData, planes = [], set(), [], []
+    # Tags without their schema, since there are few distinct tags
+    localTags = {}
+    try:
+        for _, elem in cElementTree.iterparse(BytesIO(xml)):
+            tag = localTags.get(elem.tag)
+            if tag is None:
+                tag = localTags[elem.tag] = _localTag(elem.tag)
+            if tag == 'Plane':
+                planes.append((
+                    int(elem.get('TheC', 0)), int(elem.get('TheZ', 0)),
+                    int(elem.get('TheT', 0))))
+                elem.clear()
+            elif tag == 'TiffData':
+                for child in elem:
+                    if localTags.get(child.tag) == 'UUID':
+                        files.add(child.attrib['FileName'])
+                        break
+                else:
+                    raise KeyError('UUID')
+                tiffData.append((
+                    int(elem.attrib['IFD']), int(elem.get('FirstC', 0)),
+                    int(elem.get('FirstZ', 0)), int(elem.get('FirstT', 0))))
+                elem.clear()
+            elif tag == 'Channel':
+                channels.append({_localTag(k): v for k, v in six.iteritems(elem.attrib)})
+            elif tag == 'Pixels':
+                frames = numpy.array(tiffData, dtype=numpy.int64).reshape(-1, 4)
+                if planes and len(planes) == len(tiffData):
+                    frames[:, 1:] = planes
+                images.append({
+                    'Pixels': {_localTag(k): v for k, v in six.iteritems(elem.attrib)},
+                    'Channel': channels,
+                    'files': files,
+                    'frames': frames,
+                    'planeCount': len(planes) if planes else len(tiffData),
+                })
+                channels, files, tiffData, planes = [], set(), [], []
+                elem.clear()
+            elif tag in ('Image', 'StructuredAnnotations'):
+                elem.clear()
+    except (cElementTree.ParseError, KeyError, ValueError):
+        raise TileSourceException('OME Tiff does not contain an expected record')
+    return images
+
 
 @six.add_metaclass(LruCacheMetaclass)
 class OMETiffFileTileSource(TiffFileTileSource):
@@ -84,58 +193,90 @@ class OMETiffFileTileSource(TiffFileTileSource):
         'ome': SourcePriority.PREFERRED,
     }
 
-    def __init__(self, path, **kwargs):
+    def __init__(self, path, composite=None, **kwargs):
         """
         Initialize the tile class.  See the base class for other available
         parameters.
 
-        :param path: a filesystem path for the tile source.
+        :param path: a filesystem path for the tile source, an http or https
+            URL that can be read with range requests, or a ByteSource.
+        :param composite: None to get the tiles of single frames, or a JSON
+            string or dictionary that describes how several frames are
+            combined into RGB tiles.  This has a single key of 'channels',
+            which is a list of dictionaries, each of which can contain:
+                frame: the frame number of the channel.
+                channel: the OME channel number (TheC).  Either this or frame
+                    must be specified.  The Z and T planes of this channel are
+                    those of the frame that is requested.
+                color: a css color string or a list of red, green, and blue
+                    values from 0 to 255.  This defaults to the channel's
+                    color in the OME metadata, if any, and otherwise to red,
+                    green, blue, cyan, magenta, yellow, and white in order.
+                min: the channel value that is shown as black.  This
+                    defaults to 0 (or the smallest value of signed data
+                    types).
+                max: the channel value that is shown in the full color.  This
+                    defaults to the largest value of the channel's data type,
+                    or 1 for floating point data.
+                gamma: the channel value scaled from 0 to 1 between min and
+                    max is raised to the power of 1 / gamma.  This defaults to
+                    1.
+            The colored channels are added together.
         """
         super(TiffFileTileSource, self).__init__(path, **kwargs)
 
         largeImagePath = self._getLargeImagePath()
+        self._largeImagePath = largeImagePath
+        # All directories, including those of other frames, are read through
+        # one open file
+        self._sharedFile = SharedTiffFile(largeImagePath)
 
         try:
-            base = TiledTiffDirectory(largeImagePath, 0)
+            base = TiledTiffDirectory(largeImagePath, 0, sharedFile=self._sharedFile)
         except TiffException:
             raise TileSourceException('Not a tiled OME Tiff')
-        info = getattr(base, '_description_xml', None)
-        if not info.get('OME'):
+        omexml = getattr(base, '_omeXml', None)
+        if not omexml:
             raise TileSourceException('Not an OME Tiff')
-        self._omeinfo = info['OME']
-        if isinstance(self._omeinfo['Image'], dict):
-            self._omeinfo['Image'] = [self._omeinfo['Image']]
-        for img in self._omeinfo['Image']:
-            if isinstance(img['Pixels'].get('TiffData'), dict):
-                img['Pixels']['TiffData'] = [img['Pixels']['TiffData']]
-            if isinstance(img['Pixels'].get('Plane'), dict):
-                img['Pixels']['Plane'] = [img['Pixels']['Plane']]
+        self._omeXml = omexml
+        omeimages = _parseOMEXml(omexml)
         try:
-            self._omebase = self._omeinfo['Image'][0]['Pixels']
-            if len({entry['UUID']['FileName'] for entry in self._omebase['TiffData']}) > 1:
+            self._omebase = omeimages[0]['Pixels']
+            self._omebase['Channel'] = omeimages[0]['Channel']
+            frameCount = len(omeimages[0]['frames'])
+            if not frameCount:
+                raise KeyError('TiffData')
+            if len(omeimages[0]['files']) > 1:
                 raise TileSourceException('OME Tiff references multiple files')
-            if (len(self._omebase['TiffData']) != int(self._omebase['SizeC']) *
+            if (frameCount != int(self._omebase['SizeC']) *
                     int(self._omebase['SizeT']) * int(self._omebase['SizeZ']) or
-                    len(self._omebase['TiffData']) != len(
-                        self._omebase.get('Plane', self._omebase['TiffData']))):
+                    frameCount != omeimages[0]['planeCount']):
                 raise TileSourceException('OME Tiff contains frames that contain multiple planes')
+            omeimages = [entry for entry in omeimages if len(entry['frames']) == frameCount]
+            levels = [max(0, int(math.ceil(math.log(max(
+                float(entry['Pixels']['SizeX']) / base.tileWidth,
+                float(entry['Pixels']['SizeY']) / base.tileHeight)) / math.log(2))))
+                for entry in omeimages]
         except (KeyError, ValueError, IndexError):
             raise TileSourceException('OME Tiff does not contain an expected record')
-        omeimages = [
-            entry['Pixels'] for entry in self._omeinfo['Image'] if
-            len(entry['Pixels']['TiffData']) == len(self._omebase['TiffData'])]
-        levels = [max(0, int(math.ceil(math.log(max(
-            float(entry['SizeX']) / base.tileWidth,
-            float(entry['SizeY']) / base.tileHeight)) / math.log(2))))
-            for entry in omeimages]
+        # The IFD, C, Z, and T of each frame
+        self._frameTable = omeimages[0]['frames']
         omebylevel = dict(zip(levels, omeimages))
         self._omeLevels = [omebylevel.get(key) for key in range(max(omebylevel.keys()) + 1)]
+        # The IFD of each frame of each level
+        self._frameDirectoryTable = [
+            entry['frames'][:, 0] if entry else None for entry in self._omeLevels]
         self._tiffDirectories = [
-            TiledTiffDirectory(largeImagePath, int(entry['TiffData'][0]['IFD']))
-            if entry else None
-            for entry in self._omeLevels]
-        self._directoryCache = {}
-        self._directoryCacheMaxSize = max(20, len(self._omebase['TiffData']) * 3)
+            TiledTiffDirectory(largeImagePath, int(ifds[0]), sharedFile=self._sharedFile)
+            if ifds is not None else None
+            for ifds in self._frameDirectoryTable]
+        # Directories of other frames are kept by IFD, and the least recently
+        # used are discarded.  Since all directories share one open file and
+        # its libtiff handle is switched by IFD offset, opening a directory
+        # that isn't cached doesn't reopen the file.
+        self._directoryCacheMaxSize = max(20, frameCount * 3)
+        self._directoryCache = LRUCache(self._directoryCacheMaxSize)
+        self._directoryCacheLock = threading.Lock()
         self.tileWidth = base.tileWidth
         self.tileHeight = base.tileHeight
         self.levels = len(self._tiffDirectories)
@@ -147,19 +288,158 @@ class OMETiffFileTileSource(TiffFileTileSource):
         # directories not mentioned by the ome list.
         self._associatedImages = {}
 
-    def getMetadata(self):
+        # The channel, Z, and T planes of each frame
+        self._framePlanes = self._frameTable[:, 1:]
+        self._planeFrames = {
+            tuple(plane): frame for frame, plane in enumerate(self._framePlanes.tolist())}
+        # The OME metadata as a dictionary is only made when it is asked for
+        self._omeinfo = None
+        self._jsoncomposite = composite
+        self._composite = self._parseComposite(composite) if composite else None
+
+    @staticmethod
+    def getLRUHash(*args, **kwargs):
+        return strhash(
+            super(OMETiffFileTileSource, OMETiffFileTileSource).getLRUHash(
+                *args, **kwargs),
+            kwargs.get('composite'))
+
+    def getState(self):
+        return super(OMETiffFileTileSource, self).getState() + ',' + str(
+            self._jsoncomposite)
+
+    def _parseComposite(self, composite):
+        """
+        Check a composite specification and fill in its default values.
+
+        :param composite: a JSON string or a dictionary.  See __init__.
+        :returns: a list of channel dictionaries with frame, channel, color (a
+            numpy array of red, green, and blue from 0 to 1), min, max, and
+            gamma.
+        :raises: TileSourceException if the specification is invalid.
+        """
+        if isinstance(composite, six.string_types):
+            try:
+                composite = json.loads(composite)
+            except ValueError:
+                raise TileSourceException('Composite is not valid json.')
+        if not isinstance(composite, dict) or not isinstance(
+                composite.get('channels'), list) or not len(composite['channels']):
+            raise TileSourceException('Composite must contain a list of channels.')
+        omeChannels = self._omebase['Channel']
+        channels = []
+        for idx, entry in enumerate(composite['channels']):
+            try:
+                if ('frame' in entry) == ('channel' in entry):
+                    raise ValueError
+                channel = {
+                    'frame': int(entry['frame']) if 'frame' in entry else None,
+                    'channel': int(entry['channel']) if 'channel' in entry else None,
+                    'min': float(entry['min']) if entry.get('min') is not None else None,
+                    'max': float(entry['max']) if entry.get('max') is not None else None,
+                    'gamma': float(entry.get('gamma', 1)),
+                }
+                if channel['frame'] is not None:
+                    if not 0 <= channel['frame'] < len(self._framePlanes):
+                        raise ValueError
+                    omeChannel = int(self._framePlanes[channel['frame'], 0])
+                else:
+                    if channel['channel'] not in set(self._framePlanes[:, 0].tolist()):
+                        raise ValueError
+                    omeChannel = channel['channel']
+                if channel['gamma'] <= 0:
+                    raise ValueError
+                color = entry.get('color')
+                if color is None and omeChannel < len(omeChannels) and (
+                        omeChannels[omeChannel].get('Color') is not None):
+                    # OME colors are signed 32-bit RGBA values
+                    rgba = int(omeChannels[omeChannel]['Color']) & 0xFFFFFFFF
+                    color = [(rgba >> 24) & 255, (rgba >> 16) & 255, (rgba >> 8) & 255]
+                if color is None:
+                    color = _compositeColors[idx % len(_compositeColors)]
+                if isinstance(color, six.string_types):
+                    color = PIL.ImageColor.getrgb(color)
+                channel['color'] = numpy.array(
+                    [float(value) / 255 for value in color[:3]], dtype=numpy.float32)
+                if len(channel['color']) != 3:
+                    raise ValueError
+            except (AttributeError, KeyError, TypeError, ValueError):
+                raise TileSourceException('Composite channel %d is invalid.' % idx)
+            channels.append(channel)
+        return channels
+
+    def getMetadata(self, framesOffset=None, framesLimit=None, omeinfo=True, **kwargs):
         """
         Return a dictionary of metadata containing levels, sizeX, sizeY,
-        tileWidth, tileHeight, magnification, mm_x, mm_y, and frames.
+        tileWidth, tileHeight, magnification, mm_x, mm_y, frameCount, frames,
+        and omeinfo.
+
+        By default, frames is the list of OME Plane records (or TiffData
+        records if there are no Plane records).  If framesOffset or
+        framesLimit is specified, only that part of the frames is listed, and
+        each entry is a compact record of the Frame number and the IFD, TheC,
+        TheZ, and TheT of that frame.  This doesn't require converting the OME
+        metadata, so it is much faster for images with many frames.
 
+        :param framesOffset: if not None, list compact frames starting with
+            this frame number.  The offset is added to the metadata as
+            framesOffset.
+        :param framesLimit: if not None, list at most this many compact
+            frames.  Use 0 to only get the frameCount.
+        :param omeinfo: if False, don't include the OME metadata.
         :returns: metadata dictonary.
         """
-        result = super(OMETiffFileTileSource, self).getMetadata()
-        # We may want to reformat the frames to standardize this across sources
-        result['frames'] = self._omebase.get('Plane', self._omebase['TiffData'])
-        result['omeinfo'] = self._omeinfo
+        result = super(OMETiffFileTileSource, self).getMetadata(**kwargs)
+        result['frameCount'] = len(self._frameTable)
+        if framesOffset is None and framesLimit is None:
+            # We may want to reformat the frames to standardize this across
+            # sources
+            pixels = self.getOMEInfo()['Image'][0]['Pixels']
+            result['frames'] = pixels.get('Plane', pixels['TiffData'])
+        else:
+            start = max(0, int(framesOffset or 0))
+            stop = len(self._frameTable)
+            if framesLimit is not None:
+                stop = min(stop, start + max(0, int(framesLimit)))
+            result['frames'] = self._getFrameList(start, stop)
+            result['framesOffset'] = start
+        if omeinfo:
+            result['omeinfo'] = self.getOMEInfo()
         return result
 
+    def _getFrameList(self, start, stop):
+        """
+        List compact frame records for the metadata.
+
+        :param start: the first frame to list.
+        :param stop: one more than the last frame to list.
+        :returns: a list of dictionaries with Frame, IFD, TheC, TheZ, and
+            TheT.
+        """
+        return [
+            dict(zip(('IFD', 'TheC', 'TheZ', 'TheT'), row), Frame=frame)
+            for frame, row in enumerate(self._frameTable[start:stop].tolist(), start)]
+
+    def getOMEInfo(self):
+        """
+        Get the OME metadata as a dictionary.  This is made from the OME xml
+        the first time it is asked for.  The Image, TiffData, and Plane
+        records are always lists.
+
+        :returns: the OME dictionary.
+        """
+        if self._omeinfo is None:
+            info = etreeToDict(cElementTree.fromstring(self._omeXml))['OME']
+            if isinstance(info['Image'], dict):
+                info['Image'] = [info['Image']]
+            for img in info['Image']:
+                if isinstance(img['Pixels'].get('TiffData'), dict):
+                    img['Pixels']['TiffData'] = [img['Pixels']['TiffData']]
+                if isinstance(img['Pixels'].get('Plane'), dict):
+                    img['Pixels']['Plane'] = [img['Pixels']['Plane']]
+            self._omeinfo = info
+        return self._omeinfo
+
     def getNativeMagnification(self):
         """
         Get the magnification for the highest-resolution level.
@@ -182,21 +462,24 @@ class OMETiffFileTileSource(TiffFileTileSource):
     @methodcache()
     def getTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False,
                 **kwargs):
+        if self._composite:
+            return self._getCompositeTile(x, y, z, pilImageAllowed, **kwargs)
+        return self._getFrameTile(x, y, z, pilImageAllowed, sparseFallback, **kwargs)
+
+    def _getFrameTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False,
+                      **kwargs):
+        """
+        Get a tile of a single frame.  This takes the same parameters as
+        getTile, but is not cached.
+        """
         if (z < 0 or z >= len(self._omeLevels) or self._omeLevels[z] is None or
                 kwargs.get('frame') in (None, 0, '0', '')):
-            return super(OMETiffFileTileSource, self).getTile(
-                x, y, z, pilImageAllowed=pilImageAllowed, sparseFallback=sparseFallback, **kwargs)
-        frame = int(kwargs['frame'])
-        if frame < 0 or frame >= len(self._omebase['TiffData']):
-            raise TileSourceException('Frame does not exist')
-        dirnum = int(self._omeLevels[z]['TiffData'][frame]['IFD'])
-        if dirnum in self._directoryCache:
-            dir = self._directoryCache[dirnum]
-        else:
-            if len(self._directoryCache) >= self._directoryCacheMaxSize:
-                self._directoryCache = {}
-            dir = TiledTiffDirectory(self._getLargeImagePath(), dirnum)
-            self._directoryCache[dirnum] = dir
+            # Use the undecorated getTile, since the tile cache key of this
+            # source includes the composite parameters
+            return TiffFileTileSource.getTile.__wrapped__(
+                self, x, y, z, pilImageAllowed=pilImageAllowed,
+                sparseFallback=sparseFallback, **kwargs)
+        dir = self._getFrameDirectory(z, kwargs['frame'])
         try:
             tile = dir.getTile(x, y)
             format = 'JPEG'
@@ -211,6 +494,161 @@ class OMETiffFileTileSource(TiffFileTileSource):
                 x, y, z, pilImageAllowed=pilImageAllowed,
                 sparseFallback=sparseFallback, exception=e, **kwargs)
 
+    def _getCompositeTile(self, x, y, z, pilImageAllowed=False, frame=None,
+                          **kwargs):
+        """
+        Get a tile that combines several frames as colored channels.  The tile
+        of each channel is read in parallel.
+
+        :param x: the 0-based x position of the tile on the level.
+        :param y: the 0-based y position of the tile on the level.
+        :param z: the tile level.
+        :param pilImageAllowed: True if a PIL image may be returned.
+        :param frame: the frame whose Z and T planes are used by channels that
+            are specified by their OME channel number.
+        :returns: either a PIL image or a memory object with an image file.
+        """
+        try:
+            frame = int(frame or 0)
+        except ValueError:
+            raise TileSourceException('Frame does not exist')
+        if not 0 <= frame < len(self._framePlanes):
+            raise TileSourceException('Frame does not exist')
+        if z < 0 or z >= len(self._omeLevels):
+            raise TileSourceException('z layer does not exist')
+        if self._omeLevels[z] is None:
+            # This is made from composited tiles of a higher resolution level
+            tile = self.getTileFromEmptyDirectory(x, y, z, frame=frame)
+            return self._outputTile(tile, TILE_FORMAT_PIL, x, y, z, pilImageAllowed,
+                                    **kwargs)
+        planeZ, planeT = self._framePlanes[frame, 1:].tolist()
+        frames = []
+        for channel in self._composite:
+            if channel['frame'] is not None:
+                frames.append(channel['frame'])
+            elif (channel['channel'], planeZ, planeT) in self._planeFrames:
+                frames.append(self._planeFrames[(channel['channel'], planeZ, planeT)])
+            else:
+                raise TileSourceException('Frame does not exist')
+        pool = _getCompositePool()
+        futures = [pool.submit(self._getChannelArray, x, y, z, channelFrame)
+                   for channelFrame in frames]
+        try:
+            arrays = [future.result() for future in futures]
+        except InvalidOperationTiffException as e:
+            raise TileSourceException(e.args[0])
+        except IOTiffException as e:
+            raise TileSourceException('Internal I/O failure: %s' % e.args[0])
+        tile = PIL.Image.fromarray(self._compositeArrays(arrays))
+        return self._outputTile(tile, TILE_FORMAT_PIL, x, y, z, pilImageAllowed,
+                                **kwargs)
+
+    def _getChannelArray(self, x, y, z, frame):
+        """
+        Get the tile of a frame as a two dimensional numpy array for
+        compositing.  Only the first sample of each pixel is used.
+
+        :param x: the 0-based x position of the tile on the level.
+        :param y: the 0-based y position of the tile on the level.
+        :param z: the tile level.
+        :param frame: the frame number.
+        :returns: a numpy array.
+        """
+        data = None
+        if self._nativeTileDirectory(z, frame) is not None:
+            data = self._getNativeTile(x, y, z, frame)
+        if data is None:
+            tile = self._getFrameTile(x, y, z, pilImageAllowed=True, frame=frame)
+            if not isinstance(tile, PIL.Image.Image):
+                tile = PIL.Image.open(BytesIO(tile))
+            data = numpy.asarray(tile)
+        if len(data.shape) == 3:
+            data = data[:, :, 0]
+        return data
+
+    def _compositeArrays(self, arrays):
+        """
+        Combine the tiles of the composited channels.
+
+        :param arrays: a two dimensional numpy array for each channel.
+        :returns: an RGB numpy array with 8 bits per sample.
+        """
+        result = None
+        for data, channel in zip(arrays, self._composite):
+            low, high = channel['min'], channel['max']
+            if low is None:
+                low = numpy.iinfo(data.dtype).min if data.dtype.kind == 'i' else 0
+            if high is None:
+                high = numpy.iinfo(data.dtype).max if data.dtype.kind in 'iu' else 1
+            value = data.astype(numpy.float32)
+            value -= low
+            value *= 1.0 / (high - low) if high != low else 0
+            numpy.clip(value, 0, 1, out=value)
+            if channel['gamma'] != 1:
+                numpy.power(value, 1.0 / channel['gamma'], out=value)
+            value = value[:, :, numpy.newaxis] * channel['color']
+            if result is None:
+                result = value
+            else:
+                result += value
+        numpy.clip(result, 0, 1, out=result)
+        result *= 255
+        result += 0.5
+        return result.astype(numpy.uint8)
+
+    def _getFrameDirectory(self, z, frame):
+        """
+        Get the TIFF directory of a level of a frame.
+
+        :param z: the tile level.
+        :param frame: the frame number.
+        :returns: a TiledTiffDirectory.
+        :raises: TileSourceException if the frame doesn't exist.
+        """
+        frame = int(frame)
+        ifds = self._frameDirectoryTable[z]
+        if frame < 0 or frame >= len(ifds):
+            raise TileSourceException('Frame does not exist')
+        dirnum = int(ifds[frame])
+        if dirnum == ifds[0]:
+            return self._tiffDirectories[z]
+        with self._directoryCacheLock:
+            try:
+                return self._directoryCache[dirnum]
+            except KeyError:
+                pass
+            dir = TiledTiffDirectory(
+                self._largeImagePath, dirnum, sharedFile=self._sharedFile)
+            self._directoryCache[dirnum] = dir
+        return dir
+
+    def _tileDirectory(self, z, frame=None):
+        if self._composite:
+            # Composited tiles are not read from a single directory
+            return None
+        if (z < 0 or z >= len(self._omeLevels) or self._omeLevels[z] is None or
+                frame in (None, 0, '0', '')):
+            return super(OMETiffFileTileSource, self)._tileDirectory(z, frame)
+        try:
+            return self._getFrameDirectory(z, frame)
+        except (TileSourceException, TiffException, ValueError):
+            return None
+
+    def _getNativeTileFormat(self, z, frame=None):
+        if self._composite:
+            return None
+        return super(OMETiffFileTileSource, self)._getNativeTileFormat(z, frame)
+
+    def _nativeTileDirectory(self, z, frame=None):
+        if (z < 0 or z >= len(self._omeLevels) or self._omeLevels[z] is None or
+                frame in (None, 0, '0', '')):
+            return super(OMETiffFileTileSource, self)._nativeTileDirectory(z, frame)
+        try:
+            td = self._getFrameDirectory(z, frame)
+        except (TileSourceException, TiffException, ValueError):
+            return None
+        return td if td.hasTileArrays else None
+
 
 if girder:
     class OMETiffGirderTileSource(OMETiffFileTileSource, GirderTileSource):
@@ -219,3 +657,11 @@ if girder:
         """
         cacheName = 'tilesource'
         name = 'ometiff'
+        # Files in assetstores without local paths are read in ranges
+        byteSourceAllowed = True
+
+        @staticmethod
+        def getLRUHash(*args, **kwargs):
+            return strhash(
+                GirderTileSource.getLRUHash(*args, **kwargs),
+                kwargs.get('composite'))
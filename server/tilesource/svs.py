@@ -17,10 +17,14 @@
 #  limitations under the License.
 ###############################################################################
 
+import concurrent.futures
+import itertools
 import math
+import numpy
+import psutil
 import six
 
-from six.moves import range
+from six.moves import range, zip
 
 import openslide
 import PIL
@@ -38,6 +42,17 @@ except ImportError:
     import logging as logger
     logger.getLogger().setLevel(logger.INFO)
 
+try:
+    from libtiff import libtiff_ctypes
+    from .tiff_reader import TiledTiffDirectory, SharedTiffFile, TiffException, \
+        ValidationTiffException, InvalidOperationTiffException, IOTiffException
+except ImportError:
+    TiledTiffDirectory = None
+
+# An Adobe APP14 marker with a transform of 0, which tells JPEG decoders that
+# the three components are red, green, and blue rather than YCbCr.
+_jpegAdobeRGBMarker = b'\xff\xee\x00\x0eAdobe\x00\x64\x00\x00\x00\x00\x00'
+
 
 @six.add_metaclass(LruCacheMetaclass)
 class SVSFileTileSource(FileTileSource):
@@ -59,6 +74,15 @@ class SVSFileTileSource(FileTileSource):
         'vms': SourcePriority.HIGH,  # Hamamatsu
         'vmu': SourcePriority.HIGH,  # Hamamatsu
     }
+    # Regions are read from OpenSlide in blocks of about this many pixels on a
+    # side of the SVS level.  Blocks are read in parallel and bound the extra
+    # memory that is used.
+    regionReadSize = 4096
+    # For files from these OpenSlide vendors, tiles of levels that are stored
+    # as JPEG tiles of the same size as ours are served as they are stored
+    # rather than decoded and encoded again.  Each level of these files is a
+    # whole TIFF directory.
+    jpegPassthroughVendors = {'aperio', 'generic-tiff'}
 
     def __init__(self, path, **kwargs):
         """
@@ -137,6 +161,65 @@ class SVSFileTileSource(FileTileSource):
                 'svslevel': bestlevel,
                 'scale': scale
             })
+        self._jpegDirectories = self._getJpegDirectories(largeImagePath)
+
+    def _getJpegDirectories(self, path):
+        """
+        Find the TIFF directories whose tiles can be served without decoding
+        them.  These are the directories of SVS levels that are used at their
+        own scale and are stored as JPEG tiles of the same size as our tiles.
+        Aperio files usually store JPEG tiles with red, green, and blue
+        components rather than YCbCr.  These tiles get a marker that tells
+        decoders so, except that levels whose tiles have a JFIF marker, which
+        decoders take to mean YCbCr, are not used.  Other levels are read
+        through OpenSlide.
+
+        :param path: the path of the SVS file.
+        :returns: a list with None or a tuple of a TiledTiffDirectory and the
+            bytes to add after the start of each JPEG tile for each level.
+        """
+        directories = [None] * self.levels
+        if (TiledTiffDirectory is None or self._openslide.properties.get(
+                openslide.PROPERTY_NAME_VENDOR) not in self.jpegPassthroughVendors):
+            return directories
+        # The levels that use each SVS level at its own scale, by the size of
+        # the SVS level
+        wanted = {}
+        for level, svslevel in enumerate(self._svslevels):
+            if svslevel['scale'] == 1:
+                wanted.setdefault(tuple(self._openslide.level_dimensions[
+                    svslevel['svslevel']]), []).append(level)
+        sharedFile = SharedTiffFile(path)
+        for directoryNum in itertools.count():
+            if not wanted:
+                break
+            try:
+                td = TiledTiffDirectory(path, directoryNum, sharedFile=sharedFile)
+            except ValidationTiffException:
+                continue
+            except TiffException:
+                break
+            photometric = td._tiffInfo.get('photometric')
+            if (td._tiffInfo.get('compression') != libtiff_ctypes.COMPRESSION_JPEG or
+                    photometric not in (libtiff_ctypes.PHOTOMETRIC_RGB,
+                                        libtiff_ctypes.PHOTOMETRIC_YCBCR) or
+                    td.tileWidth != self.tileWidth or td.tileHeight != self.tileHeight or
+                    (td.imageWidth, td.imageHeight) not in wanted):
+                continue
+            marker = b''
+            if photometric == libtiff_ctypes.PHOTOMETRIC_RGB:
+                # The markers of the first tile stand for all of its tiles
+                try:
+                    header = td.getTile(0, 0).split(b'\xff\xda', 1)[0]
+                except TiffException:
+                    continue
+                if b'JFIF\x00' in header:
+                    continue
+                if b'Adobe' not in header:
+                    marker = _jpegAdobeRGBMarker
+            for level in wanted.pop((td.imageWidth, td.imageHeight)):
+                directories[level] = (td, marker)
+        return directories
 
     def _getTileSize(self):
         """
@@ -254,6 +337,19 @@ class SVSFileTileSource(FileTileSource):
         offsety = y * self.tileHeight * scale
         if not (0 <= offsety < self.sizeY):
             raise TileSourceException('y is outside layer')
+        if self._jpegDirectories[z] is not None:
+            td, marker = self._jpegDirectories[z]
+            try:
+                tile = td.getTile(x, y)
+                if marker:
+                    # Add the marker after the JPEG Start Of Image marker
+                    tile = tile[:2] + marker + tile[2:]
+                return self._outputTile(tile, 'JPEG', x, y, z, pilImageAllowed, **kwargs)
+            except (InvalidOperationTiffException, IOTiffException) as exc:
+                # Read tiles that can't be read from the file through
+                # OpenSlide.
+                logger.debug('Reading tile %d, %d, %d of %s through OpenSlide: %s',
+                             x, y, z, self._getLargeImagePath(), exc)
         # We ask to read an area that will cover the tile at the z level.  The
         # scale we computed in the __init__ process for this svs level tells
         # how much larger a region we need to read.
@@ -271,6 +367,116 @@ class SVSFileTileSource(FileTileSource):
                                PIL.Image.LANCZOS)
         return self._outputTile(tile, 'PIL', x, y, z, pilImageAllowed, **kwargs)
 
+    def _fillRegionArray(self, regionData, iterInfo, left, top):
+        """
+        Read a region directly from OpenSlide rather than one tile at a time,
+        so that large regions pay the overhead of an OpenSlide call once per
+        block instead of once per tile.  Blocks are read from the SVS level
+        used for tiles of the requested level, scaled in the same manner as
+        tiles are, and are read in a pool of threads.  See
+        TileSource._fillRegionArray.
+
+        :param regionData: a height x width x 4 uint8 numpy array.
+        :param iterInfo: tile iterator information.  See _tileIteratorInfo.
+        :param left: the left coordinate of the array in level pixels.
+        :param top: the top coordinate of the array in level pixels.
+        """
+        z = iterInfo['level']
+        if (regionData.dtype != numpy.uint8 or regionData.shape[2] != 4 or
+                not 0 <= z < len(self._svslevels)):
+            return super(SVSFileTileSource, self)._fillRegionArray(
+                regionData, iterInfo, left, top)
+        left, top = int(left), int(top)
+        height, width = regionData.shape[:2]
+        # Block edges are multiples of the tile size on the level, so that
+        # OpenSlide doesn't decode the same tile for adjacent blocks.  Blocks
+        # are made smaller until there are enough for each thread to read
+        # one, since OpenSlide decodes the tiles of a single read in turn.
+        scale = self._svslevels[z]['scale']
+        tilesX = max(1, self.regionReadSize // scale // self.tileWidth)
+        tilesY = max(1, self.regionReadSize // scale // self.tileHeight)
+        cpus = psutil.cpu_count(logical=True) or 1
+        while (tilesX > 1 or tilesY > 1) and (
+                int(math.ceil(float(width) / (tilesX * self.tileWidth))) *
+                int(math.ceil(float(height) / (tilesY * self.tileHeight))) < cpus):
+            if tilesX >= tilesY:
+                tilesX = (tilesX + 1) // 2
+            else:
+                tilesY = (tilesY + 1) // 2
+        blockWidth = tilesX * self.tileWidth
+        blockHeight = tilesY * self.tileHeight
+        xs = sorted({left, left + width} | set(range(
+            left - left % blockWidth + blockWidth, left + width, blockWidth)))
+        ys = sorted({top, top + height} | set(range(
+            top - top % blockHeight + blockHeight, top + height, blockHeight)))
+        blocks = [(x0, y0, x1 - x0, y1 - y0)
+                  for y0, y1 in zip(ys[:-1], ys[1:]) for x0, x1 in zip(xs[:-1], xs[1:])]
+        workers = min(len(blocks), cpus)
+        if workers <= 1:
+            for block in blocks:
+                self._readRegionBlock(regionData, z, left, top, *block)
+            return
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            tasks = [pool.submit(self._readRegionBlock, regionData, z, left, top, *block)
+                     for block in blocks]
+            for task in tasks:
+                # This raises any exception that occurred in a task
+                task.result()
+        finally:
+            pool.shutdown(False)
+
+    def _readRegionBlock(self, regionData, z, left, top, x, y, width, height):
+        """
+        Read part of a region from OpenSlide and copy it into the region's
+        array.
+
+        :param regionData: a height x width x 4 uint8 numpy array.
+        :param z: the tile level of the region.
+        :param left: the left coordinate of the array in level pixels.
+        :param top: the top coordinate of the array in level pixels.
+        :param x: the left coordinate of the block in level pixels.
+        :param y: the top coordinate of the block in level pixels.
+        :param width: the width of the block in level pixels.
+        :param height: the height of the block in level pixels.
+        """
+        svslevel = self._svslevels[z]
+        scale = svslevel['scale']
+        # Scaled tiles are resized one at a time, as in getTile, so that the
+        # region is the same as one made from tiles.  The block is read from
+        # the edges of the tiles it covers.
+        x0, y0, x1, y1 = x, y, x + width, y + height
+        if scale != 1:
+            x0 -= x0 % self.tileWidth
+            y0 -= y0 % self.tileHeight
+            x1 += -x1 % self.tileWidth
+            y1 += -y1 % self.tileHeight
+        # As in getTile, the offset is in the SVS level 0 coordinate system.
+        levelScale = 2 ** (self.levels - 1 - z)
+        try:
+            block = self._openslide.read_region(
+                (x0 * levelScale, y0 * levelScale), svslevel['svslevel'],
+                ((x1 - x0) * scale, (y1 - y0) * scale))
+        except openslide.lowlevel.OpenSlideError as exc:
+            raise TileSourceException(
+                'Failed to get OpenSlide region (%r).' % exc)
+        if scale == 1:
+            regionData[y - top:y - top + height, x - left:x - left + width] = numpy.asarray(block)
+            return
+        for ty in range(y0, y1, self.tileHeight):
+            for tx in range(x0, x1, self.tileWidth):
+                tile = numpy.asarray(block.crop((
+                    (tx - x0) * scale, (ty - y0) * scale,
+                    (tx - x0 + self.tileWidth) * scale,
+                    (ty - y0 + self.tileHeight) * scale,
+                )).resize((self.tileWidth, self.tileHeight), PIL.Image.LANCZOS))
+                # Copy the part of the tile that is in the block
+                cx0, cy0 = max(tx, x), max(ty, y)
+                cx1 = min(tx + self.tileWidth, x + width)
+                cy1 = min(ty + self.tileHeight, y + height)
+                regionData[cy0 - top:cy1 - top, cx0 - left:cx1 - left] = tile[
+                    cy0 - ty:cy1 - ty, cx0 - tx:cx1 - tx]
+
     def getPreferredLevel(self, level):
         """
         Given a desired level (0 is minimum resolution, self.levels - 1 is max
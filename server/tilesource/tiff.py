@@ -20,15 +20,18 @@
 import base64
 import itertools
 import math
+import os
 import six
+import threading
 from six import BytesIO
 from six.moves import range
 
 from .base import FileTileSource, TileSourceException, nearPowerOfTwo
-from ..cache_util import LruCacheMetaclass, methodcache
+from ..cache_util import LruCacheMetaclass, LRUCache, methodcache, getMetadataIndexCache
 from ..constants import SourcePriority
 from .tiff_reader import TiledTiffDirectory, TiffException, \
-    InvalidOperationTiffException, IOTiffException, ValidationTiffException
+    InvalidOperationTiffException, IOTiffException, ValidationTiffException, \
+    SharedTiffFile, StrippedTiffDirectory
 
 try:
     import girder
@@ -60,13 +63,23 @@ class TiffFileTileSource(FileTileSource):
         'ptif': SourcePriority.PREFERRED,
         'ptiff': SourcePriority.PREFERRED,
     }
+    # Tiles in a row are often stored together, so read them together
+    batchTileRows = True
+    # Change this if the contents of stored metadata indices change
+    metadataIndexVersion = 2
+    # The number of decoded associated images kept by each tile source
+    associatedImageCacheSize = 2
+    # Files without tiled images can be read from their strips as tiles of
+    # this size
+    virtualTileSize = 256
 
     def __init__(self, path, **kwargs):
         """
         Initialize the tile class.  See the base class for other available
         parameters.
 
-        :param path: a filesystem path for the tile source.
+        :param path: a filesystem path for the tile source, an http or https
+            URL that can be read with range requests, or a ByteSource.
         """
         super(TiffFileTileSource, self).__init__(path, **kwargs)
 
@@ -77,17 +90,30 @@ class TiffFileTileSource(FileTileSource):
         # Individual TIFF images can also have images embedded into their
         # directory as tags (this is a vendor-specific method of adding more
         # images into a file) -- those are stored in the individual
-        # directories' _embeddedImages field.
+        # directories' _embeddedImages field.  Associated images are only
+        # decoded when they are requested, so this holds the metadata index of
+        # each image's directory.
         self._associatedImages = {}
+        self._associatedImageCache = LRUCache(self.associatedImageCacheSize)
+        self._associatedImageLock = threading.Lock()
+        self._largeImagePath = largeImagePath
+        # All directories are read through one open file
+        self._sharedFile = SharedTiffFile(largeImagePath)
+        indexKey = self._metadataIndexKey(largeImagePath)
+        if self._loadMetadataIndex(largeImagePath, indexKey):
+            return
 
         # Query all know directories in the tif file.  Only keep track of
         # directories that contain tiled images.
         alldir = []
+        untiled = []
         for directoryNum in itertools.count():  # pragma: no branch
             try:
-                td = TiledTiffDirectory(largeImagePath, directoryNum)
+                td = TiledTiffDirectory(
+                    largeImagePath, directoryNum, sharedFile=self._sharedFile)
             except ValidationTiffException as exc:
                 lastException = exc
+                untiled.append(directoryNum)
                 self._addAssociatedImage(largeImagePath, directoryNum)
                 continue
             except TiffException as exc:
@@ -106,7 +132,11 @@ class TiffFileTileSource(FileTileSource):
             # Store information for sorting with the directory.
             alldir.append((td.tileWidth * td.tileHeight, level,
                            td.imageWidth * td.imageHeight, directoryNum, td))
-        # If there are no tiled images, raise an exception.
+        # If there are no tiled images, read a stripped image as tiles, or
+        # raise an exception.
+        if not len(alldir) and self._initVirtualTiles(largeImagePath, untiled):
+            self._storeMetadataIndex(largeImagePath, indexKey)
+            return
         if not len(alldir):
             msg = 'File %s didn\'t meet requirements for tile source: %s' % (
                 largeImagePath, lastException)
@@ -147,18 +177,155 @@ class TiffFileTileSource(FileTileSource):
         self.levels = len(self._tiffDirectories)
         self.sizeX = highest.imageWidth
         self.sizeY = highest.imageHeight
+        self._storeMetadataIndex(largeImagePath, indexKey)
+
+    def _initVirtualTiles(self, largeImagePath, directoryNums):
+        """
+        Use the largest stripped image of a file that has no tiled images,
+        read as a grid of virtual tiles.  Only the full resolution level is
+        stored in the file; the other levels are made from its strips.
+
+        :param largeImagePath: path to the TIFF file.
+        :param directoryNums: the directories that might contain stripped
+            images.
+        :returns: True if a stripped image is used.
+        """
+        highest = None
+        for directoryNum in directoryNums:
+            try:
+                td = StrippedTiffDirectory(
+                    largeImagePath, directoryNum, self.virtualTileSize,
+                    sharedFile=self._sharedFile)
+            except TiffException:
+                continue
+            if (highest is None or td.imageWidth * td.imageHeight >
+                    highest.imageWidth * highest.imageHeight):
+                highest = td
+        if highest is None:
+            return False
+        levels = int(math.ceil(math.log(max(
+            float(highest.imageWidth) / highest.tileWidth,
+            float(highest.imageHeight) / highest.tileHeight, 1)) / math.log(2))) + 1
+        self._tiffDirectories = [None] * (levels - 1) + [highest]
+        # The image isn't also an associated image
+        self._associatedImages = {
+            key: value for key, value in six.iteritems(self._associatedImages)
+            if value['directoryNum'] != highest._directoryNum}
+        self.tileWidth = highest.tileWidth
+        self.tileHeight = highest.tileHeight
+        self.levels = levels
+        self.sizeX = highest.imageWidth
+        self.sizeY = highest.imageHeight
+        return True
+
+    def _virtualTileDirectory(self):
+        """
+        Get the directory of a stripped image that is read as virtual tiles.
+
+        :returns: a StrippedTiffDirectory or None if the image is tiled.
+        """
+        highest = self._tiffDirectories[-1]
+        return highest if isinstance(highest, StrippedTiffDirectory) else None
+
+    def _metadataIndexKey(self, largeImagePath):
+        """
+        Get the key of the metadata index of a file.  This includes the size
+        and modification time of the file, so a changed file isn't read using
+        an old index.  Files read through a byte source use the source's
+        identity instead.
+
+        :param largeImagePath: path to the TIFF file.
+        :returns: the key or None if metadata indices are not used.
+        """
+        if getMetadataIndexCache() is None:
+            return None
+        byteSource = self._sharedFile.byteSource
+        if byteSource is not None and byteSource.path is None:
+            if byteSource.identity is None:
+                return None
+            return '%s %s %d %s' % (
+                self.name, byteSource.name, self.metadataIndexVersion, byteSource.identity)
+        try:
+            stat = os.stat(largeImagePath)
+        except OSError:
+            return None
+        return '%s %s %d %d %r' % (
+            self.name, os.path.realpath(largeImagePath), self.metadataIndexVersion,
+            stat.st_size, stat.st_mtime)
+
+    def _loadMetadataIndex(self, largeImagePath, indexKey):
+        """
+        If there is a stored metadata index for this file, use it to set up
+        the tile source without walking the TIFF directories.
+
+        :param largeImagePath: path to the TIFF file.
+        :param indexKey: the key from _metadataIndexKey.
+        :returns: True if the tile source was set up from the index.
+        """
+        if indexKey is None:
+            return False
+        try:
+            index = getMetadataIndexCache()[indexKey]
+        except KeyError:
+            return False
+        try:
+            self._tiffDirectories = [
+                (StrippedTiffDirectory(
+                    largeImagePath, entry['directoryNum'], entry['virtualTileSize'],
+                    metadata=entry, sharedFile=self._sharedFile)
+                 if entry.get('virtualTileSize') else
+                 TiledTiffDirectory(largeImagePath, entry['directoryNum'], metadata=entry,
+                                    sharedFile=self._sharedFile))
+                if entry is not None else None
+                for entry in index['directories']]
+            self._associatedImages = dict(index['associatedImages'])
+        except (KeyError, TypeError, TiffException) as exc:
+            logger.info('Cannot use the metadata index of %s: %s', largeImagePath, exc)
+            self._associatedImages = {}
+            return False
+        highest = self._tiffDirectories[-1]
+        self.tileWidth = highest.tileWidth
+        self.tileHeight = highest.tileHeight
+        self.levels = len(self._tiffDirectories)
+        self.sizeX = highest.imageWidth
+        self.sizeY = highest.imageHeight
+        return True
+
+    def _storeMetadataIndex(self, largeImagePath, indexKey):
+        """
+        Store the directory layout, tile locations, pixel information, and
+        associated images of this file so that it can be reopened with
+        _loadMetadataIndex.
+
+        :param largeImagePath: path to the TIFF file.
+        :param indexKey: the key from _metadataIndexKey.
+        """
+        if indexKey is None:
+            return
+        try:
+            index = {
+                'directories': [
+                    td.getMetadataIndex() if td is not None else None
+                    for td in self._tiffDirectories],
+                'associatedImages': self._associatedImages,
+            }
+            getMetadataIndexCache()[indexKey] = index
+        except Exception:
+            logger.exception('Could not store the metadata index of %s', largeImagePath)
 
     def _addAssociatedImage(self, largeImagePath, directoryNum):
         """
         Check if the specfied TIFF directory contains a non-tiled image with a
         sensible image description that can be used as an ID.  If so, and if
-        the image isn't too large, add this image as an associated image.
+        the image isn't too large, add this image as an associated image.  The
+        image is read when it is first requested.
 
         :param largeImagePath: path to the TIFF file.
         :param directoryNum: libtiff directory number of the image.
         """
         try:
-            associated = TiledTiffDirectory(largeImagePath, directoryNum, False)
+            associated = TiledTiffDirectory(
+                largeImagePath, directoryNum, False, sharedFile=self._sharedFile)
             id = associated._tiffInfo.get(
                 'imagedescription').strip().split(None, 1)[0].lower()
             if not isinstance(id, six.text_type):
@@ -169,7 +336,7 @@ class TiffFileTileSource(FileTileSource):
             if (id.isalnum() and len(id) > 3 and len(id) <= 20 and
                     associated._pixelInfo['width'] <= 8192 and
                     associated._pixelInfo['height'] <= 8192):
-                self._associatedImages[id] = associated._tiffFile.read_image()
+                self._associatedImages[id] = associated.getMetadataIndex()
         except (TiffException, AttributeError):
             # If we can't validate or read an associated image or it has no
             # useful imagedescription, fail quietly without adding an
@@ -201,8 +368,10 @@ class TiffFileTileSource(FileTileSource):
     def getTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False,
                 **kwargs):
         try:
+            if z < 0:
+                raise IndexError('z layer does not exist')
             if self._tiffDirectories[z] is None:
-                if sparseFallback:
+                if sparseFallback and not self._virtualTileDirectory():
                     raise IOTiffException('Missing z level %d' % z)
                 tile = self.getTileFromEmptyDirectory(x, y, z, **kwargs)
                 format = TILE_FORMAT_PIL
@@ -222,6 +391,97 @@ class TiffFileTileSource(FileTileSource):
                 x, y, z, pilImageAllowed=pilImageAllowed,
                 sparseFallback=sparseFallback, exception=e, **kwargs)
 
+    def _nativeTileDirectory(self, z, frame=None):
+        """
+        Get the directory used for native tiles of a level.
+
+        :param z: the tile level.
+        :param frame: the frame number or None.
+        :returns: a TiledTiffDirectory whose tiles can be read as arrays or
+            None.
+        """
+        if frame not in (None, 0, '0', '') or not 0 <= z < len(self._tiffDirectories):
+            return None
+        # The lower levels of virtually tiled images are read from the strips
+        td = self._tiffDirectories[z] or self._virtualTileDirectory()
+        if td is None or not td.hasTileArrays:
+            return None
+        return td
+
+    def _getNativeTileFormat(self, z, frame=None):
+        td = self._nativeTileDirectory(z, frame)
+        if td is None:
+            return None
+        return td.tileArrayDtype, td._tiffInfo.get('samplesperpixel') or 1
+
+    def _readNativeTile(self, x, y, z, frame=None):
+        td = self._nativeTileDirectory(z, frame)
+        if td is None:
+            return None
+        try:
+            if self._tiffDirectories[z] is None:
+                return td.getReducedTileArray(x, y, 2 ** (self.levels - 1 - z))
+            return td.getTileArray(x, y)
+        except TiffException:
+            # Fall back to getTile, which handles missing tiles.
+            return None
+
+    def _getTilesFromSource(self, requests):
+        """
+        Read tiles that were not in the tile cache.  The raw data of the
+        requested tiles in each directory is read first with as few reads as
+        possible (see TiledTiffDirectory.readRawTiles).
+
+        :param requests: a list of ((x, y, z), kwargs) tuples, where kwargs
+            are passed to getTile.
+        :returns: a list of tiles in the same order as the requests.
+        """
+        directories = {}
+        for (x, y, z), tileKwargs in requests:
+            td = self._tileDirectory(z, tileKwargs.get('frame'))
+            if td is not None:
+                directories.setdefault(td, []).append((x, y))
+        for td, tiles in six.iteritems(directories):
+            if len(tiles) > 1:
+                td.prefetchRawTiles(tiles)
+        try:
+            return super(TiffFileTileSource, self)._getTilesFromSource(requests)
+        finally:
+            for td in directories:
+                td.clearPrefetchedRawTiles()
+
+    def _loadTiles(self, tiles):
+        """
+        Load the image data of tiles from the tile iterator in the current
+        thread.  The raw data of the tiles is read first with as few reads as
+        possible.
+
+        :param tiles: a list of LazyTileDict objects on the same row of the
+            same level and frame.
+        :returns: a list of the image data of the tiles.
+        """
+        td = self._tileDirectory(tiles[0].level, tiles[0].frame)
+        if td is None or len(tiles) < 2 or tiles[0].retile:
+            return super(TiffFileTileSource, self)._loadTiles(tiles)
+        td.prefetchRawTiles([(tile.x, tile.y) for tile in tiles])
+        try:
+            return [tile['tile'] for tile in tiles]
+        finally:
+            td.clearPrefetchedRawTiles()
+
+    def _tileDirectory(self, z, frame=None):
+        """
+        Get the directory that stores the tiles of a level.
+
+        :param z: the tile level.
+        :param frame: the frame number or None.
+        :returns: a TiledTiffDirectory or None if the level isn't stored in
+            the file.
+        """
+        if frame not in (None, 0, '0', '') or not 0 <= z < len(self._tiffDirectories):
+            return None
+        return self._tiffDirectories[z]
+
     def getTileIOTiffException(self, x, y, z, pilImageAllowed=False,
                                sparseFallback=False, exception=None, **kwargs):
         if sparseFallback and z and PIL:
@@ -252,6 +512,11 @@ class TiffFileTileSource(FileTileSource):
         :param z: original level.
         :returns: tile in PIL format.
         """
+        virtual = self._virtualTileDirectory()
+        if virtual is not None:
+            if z < 0:
+                raise IndexError('z layer does not exist')
+            return virtual.getReducedTile(x, y, 2 ** (self.levels - 1 - z))
         scale = 1
         while self._tiffDirectories[z] is None:
             scale *= 2
@@ -286,6 +551,10 @@ class TiffFileTileSource(FileTileSource):
         :returns level: a level with actual data that is no lower resolution.
         """
         level = max(0, min(level, self.levels - 1))
+        # All levels of virtually tiled images are made from the strips, so
+        # lower levels are cheaper to use than the full resolution level.
+        if self._virtualTileDirectory():
+            return level
         while self._tiffDirectories[level] is None and level < self.levels - 1:
             level += 1
         return level
@@ -321,9 +590,32 @@ class TiffFileTileSource(FileTileSource):
                 image = PIL.Image.open(BytesIO(base64.b64decode(td._embeddedImages[imageKey])))
                 return image
         if imageKey in self._associatedImages:
-            return PIL.Image.fromarray(self._associatedImages[imageKey])
+            image = self._readAssociatedImage(imageKey)
+            if image is not None:
+                return PIL.Image.fromarray(image)
         return None
 
+    def _readAssociatedImage(self, imageKey):
+        """
+        Read and decode an associated image, keeping the most recently used
+        ones in a small cache.
+
+        :param imageKey: the key of the associated image.
+        :return: the image as a numpy array or None if it can't be read.
+        """
+        with self._associatedImageLock:
+            if imageKey not in self._associatedImageCache:
+                metadata = self._associatedImages[imageKey]
+                try:
+                    image = TiledTiffDirectory(
+                        self._largeImagePath, metadata['directoryNum'], False,
+                        metadata=metadata, sharedFile=self._sharedFile)._readImage()
+                except Exception:
+                    logger.exception('Could not read associated image %s', imageKey)
+                    return None
+                self._associatedImageCache[imageKey] = image
+            return self._associatedImageCache[imageKey]
+
 
 if girder:
     class TiffGirderTileSource(TiffFileTileSource, GirderTileSource):
@@ -332,3 +624,5 @@ if girder:
         """
         cacheName = 'tilesource'
         name = 'tiff'
+        # Files in assetstores without local paths are read in ranges
+        byteSourceAllowed = True
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import numpy
+import struct
+import threading
+
+from .byte_source import ByteSource, openByteSource
+
+# TIFF tags used to locate tiles
+TAG_IMAGEWIDTH = 256
+TAG_IMAGELENGTH = 257
+TAG_COMPRESSION = 259
+TAG_STRIPOFFSETS = 273
+TAG_SAMPLESPERPIXEL = 277
+TAG_ROWSPERSTRIP = 278
+TAG_STRIPBYTECOUNTS = 279
+TAG_PLANARCONFIG = 284
+TAG_TILEWIDTH = 322
+TAG_TILELENGTH = 323
+TAG_TILEOFFSETS = 324
+TAG_TILEBYTECOUNTS = 325
+
+# The numpy data type of each TIFF field type.  Rationals are read as pairs of
+# integers.
+FieldTypes = {
+    1: 'u1',   # BYTE
+    2: 'u1',   # ASCII
+    3: 'u2',   # SHORT
+    4: 'u4',   # LONG
+    5: 'u4',   # RATIONAL
+    6: 'i1',   # SBYTE
+    7: 'u1',   # UNDEFINED
+    8: 'i2',   # SSHORT
+    9: 'i4',   # SLONG
+    10: 'i4',  # SRATIONAL
+    11: 'f4',  # FLOAT
+    12: 'f8',  # DOUBLE
+    13: 'u4',  # IFD
+    16: 'u8',  # LONG8 (BigTIFF)
+    17: 'i8',  # SLONG8 (BigTIFF)
+    18: 'u8',  # IFD8 (BigTIFF)
+}
+RationalTypes = {5, 10}
+
+
+class TiffFile(object):
+    """
+    Read bytes and image file directories from a TIFF file without libtiff.
+    Reads are positional, so a single TiffFile can be used by many threads at
+    once.
+    """
+
+    def __init__(self, source):
+        """
+        Open a TIFF file and read its header.
+
+        :param source: the path or http or https URL of the TIFF file, or a
+            ByteSource to read it from.
+        :raises: IOError or OSError if the file can't be read, or ValueError
+            if it isn't a TIFF file.
+        """
+        # A byte source that is passed in belongs to the caller.
+        self._ownSource = not isinstance(source, ByteSource)
+        self.source = openByteSource(source)
+        self.path = self.source.path if self.source.path is not None else self.source.name
+        self._directoryOffsets = None
+        self._directories = {}
+        self._directoriesLock = threading.Lock()
+        try:
+            self._readHeader()
+        except Exception:
+            self.close()
+            raise
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Close the byte source if it was opened by this file.
+        """
+        source, self.source = getattr(self, 'source', None), None
+        if source is not None and self._ownSource:
+            source.close()
+
+    def read(self, offset, length):
+        """
+        Read bytes from the file.
+
+        :param offset: the position in the file to start reading.
+        :param length: the number of bytes to read.
+        :returns: the bytes read.  This is shorter than length if the end of
+            the file is reached.
+        """
+        return self.source.read(offset, length)
+
+    def _readHeader(self):
+        header = self.read(0, 16)
+        if header[:2] == b'II':
+            self.byteOrder = '<'
+        elif header[:2] == b'MM':
+            self.byteOrder = '>'
+        else:
+            raise ValueError('Not a TIFF file')
+        version = struct.unpack(self.byteOrder + 'H', header[2:4])[0]
+        if version == 42:
+            self.bigTiff = False
+            self._firstOffset = struct.unpack(self.byteOrder + 'I', header[4:8])[0]
+        elif version == 43:
+            self.bigTiff = True
+            self._firstOffset = struct.unpack(self.byteOrder + 'Q', header[8:16])[0]
+        else:
+            raise ValueError('Unknown TIFF version %d' % version)
+
+    @property
+    def directoryOffsets(self):
+        """
+        Get the file offsets of the image file directories in the main chain.
+        Subdirectories are not included, so the index in this list is the
+        same as libtiff's directory number.
+
+        :returns: a list of file offsets.
+        """
+        if self._directoryOffsets is None:
+            offsets = []
+            offset = self._firstOffset
+            countFormat, countSize, entrySize, nextFormat = self._ifdFormat()
+            while offset and offset not in offsets:
+                offsets.append(offset)
+                countData = self.read(offset, countSize)
+                if len(countData) < countSize:
+                    break
+                count = struct.unpack(self.byteOrder + countFormat, countData)[0]
+                nextData = self.read(offset + countSize + count * entrySize,
+                                     struct.calcsize(nextFormat))
+                if len(nextData) < struct.calcsize(nextFormat):
+                    break
+                offset = struct.unpack(self.byteOrder + nextFormat, nextData)[0]
+            self._directoryOffsets = offsets
+        return self._directoryOffsets
+
+    def _ifdFormat(self):
+        """
+        Get the structure of image file directories for this file.
+
+        :returns: the struct format of the entry count, the size of the entry
+            count, the size of each entry, and the struct format of the offset
+            of the next directory.
+        """
+        if self.bigTiff:
+            return 'Q', 8, 20, 'Q'
+        return 'H', 2, 12, 'I'
+
+    def directory(self, directoryNum, state=None):
+        """
+        Get an image file directory.  Directories are only parsed once.
+
+        :param directoryNum: the libtiff directory number.
+        :param state: if not None, the result of getState from a previous
+            index of this directory.  The directory is created from this
+            without reading the file.
+        :returns: a TiffDirectoryIndex.
+        :raises: ValueError if there is no such directory.
+        """
+        with self._directoriesLock:
+            if directoryNum not in self._directories and state is not None:
+                self._directories[directoryNum] = TiffDirectoryIndex(
+                    self, state['offset'], state)
+            if directoryNum not in self._directories:
+                offsets = self.directoryOffsets
+                if directoryNum < 0 or directoryNum >= len(offsets):
+                    raise ValueError('No TIFF directory %d' % directoryNum)
+                self._directories[directoryNum] = TiffDirectoryIndex(
+                    self, offsets[directoryNum])
+            return self._directories[directoryNum]
+
+
+class TiffDirectoryIndex(object):
+    """
+    The tags of one image file directory, with the locations of its tiles
+    held in numpy arrays so that tiles can be read without libtiff.  The
+    strips of a stripped image are treated as tiles that are as wide as the
+    image.
+    """
+
+    def __init__(self, tiffFile, offset, state=None):
+        """
+        Parse an image file directory.
+
+        :param tiffFile: the TiffFile that contains the directory.
+        :param offset: the file offset of the directory.
+        :param state: if not None, the result of getState from a previous
+            index of this directory, which is used instead of reading the
+            file.
+        :raises: ValueError if the directory can't be parsed or is neither
+            tiled nor stripped.
+        """
+        self.file = tiffFile
+        self.offset = offset
+        if state is not None:
+            self.tags = dict(state['tags'])
+        else:
+            self._readTags()
+
+        self.imageWidth = self.getTagValue(TAG_IMAGEWIDTH)
+        self.imageHeight = self.getTagValue(TAG_IMAGELENGTH)
+        self.tileWidth = self.getTagValue(TAG_TILEWIDTH)
+        self.tileHeight = self.getTagValue(TAG_TILELENGTH)
+        self.compression = self.getTagValue(TAG_COMPRESSION, 1)
+        self.stripped = (TAG_TILEOFFSETS not in self.tags and
+                         TAG_STRIPOFFSETS in self.tags)
+        if self.stripped and self.imageWidth and self.imageHeight:
+            self.tileWidth = self.imageWidth
+            self.tileHeight = min(
+                self.getTagValue(TAG_ROWSPERSTRIP) or self.imageHeight, self.imageHeight)
+        if not self.imageWidth or not self.imageHeight or \
+                not self.tileWidth or not self.tileHeight:
+            raise ValueError('Not a tiled or stripped TIFF directory')
+        self.tilesAcross = (self.imageWidth + self.tileWidth - 1) // self.tileWidth
+        self.tilesDown = (self.imageHeight + self.tileHeight - 1) // self.tileHeight
+        if state is not None:
+            self.tileOffsets = numpy.asarray(state['tileOffsets'], dtype=numpy.int64)
+            self.tileByteCounts = numpy.asarray(state['tileByteCounts'], dtype=numpy.int64)
+        else:
+            offsets = self.getTag(TAG_STRIPOFFSETS if self.stripped else TAG_TILEOFFSETS)
+            if offsets is None:
+                raise ValueError('Missing TIFF offsets')
+            self.tileOffsets = offsets.astype(numpy.int64)
+            byteCounts = self.getTag(
+                TAG_STRIPBYTECOUNTS if self.stripped else TAG_TILEBYTECOUNTS)
+            if byteCounts is None:
+                raise ValueError('Missing TIFF byte counts')
+            self.tileByteCounts = byteCounts.astype(numpy.int64)
+        tileCount = self.tilesAcross * self.tilesDown
+        if self.getTagValue(TAG_PLANARCONFIG, 1) == 2:
+            tileCount *= self.getTagValue(TAG_SAMPLESPERPIXEL, 1)
+        if (len(self.tileOffsets) != len(self.tileByteCounts) or
+                len(self.tileOffsets) < tileCount):
+            raise ValueError('Tile offsets do not match the image size')
+
+    def _readTags(self):
+        """
+        Read the tags of the directory from the file.
+        """
+        tiffFile = self.file
+        byteOrder = tiffFile.byteOrder
+        countFormat, countSize, entrySize, _ = tiffFile._ifdFormat()
+        count = struct.unpack(byteOrder + countFormat, tiffFile.read(self.offset, countSize))[0]
+        data = tiffFile.read(self.offset + countSize, count * entrySize)
+        if len(data) < count * entrySize:
+            raise ValueError('Truncated TIFF directory')
+        entryFormat = byteOrder + ('HHQ8s' if tiffFile.bigTiff else 'HHI4s')
+        # Each tag is stored as (type, count, raw value or offset)
+        self.tags = {}
+        for idx in range(count):
+            tag, fieldType, valueCount, value = struct.unpack_from(
+                entryFormat, data, idx * entrySize)
+            self.tags[tag] = (fieldType, valueCount, value)
+
+    def getState(self):
+        """
+        Get the parsed contents of the directory, so that it can be stored
+        and the index recreated without reading the file (see
+        TiffFile.directory).
+
+        :returns: a picklable dictionary.
+        """
+        return {
+            'offset': self.offset,
+            'tags': self.tags,
+            'tileOffsets': self.tileOffsets,
+            'tileByteCounts': self.tileByteCounts,
+        }
+
+    def getTag(self, tag):
+        """
+        Get the values of a tag.
+
+        :param tag: the numeric tag.
+        :returns: a numpy array of values, or None if the tag is not present.
+            Rational values are returned as pairs of numerators and
+            denominators.
+        """
+        if tag not in self.tags:
+            return None
+        fieldType, valueCount, value = self.tags[tag]
+        if fieldType not in FieldTypes:
+            raise ValueError('Unknown TIFF field type %d' % fieldType)
+        dtype = numpy.dtype(self.file.byteOrder + FieldTypes[fieldType])
+        length = valueCount * dtype.itemsize * (2 if fieldType in RationalTypes else 1)
+        if length <= len(value):
+            data = value[:length]
+        else:
+            offset = struct.unpack(
+                self.file.byteOrder + ('Q' if self.file.bigTiff else 'I'), value)[0]
+            data = self.file.read(offset, length)
+            if len(data) < length:
+                raise ValueError('Truncated TIFF tag %d' % tag)
+        values = numpy.frombuffer(data, dtype=dtype)
+        if fieldType in RationalTypes:
+            values = values.reshape(-1, 2)
+        return values
+
+    def getTagValue(self, tag, default=None):
+        """
+        Get the first value of a tag as a python number.
+
+        :param tag: the numeric tag.
+        :param default: the value to return if the tag is not present.
+        :returns: the value.
+        """
+        values = self.getTag(tag)
+        if values is None or not len(values):
+            return default
+        return values.flat[0].item()
+
+    def tileNumber(self, x, y):
+        """
+        Get the tile number of a tile from its column and row.
+
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :returns: the tile number, or None if the tile is outside of the
+            image.
+        """
+        if x < 0 or y < 0 or x >= self.tilesAcross or y >= self.tilesDown:
+            return None
+        return int(y) * self.tilesAcross + int(x)
+
+    def readTiles(self, tileNums, maxGap=65536, maxRead=16 * 1024 ** 2):
+        """
+        Read the raw data of several tiles with as few reads as possible.  The
+        tiles are sorted by their position in the file, and tiles that are no
+        more than maxGap bytes apart are read together; the bytes between them
+        are read and discarded.
+
+        :param tileNums: a list of tile numbers.
+        :param maxGap: the largest number of unused bytes between two tiles
+            that can be read together.
+        :param maxRead: tiles are not combined into reads larger than this
+            many bytes.
+        :returns: a dictionary of the bytes of each tile keyed by tile number.
+        :raises: IndexError if a tile number is out of range, or IOError if a
+            tile can't be read completely.
+        """
+        tileNums = numpy.unique(numpy.asarray(list(tileNums), dtype=numpy.int64))
+        if len(tileNums) and (tileNums[0] < 0 or tileNums[-1] >= len(self.tileOffsets)):
+            raise IndexError('Tile number out of range')
+        offsets = self.tileOffsets[tileNums]
+        sizes = self.tileByteCounts[tileNums]
+        results = {}
+        # Each group is a list of (tile number, offset, size) that is read
+        # from start to end.
+        group, start, end = [], 0, 0
+        for idx in numpy.argsort(offsets, kind='mergesort'):
+            tileNum, offset, size = int(tileNums[idx]), int(offsets[idx]), int(sizes[idx])
+            if not size:
+                results[tileNum] = b''
+                continue
+            if (not group or offset - end > maxGap or
+                    max(end, offset + size) - start > maxRead):
+                self._readGroup(group, start, end, results)
+                group, start, end = [], offset, offset + size
+            group.append((tileNum, offset, size))
+            end = max(end, offset + size)
+        self._readGroup(group, start, end, results)
+        return results
+
+    def _readGroup(self, group, start, end, results):
+        """
+        Read a range of the file that contains several tiles.
+
+        :param group: a list of (tile number, offset, size) tuples for tiles
+            that are within the range.
+        :param start: the file offset of the start of the range.
+        :param end: the file offset of the end of the range.
+        :param results: a dictionary to add the bytes of each tile to.
+        """
+        if not group:
+            return
+        data = self.file.read(start, end - start)
+        if len(data) < end - start:
+            raise IOError('Short read of tiles %d to %d' % (group[0][0], group[-1][0]))
+        if len(group) == 1:
+            results[group[0][0]] = data
+            return
+        for tileNum, offset, size in group:
+            results[tileNum] = data[offset - start:offset - start + size]
+
+    def readTile(self, tileNum):
+        """
+        Read the raw, still encoded, data of a tile.
+
+        :param tileNum: the tile number.
+        :returns: the bytes of the tile.
+        :raises: IndexError if the tile number is out of range, or IOError if
+            the tile can't be read completely.
+        """
+        if tileNum < 0 or tileNum >= len(self.tileOffsets):
+            raise IndexError('Tile number out of range')
+        size = int(self.tileByteCounts[tileNum])
+        data = self.file.read(int(self.tileOffsets[tileNum]), size)
+        if len(data) < size:
+            raise IOError('Short read of tile %d' % tileNum)
+        return data
@@ -18,14 +18,23 @@
 ###############################################################################
 
 import ctypes
+import numpy
 import os
+import re
 import six
+import sys
+import threading
+import zlib
 
 from collections import defaultdict
 from functools import partial
+from six.moves import cPickle as pickle
 from xml.etree import cElementTree
 
-from ..cache_util import LRUCache, strhash, methodcache
+from ..cache_util import LRUCache, strhash, methodcache, getConfig, getDecodedTileCache
+from .base import arrayToUint8
+from .byte_source import ByteSource, isRemotePath, openByteSource
+from .tiff_index import TiffFile, RationalTypes
 
 try:
     from girder import logger
@@ -52,6 +61,12 @@ except ImportError:
 # This suppress warnings about unknown tags
 libtiff_ctypes.suppress_warnings()
 
+# A description that starts with an OME root element.  These are kept as text
+# rather than converted to a dictionary, since they can list a great many
+# planes; the OME tile source parses them itself.
+_omeDescriptionPattern = re.compile(
+    r'\s*(<\?xml[^>]*\?>\s*)?(<!--.*?-->\s*)*<([\w.-]+:)?OME[\s>/]', re.S)
+
 
 def etreeToDict(t):
     """
@@ -97,10 +112,52 @@ def patchLibtiff():
     # BigTIFF 64-bit unsigned integer (offset)
     libtiff_ctypes.TIFFDataType.TIFF_IFD8 = 18
 
+    # Used to switch directly to a directory at a known file offset
+    libtiff_ctypes.libtiff.TIFFSetSubDirectory.restype = ctypes.c_int
+    libtiff_ctypes.libtiff.TIFFSetSubDirectory.argtypes = \
+        (libtiff_ctypes.TIFF, ctypes.c_uint64)
+
 
 patchLibtiff()
 
 
+# Compression schemes whose tiles are read as raw, still encoded, frames: JPEG
+# and the two Aperio JPEG 2000 variants.
+RawTileCompressions = {libtiff_ctypes.COMPRESSION_JPEG, 33003, 33005}
+# Compression schemes whose tiles are decoded to numpy arrays of the image's
+# own data type.
+ArrayTileCompressions = {
+    libtiff_ctypes.COMPRESSION_NONE, libtiff_ctypes.COMPRESSION_LZW,
+    libtiff_ctypes.COMPRESSION_ADOBE_DEFLATE, libtiff_ctypes.COMPRESSION_DEFLATE}
+# Deflate compressed tiles without a predictor are decoded with zlib
+DeflateCompressions = {
+    libtiff_ctypes.COMPRESSION_ADOBE_DEFLATE, libtiff_ctypes.COMPRESSION_DEFLATE}
+# Tags that mark a TIFF file as geospatial: ModelPixelScale, ModelTiepoint,
+# ModelTransformation, and GeoKeyDirectory
+GeoTiffTags = {33550, 33922, 34264, 34735}
+# Tags with a value for each sample that libtiff reports as a single value:
+# BitsPerSample, MinSampleValue, MaxSampleValue, SampleFormat,
+# SMinSampleValue, and SMaxSampleValue
+PerSampleTags = {258, 280, 281, 339, 340, 341}
+# The lowercase libtiff field names of each TIFF tag number
+TagFieldNames = defaultdict(list)
+for _key in dir(libtiff_ctypes.tiff_h):
+    if _key.startswith('TIFFTAG_') and isinstance(getattr(libtiff_ctypes.tiff_h, _key), int):
+        TagFieldNames[getattr(libtiff_ctypes.tiff_h, _key)].append(_key.split('_', 1)[1].lower())
+# The numpy data type kind of each TIFF sample format
+SampleFormatKinds = {
+    libtiff_ctypes.SAMPLEFORMAT_UINT: 'u',
+    libtiff_ctypes.SAMPLEFORMAT_INT: 'i',
+    libtiff_ctypes.SAMPLEFORMAT_IEEEFP: 'f',
+}
+
+# The argtypes of libtiff's TIFFGetField are shared by all TIFF handles, and
+# both pylibtiff and this module change them to read specific tags.  Hold this
+# lock from changing them until the call is complete.  When a directory's
+# _tiffLock is also needed, acquire that first.
+_getFieldLock = threading.RLock()
+
+
 class TiffException(Exception):
     pass
 
@@ -128,24 +185,190 @@ class ValidationTiffException(TiffException):
     pass
 
 
-class TiledTiffDirectory(object):
+class SharedTiffFile(object):
+    """
+    The open file used to read all of the directories of a TIFF file.  A
+    single libtiff handle is shared by the directories and is switched to the
+    directory that is being used, so the lock must be held while the handle
+    is used.  Raw tiles are read with positional reads through a single
+    TiffFile, which doesn't need the lock.  Files that aren't on the local
+    file system are only read through the TiffFile, since libtiff can't open
+    them.
+    """
 
     CoreFunctions = [
         'SetDirectory', 'GetField', 'LastDirectory', 'GetMode', 'IsTiled',
         'IsByteSwapped', 'IsUpSampled', 'IsMSB2LSB', 'NumberOfStrips'
     ]
 
-    def __init__(self, filePath, directoryNum, mustBeTiled=True):
+    def __init__(self, filePath):
+        """
+        Create a shared file.  Nothing is opened until it is needed, except
+        that the size of a file read over HTTP is checked.
+
+        :param filePath: A path to a TIFF file on disk, an http or https URL,
+            or a ByteSource.
+        :raises: IOTiffException if a URL can't be read.
+        """
+        # The byte source used for positional reads, if it was given
+        self.byteSource = None
+        if isRemotePath(filePath):
+            try:
+                filePath = openByteSource(filePath)
+            except (IOError, OSError) as exc:
+                raise IOTiffException('Could not open TIFF file %s: %s' % (filePath, exc))
+        if isinstance(filePath, ByteSource):
+            self.byteSource = filePath
+            filePath = filePath.path
+        # The local path of the file or None
+        self.filePath = filePath
+        self.name = str(filePath if self.byteSource is None else self.byteSource)
+        # A libtiff handle can only be used by one thread at a time.
+        self.lock = threading.RLock()
+        self._handle = None
+        self._directoryNum = None
+        self._tiffFile = None
+        self._tiffFileLock = threading.Lock()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Close the libtiff handle and the file used for raw reads.  They are
+        opened again if they are needed.
+        """
+        with self.lock:
+            if self._handle:
+                self._handle.close()
+            self._handle = None
+            self._directoryNum = None
+        with self._tiffFileLock:
+            if self._tiffFile:
+                self._tiffFile.close()
+            self._tiffFile = None
+
+    @property
+    def isLocal(self):
+        """
+        True if the file is on the local file system, so libtiff can read it.
+        """
+        return self.filePath is not None
+
+    def _open(self):
+        """
+        Open the libtiff handle.
+
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        if not self.isLocal:
+            raise IOTiffException('libtiff can only read local files, not %s' % self.name)
+        if not os.path.isfile(self.filePath):
+            raise InvalidOperationTiffException(
+                'TIFF file does not exist: %s' % self.filePath)
+        try:
+            bytePath = self.filePath
+            if not isinstance(bytePath, six.binary_type):
+                bytePath = self.filePath.encode('utf8')
+            handle = libtiff_ctypes.TIFF.open(bytePath)
+        except TypeError:
+            raise IOTiffException(
+                'Could not open TIFF file: %s' % self.filePath)
+        # pylibtiff changed the case of some functions between version 0.4 and
+        # the version that supports libtiff 4.0.6.  To support both, ensure
+        # that the cased functions exist.
+        for func in self.CoreFunctions:
+            if (not hasattr(handle, func) and
+                    hasattr(handle, func.lower())):
+                setattr(handle, func, getattr(handle, func.lower()))
+        self._handle = handle
+        self._directoryNum = None
+
+    def libtiffHandle(self, directoryNum):
+        """
+        Get the libtiff handle set to a directory, opening the file if needed.
+        The lock must be held for as long as the handle is used.
+
+        :param directoryNum: The number of the TIFF IFD to be used.
+        :type directoryNum: int
+        :return: the libtiff handle.
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        with self.lock:
+            if self._handle is None:
+                self._open()
+            if self._directoryNum != directoryNum:
+                self._directoryNum = None
+                offset = self.directoryOffset(directoryNum)
+                # SetDirectory follows the chain of directories from the start
+                # of the file, which is slow for files with many directories,
+                # so go straight to the directory when its offset is known.
+                if offset is not None:
+                    result = libtiff_ctypes.libtiff.TIFFSetSubDirectory(self._handle, offset)
+                else:
+                    result = self._handle.SetDirectory(directoryNum)
+                if result != 1:
+                    raise IOTiffException(
+                        'Could not set TIFF directory to %d' % directoryNum)
+                self._directoryNum = directoryNum
+            return self._handle
+
+    def directoryOffset(self, directoryNum):
+        """
+        Get the file offset of a directory from the TiffFile's list of
+        directories.
+
+        :param directoryNum: The number of the TIFF IFD.
+        :returns: the file offset or None if it isn't known.
+        """
+        try:
+            offsets = self.tiffFile().directoryOffsets
+        except (IOError, OSError, ValueError):
+            return None
+        if 0 <= directoryNum < len(offsets):
+            return offsets[directoryNum]
+        return None
+
+    def tiffFile(self):
+        """
+        Get the TiffFile used to read raw tiles, opening it if needed.
+
+        :return: a TiffFile.
+        :raises: IOError or OSError if the file can't be read, or ValueError
+            if it isn't a TIFF file.
+        """
+        with self._tiffFileLock:
+            if self._tiffFile is None:
+                self._tiffFile = TiffFile(
+                    self.byteSource if self.byteSource is not None else self.filePath)
+            return self._tiffFile
+
+
+class TiledTiffDirectory(object):
+
+    CoreFunctions = SharedTiffFile.CoreFunctions
+
+    def __init__(self, filePath, directoryNum, mustBeTiled=True, metadata=None,
+                 sharedFile=None):
         """
         Create a new reader for a tiled image file directory in a TIFF file.
 
-        :param filePath: A path to a TIFF file on disk.
-        :type filePath: str
+        :param filePath: A path to a TIFF file on disk, an http or https URL,
+            or a ByteSource.  Files that aren't on disk are read without
+            libtiff, so only uncompressed, deflate, and JPEG compressed images
+            validate.
         :param directoryNum: The number of the TIFF image file directory to
         open.
         :type directoryNum: int
         :param mustBeTiled: if True, only tiled images validate.  If False,
             only non-tiled images validate.  None validates both.
+        :param metadata: if not None, the result of getMetadataIndex from a
+            previous reader of this directory of an unchanged file.  The
+            directory isn't read or validated, and libtiff doesn't open the
+            file until it is needed.
+        :param sharedFile: the SharedTiffFile used to read this file.  All
+            directories of a file should use the same one.  If None, this
+            directory uses its own.
         :raises: InvalidOperationTiffException or IOTiffException or
         ValidationTiffException
         """
@@ -156,9 +379,22 @@ class TiledTiffDirectory(object):
         self.cache = LRUCache(10)
         self._mustBeTiled = mustBeTiled
 
-        self._tiffFile = None
-
-        self._open(filePath, directoryNum)
+        self._filePath = filePath
+        self._directoryNum = directoryNum
+        self._sharedFile = sharedFile if sharedFile is not None else SharedTiffFile(filePath)
+        self._tileIndex = None
+        self._jpegTables = None
+        # The libtiff handle is shared by all directories of the file, so
+        # this is held while it is used.  Reads through the tile index don't
+        # need this.
+        self._tiffLock = self._sharedFile.lock
+        # Raw tiles read by prefetchRawTiles for use by the same thread
+        self._prefetched = threading.local()
+
+        if metadata is not None:
+            self._restoreMetadata(metadata)
+            return
+        self._open()
         self._loadMetadata()
         logger.debug('TiffDirectory %d Information %r',
                      directoryNum, self._tiffInfo)
@@ -167,51 +403,143 @@ class TiledTiffDirectory(object):
         except ValidationTiffException:
             self._close()
             raise
+        if (self._tiffInfo.get('istiled') and
+                self._tiffInfo.get('compression') in (
+                    RawTileCompressions | ArrayTileCompressions)):
+            self._openTileIndex(filePath)
 
     def __del__(self):
         self._close()
 
-    def _open(self, filePath, directoryNum):
+    def _open(self):
         """
-        Open a TIFF file to a given file and IFD number.
+        Check that the TIFF file and this directory can be opened.
 
-        :param filePath: A path to a TIFF file on disk.
-        :type filePath: str
-        :param directoryNum: The number of the TIFF IFD to be used.
-        :type directoryNum: int
-        :raises: InvalidOperationTiffException or IOTiffException
+        :raises: InvalidOperationTiffException or IOTiffException or
+        ValidationTiffException
         """
-        self._close()
-        if not os.path.isfile(filePath):
-            raise InvalidOperationTiffException(
-                'TIFF file does not exist: %s' % filePath)
+        if self._sharedFile.isLocal:
+            self._sharedFile.libtiffHandle(self._directoryNum)
+            return
         try:
-            bytePath = filePath
-            if not isinstance(bytePath, six.binary_type):
-                bytePath = filePath.encode('utf8')
-            self._tiffFile = libtiff_ctypes.TIFF.open(bytePath)
-        except TypeError:
+            tiffFile = self._sharedFile.tiffFile()
+        except (IOError, OSError, ValueError) as exc:
             raise IOTiffException(
-                'Could not open TIFF file: %s' % filePath)
-        # pylibtiff changed the case of some functions between version 0.4 and
-        # the version that supports libtiff 4.0.6.  To support both, ensure
-        # that the cased functions exist.
-        for func in self.CoreFunctions:
-            if (not hasattr(self._tiffFile, func) and
-                    hasattr(self._tiffFile, func.lower())):
-                setattr(self._tiffFile, func, getattr(
-                    self._tiffFile, func.lower()))
-
-        self._directoryNum = directoryNum
-        if self._tiffFile.SetDirectory(self._directoryNum) != 1:
-            self._tiffFile.close()
+                'Could not open TIFF file %s: %s' % (self._sharedFile.name, exc))
+        if not 0 <= self._directoryNum < len(tiffFile.directoryOffsets):
             raise IOTiffException(
-                'Could not set TIFF directory to %d' % directoryNum)
+                'Could not set TIFF directory to %d' % self._directoryNum)
+        try:
+            tiffFile.directory(self._directoryNum)
+        except (IOError, OSError, ValueError) as exc:
+            raise ValidationTiffException(
+                'Could not read TIFF directory %d: %s' % (self._directoryNum, exc))
+
+    @property
+    def _tiffFile(self):
+        """
+        The libtiff handle, set to this directory.  This must only be used
+        while holding _tiffLock, since other directories of the file share
+        it.
+        """
+        return self._sharedFile.libtiffHandle(self._directoryNum)
 
     def _close(self):
-        if self._tiffFile:
-            self._tiffFile.close()
-            self._tiffFile = None
+        # The shared file is closed when no directory is using it.
+        self._tileIndex = None
+
+    def _openTileIndex(self, filePath):
+        """
+        Read the locations of this directory's tiles so that raw tiles can be
+        read without libtiff.  If the index can't be read or doesn't agree
+        with libtiff, libtiff is used to read tiles instead.
+
+        :param filePath: The TIFF file, used in messages.
+        """
+        try:
+            tileIndex = self._sharedFile.tiffFile().directory(self._directoryNum)
+        except (IOError, OSError, ValueError) as exc:
+            logger.debug('Cannot index TIFF directory %d of %s: %s',
+                         self._directoryNum, filePath, exc)
+            return
+        if self._sharedFile.isLocal:
+            with self._tiffLock:
+                numberOfTiles = libtiff_ctypes.libtiff.TIFFNumberOfTiles(self._tiffFile).value
+        else:
+            # Without libtiff, the index is all there is to go on
+            numberOfTiles = len(tileIndex.tileOffsets)
+        if (tileIndex.tileWidth != self._tileWidth or
+                tileIndex.tileHeight != self._tileHeight or
+                tileIndex.imageWidth != self._imageWidth or
+                tileIndex.imageHeight != self._imageHeight or
+                len(tileIndex.tileOffsets) != numberOfTiles):
+            logger.debug('TIFF directory %d of %s has an inconsistent tile index',
+                         self._directoryNum, filePath)
+            return
+        self._tileIndex = tileIndex
+
+    def getMetadataIndex(self):
+        """
+        Get the information that was read from this directory, so that it can
+        be stored and used to create a reader for the same directory without
+        reading the file again (see the metadata parameter of the
+        constructor).
+
+        :returns: a picklable dictionary.
+        """
+        tiffInfo = {}
+        for key, value in six.iteritems(self._tiffInfo):
+            # Some libtiff fields are returned as ctypes values; these aren't
+            # needed after the directory is validated.
+            try:
+                pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                continue
+            tiffInfo[key] = value
+        jpegTables = None
+        # Tiles of tiled JPEG images use the shared tables
+        if (self._tiffInfo.get('istiled') and
+                self._tiffInfo.get('compression') == libtiff_ctypes.COMPRESSION_JPEG and
+                not getattr(self, '_completeJpeg', False)):
+            jpegTables = self._getJpegTables()
+        return {
+            'directoryNum': self._directoryNum,
+            'mustBeTiled': self._mustBeTiled,
+            'tiffInfo': tiffInfo,
+            'pixelInfo': self._pixelInfo,
+            'embeddedImages': self._embeddedImages,
+            'descriptionXml': getattr(self, '_description_xml', None),
+            'completeJpeg': getattr(self, '_completeJpeg', False),
+            'jpegTables': jpegTables,
+            'tileIndex': self._tileIndex.getState() if self._tileIndex is not None else None,
+        }
+
+    def _restoreMetadata(self, metadata):
+        """
+        Set up this reader from the result of getMetadataIndex without reading
+        the file.  libtiff opens the file if it is needed later.
+
+        :param metadata: the dictionary from getMetadataIndex.
+        """
+        info = self._tiffInfo = dict(metadata['tiffInfo'])
+        self._tileWidth = info.get('tilewidth')
+        self._tileHeight = info.get('tilelength')
+        self._imageWidth = info.get('imagewidth')
+        self._imageHeight = info.get('imagelength')
+        self._pixelInfo = metadata['pixelInfo']
+        self._embeddedImages = metadata['embeddedImages']
+        if metadata.get('descriptionXml') is not None:
+            self._description_xml = metadata['descriptionXml']
+        if metadata.get('completeJpeg'):
+            self._completeJpeg = True
+        self._jpegTables = metadata.get('jpegTables')
+        if metadata.get('tileIndex') is not None:
+            try:
+                self._tileIndex = self._sharedFile.tiffFile().directory(
+                    self._directoryNum, metadata['tileIndex'])
+            except (IOError, OSError, ValueError) as exc:
+                logger.debug('Cannot use the stored index of TIFF directory %d of %s: %s',
+                             self._directoryNum, self._filePath, exc)
 
     def _validate(self):  # noqa
         """
@@ -233,17 +561,24 @@ class TiledTiffDirectory(object):
             raise ValidationTiffException(
                 'Only RGB and greyscale TIFF files are supported')
 
-        if (self._tiffInfo.get('bitspersample') != 8 and (
-                self._tiffInfo.get('compression') != libtiff_ctypes.COMPRESSION_NONE or
-                self._tiffInfo.get('bitspersample') != 16)):
-            raise ValidationTiffException(
-                'Only single-byte sampled TIFF files are supported')
-
-        if self._tiffInfo.get('sampleformat') not in {
-                None,  # default is still SAMPLEFORMAT_UINT
-                libtiff_ctypes.SAMPLEFORMAT_UINT}:
-            raise ValidationTiffException(
-                'Only unsigned int sampled TIFF files are supported')
+        # The default sample format is SAMPLEFORMAT_UINT
+        sampleFormat = self._tiffInfo.get('sampleformat') or libtiff_ctypes.SAMPLEFORMAT_UINT
+        if self._tiffInfo.get('compression') not in ArrayTileCompressions:
+            if self._tiffInfo.get('bitspersample') != 8:
+                raise ValidationTiffException(
+                    'Only single-byte sampled JPEG compressed TIFF files are supported')
+            if sampleFormat != libtiff_ctypes.SAMPLEFORMAT_UINT:
+                raise ValidationTiffException(
+                    'Only unsigned int sampled JPEG compressed TIFF files are supported')
+        else:
+            if sampleFormat not in SampleFormatKinds:
+                raise ValidationTiffException(
+                    'Only integer and floating point sampled TIFF files are supported')
+            if self._tiffInfo.get('bitspersample') not in (
+                    (32, 64) if sampleFormat == libtiff_ctypes.SAMPLEFORMAT_IEEEFP else
+                    (8, 16, 32, 64)):
+                raise ValidationTiffException(
+                    'Only TIFF files with a whole number of bytes per sample are supported')
 
         if (self._tiffInfo.get('planarconfig') != libtiff_ctypes.PLANARCONFIG_CONTIG and
                 self._tiffInfo.get('photometric') not in {
@@ -263,16 +598,21 @@ class TiledTiffDirectory(object):
             raise ValidationTiffException(
                 'Only top-left orientation TIFF files are supported')
 
-        if self._tiffInfo.get('compression') not in {
-                libtiff_ctypes.COMPRESSION_NONE,
-                libtiff_ctypes.COMPRESSION_JPEG,
-                33003, 33005}:
+        if self._tiffInfo.get('compression') not in (
+                RawTileCompressions | ArrayTileCompressions):
             raise ValidationTiffException(
-                'Only uncompressed and JPEG compressed TIFF files are supported')
-        if (not self._tiffInfo.get('istiled') or
-                not self._tiffInfo.get('tilewidth') or
-                not self._tiffInfo.get('tilelength')):
-            raise ValidationTiffException('Only tiled TIFF files are supported')
+                'Only uncompressed, LZW, deflate, and JPEG compressed TIFF files '
+                'are supported')
+        # Without libtiff, only tiles that are stored raw or can be decoded
+        # with zlib can be read.
+        if not self._sharedFile.isLocal and (
+                self._tiffInfo.get('compression') == libtiff_ctypes.COMPRESSION_LZW or
+                (self._tiffInfo.get('compression') in DeflateCompressions and
+                 (self._tiffInfo.get('predictor') or 1) != 1)):
+            raise ValidationTiffException(
+                'Only uncompressed, deflate without a predictor, and JPEG compressed '
+                'TIFF files can be read from files that are not on disk')
+        self._validateLayout()
 
         if (self._tiffInfo.get('compression') == libtiff_ctypes.COMPRESSION_JPEG and
                 self._tiffInfo.get('jpegtablesmode') !=
@@ -288,25 +628,22 @@ class TiledTiffDirectory(object):
             except IOTiffException:
                 self._completeJpeg = True
 
+    def _validateLayout(self):
+        """
+        Validate that the image is stored in a way this reader can use.
+
+        :raises: ValidationTiffException
+        """
+        if (not self._tiffInfo.get('istiled') or
+                not self._tiffInfo.get('tilewidth') or
+                not self._tiffInfo.get('tilelength')):
+            raise ValidationTiffException('Only tiled TIFF files are supported')
+
     def _loadMetadata(self):
-        fields = [key.split('_', 1)[1].lower() for key in
-                  dir(libtiff_ctypes.tiff_h) if key.startswith('TIFFTAG_')]
-        info = {}
-        for field in fields:
-            try:
-                value = self._tiffFile.GetField(field)
-                if value is not None:
-                    info[field] = value
-            except TypeError as err:
-                logger.debug('Loading field "%s" in directory number %d '
-                             'resulted in TypeError - "%s"',
-                             field, self._directoryNum, err)
-
-        for func in self.CoreFunctions[2:]:
-            if hasattr(self._tiffFile, func):
-                value = getattr(self._tiffFile, func)()
-                if value:
-                    info[func.lower()] = value
+        if self._sharedFile.isLocal:
+            info = self._readLibtiffFields()
+        else:
+            info = self._readIndexedFields()
         self._tiffInfo = info
         self._tileWidth = info.get('tilewidth')
         self._tileHeight = info.get('tilelength')
@@ -331,6 +668,81 @@ class TiledTiffDirectory(object):
         if not self._pixelInfo.get('height') and info.get('imagelength'):
             self._pixelInfo['height'] = info['imagelength']
 
+    def _readLibtiffFields(self):
+        """
+        Read the fields of this directory with libtiff.
+
+        :returns: a dictionary of field values keyed by lowercase libtiff
+            field names.
+        """
+        fields = [key.split('_', 1)[1].lower() for key in
+                  dir(libtiff_ctypes.tiff_h) if key.startswith('TIFFTAG_')]
+        info = {}
+        with self._tiffLock:
+            tiffFile = self._tiffFile
+            with _getFieldLock:
+                for field in fields:
+                    try:
+                        value = tiffFile.GetField(field)
+                        if value is not None:
+                            info[field] = value
+                    except TypeError as err:
+                        logger.debug('Loading field "%s" in directory number %d '
+                                     'resulted in TypeError - "%s"',
+                                     field, self._directoryNum, err)
+
+            for func in self.CoreFunctions[2:]:
+                if hasattr(tiffFile, func):
+                    value = getattr(tiffFile, func)()
+                    if value:
+                        info[func.lower()] = value
+        return info
+
+    def _readIndexedFields(self):
+        """
+        Read the fields of this directory from its tags without libtiff.
+        Fields are named and have values as libtiff would give them for the
+        fields this reader uses: text is bytes up to the first null, rationals
+        are floats, and only the first value of multi-valued fields that
+        libtiff reports per image (such as bits per sample) is kept.  Other
+        fields with several values are omitted.
+
+        :returns: a dictionary of field values keyed by lowercase libtiff
+            field names.
+        """
+        index = self._sharedFile.tiffFile().directory(self._directoryNum)
+        info = {}
+        for tag, (fieldType, _, _) in six.iteritems(index.tags):
+            names = TagFieldNames.get(tag)
+            if not names:
+                continue
+            try:
+                values = index.getTag(tag)
+            except (IOError, OSError, ValueError) as exc:
+                logger.debug('Loading tag %d in directory number %d failed - "%s"',
+                             tag, self._directoryNum, exc)
+                continue
+            if fieldType == 2:  # ASCII
+                value = values.tobytes().split(b'\0', 1)[0]
+            elif not len(values) or (len(values) > 1 and tag not in PerSampleTags):
+                continue
+            elif fieldType in RationalTypes:
+                value = float(values[0][0]) / values[0][1] if values[0][1] else 0.0
+            else:
+                value = values.flat[0].item()
+            for name in names:
+                info[name] = value
+        info['istiled'] = not index.stripped
+        if index.stripped:
+            info['numberofstrips'] = len(index.tileOffsets)
+        if index.file.byteOrder != ('<' if sys.byteorder == 'little' else '>'):
+            info['isbyteswapped'] = 1
+        # libtiff reports its default for this pseudo-tag
+        if info.get('compression') == libtiff_ctypes.COMPRESSION_JPEG:
+            info['jpegtablesmode'] = (
+                libtiff_ctypes.JPEGTABLESMODE_QUANT | libtiff_ctypes.JPEGTABLESMODE_HUFF)
+        return info
+
     @methodcache(key=partial(strhash, '_getJpegTables'))
     def _getJpegTables(self):
         """
@@ -344,6 +756,11 @@ class TiledTiffDirectory(object):
         :rtype: bytes
         :raises: Exception
         """
+        if self._jpegTables is not None:
+            return self._jpegTables
+        if not self._sharedFile.isLocal:
+            tableBuffer = self._readIndexedJpegTables()
+            return self._checkJpegTables(tableBuffer, len(tableBuffer))
         # TIFFTAG_JPEGTABLES uses (uint32*, void**) output arguments
         # http://www.remotesensing.org/libtiff/man/TIFFGetField.3tiff.html
 
@@ -355,20 +772,52 @@ class TiledTiffDirectory(object):
         # what is needed for our specific call.  Other versions do not set
         # argtypes, allowing any types to be passed without validation, in
         # which case we do not need to alter the list.
-        if libtiff_ctypes.libtiff.TIFFGetField.argtypes:
-            libtiff_ctypes.libtiff.TIFFGetField.argtypes = \
-                libtiff_ctypes.libtiff.TIFFGetField.argtypes[:2] + \
-                [ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_void_p)]
-        if libtiff_ctypes.libtiff.TIFFGetField(
-                self._tiffFile,
-                libtiff_ctypes.TIFFTAG_JPEGTABLES,
-                ctypes.byref(tableSize),
-                ctypes.byref(tableBuffer)) != 1:
+        with self._tiffLock, _getFieldLock:
+            if libtiff_ctypes.libtiff.TIFFGetField.argtypes:
+                libtiff_ctypes.libtiff.TIFFGetField.argtypes = \
+                    libtiff_ctypes.libtiff.TIFFGetField.argtypes[:2] + \
+                    [ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_void_p)]
+            if libtiff_ctypes.libtiff.TIFFGetField(
+                    self._tiffFile,
+                    libtiff_ctypes.TIFFTAG_JPEGTABLES,
+                    ctypes.byref(tableSize),
+                    ctypes.byref(tableBuffer)) != 1:
+                raise IOTiffException('Could not get JPEG Huffman / quantization tables')
+
+            tableSize = tableSize.value
+            # The buffer belongs to the libtiff handle, so copy it while we
+            # hold the handle's lock.
+            tableBuffer = ctypes.string_at(tableBuffer, tableSize)
+        return self._checkJpegTables(tableBuffer, tableSize)
+
+    def _readIndexedJpegTables(self):
+        """
+        Read the JPEG tables tag of this directory without libtiff.
+
+        :return: the contents of the tag.
+        :rtype: bytes
+        :raises: IOTiffException
+        """
+        try:
+            tables = self._sharedFile.tiffFile().directory(self._directoryNum).getTag(
+                libtiff_ctypes.TIFFTAG_JPEGTABLES)
+        except (IOError, OSError, ValueError) as exc:
+            raise IOTiffException('Could not read JPEG Huffman / quantization tables: %s' % exc)
+        if tables is None:
             raise IOTiffException('Could not get JPEG Huffman / quantization tables')
+        return tables.tobytes()
 
-        tableSize = tableSize.value
-        tableBuffer = ctypes.cast(tableBuffer, ctypes.POINTER(ctypes.c_char))
+    def _checkJpegTables(self, tableBuffer, tableSize):
+        """
+        Check that JPEG tables have the expected markers and remove the Start
+        and End Of Image markers.
 
+        :param tableBuffer: the contents of the JPEG tables tag.
+        :param tableSize: the length of the tables.
+        :return: the tables without Start and End Of Image markers.
+        :rtype: bytes
+        :raises: IOTiffException
+        """
         if tableBuffer[:2] != b'\xff\xd8':
             raise IOTiffException('Missing JPEG Start Of Image marker in'
                                   ' tables')
@@ -394,6 +843,12 @@ class TiledTiffDirectory(object):
         :rtype int
         :raises: InvalidOperationTiffException
         """
+        if self._tileIndex is not None:
+            tileNum = self._tileIndex.tileNumber(x, y)
+            if tileNum is None:
+                raise InvalidOperationTiffException(
+                    'Tile x=%d, y=%d does not exist' % (x, y))
+            return tileNum
         # TIFFCheckTile and TIFFComputeTile require pixel coordinates
         pixelX = int(x * self._tileWidth)
         pixelY = int(y * self._tileHeight)
@@ -401,13 +856,14 @@ class TiledTiffDirectory(object):
         if pixelX >= self._imageWidth or pixelY >= self._imageHeight:
             raise InvalidOperationTiffException(
                 'Tile x=%d, y=%d does not exist' % (x, y))
-        if libtiff_ctypes.libtiff.TIFFCheckTile(
-                self._tiffFile, pixelX, pixelY, 0, 0) == 0:
-            raise InvalidOperationTiffException(
-                'Tile x=%d, y=%d does not exist' % (x, y))
-
-        tileNum = libtiff_ctypes.libtiff.TIFFComputeTile(
-            self._tiffFile, pixelX, pixelY, 0, 0).value
+        with self._tiffLock:
+            if libtiff_ctypes.libtiff.TIFFCheckTile(
+                    self._tiffFile, pixelX, pixelY, 0, 0) == 0:
+                raise InvalidOperationTiffException(
+                    'Tile x=%d, y=%d does not exist' % (x, y))
+
+            tileNum = libtiff_ctypes.libtiff.TIFFComputeTile(
+                self._tiffFile, pixelX, pixelY, 0, 0).value
         return tileNum
 
     @methodcache(key=partial(strhash, '_getTileByteCountsType'))
@@ -419,8 +875,9 @@ class TiledTiffDirectory(object):
         :rtype: ctypes.c_uint64 or ctypes.c_uint16
         :raises: IOTiffException
         """
-        tileByteCountsFieldInfo = libtiff_ctypes.libtiff.TIFFFieldWithTag(
-            self._tiffFile, libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS).contents
+        with self._tiffLock:
+            tileByteCountsFieldInfo = libtiff_ctypes.libtiff.TIFFFieldWithTag(
+                self._tiffFile, libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS).contents
         tileByteCountsLibtiffType = tileByteCountsFieldInfo.field_type
 
         if tileByteCountsLibtiffType == libtiff_ctypes.TIFFDataType.TIFF_LONG8:
@@ -435,6 +892,7 @@ class TiledTiffDirectory(object):
     def _getJpegFrameSize(self, tileNum):
         """
         Get the file size in bytes of the raw encoded JPEG frame for a tile.
+        This must be called while holding the directory's _tiffLock.
 
         :param tileNum: The internal tile number of the desired tile.
         :type tileNum: int
@@ -465,40 +923,52 @@ class TiledTiffDirectory(object):
         # what is needed for our specific call.  Other versions do not set
         # argtypes, allowing any types to be passed without validation, in
         # which case we do not need to alter the list.
-        if libtiff_ctypes.libtiff.TIFFGetField.argtypes:
-            libtiff_ctypes.libtiff.TIFFGetField.argtypes = \
-                libtiff_ctypes.libtiff.TIFFGetField.argtypes[:2] + \
-                [ctypes.POINTER(ctypes.POINTER(rawTileSizesType))]
-        if libtiff_ctypes.libtiff.TIFFGetField(
-                self._tiffFile,
-                libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS,
-                ctypes.byref(rawTileSizes)) != 1:
-            raise IOTiffException('Could not get raw tile size')
+        with _getFieldLock:
+            if libtiff_ctypes.libtiff.TIFFGetField.argtypes:
+                libtiff_ctypes.libtiff.TIFFGetField.argtypes = \
+                    libtiff_ctypes.libtiff.TIFFGetField.argtypes[:2] + \
+                    [ctypes.POINTER(ctypes.POINTER(rawTileSizesType))]
+            if libtiff_ctypes.libtiff.TIFFGetField(
+                    self._tiffFile,
+                    libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS,
+                    ctypes.byref(rawTileSizes)) != 1:
+                raise IOTiffException('Could not get raw tile size')
 
         # In practice, this will never overflow, and it's simpler to convert the
         # long to an int
         return int(rawTileSizes[tileNum])
 
-    def _getJpegFrame(self, tileNum, entire=False):
+    def _readRawTile(self, tileNum):
         """
-        Get the raw encoded JPEG image frame from a tile.
+        Read the raw encoded data of a tile.  If the tile index is available,
+        this reads directly from the file; otherwise libtiff is used.
 
         :param tileNum: The internal tile number of the desired tile.
         :type tileNum: int
-        :param entire: True to return the entire frame.  False to strip off
-            container information.
-        :return: The JPEG image frame, including a JPEG Start Of Frame marker.
+        :return: The raw tile data.
         :rtype: bytes
         :raises: InvalidOperationTiffException or IOTiffException
         """
-        # This raises an InvalidOperationTiffException if the tile doesn't exist
-        rawTileSize = self._getJpegFrameSize(tileNum)
-
-        frameBuffer = ctypes.create_string_buffer(rawTileSize)
-
-        bytesRead = libtiff_ctypes.libtiff.TIFFReadRawTile(
-            self._tiffFile, tileNum,
-            frameBuffer, rawTileSize).value
+        rawTiles = getattr(self._prefetched, 'rawTiles', None)
+        if rawTiles and tileNum in rawTiles:
+            return rawTiles[tileNum]
+        if self._tileIndex is not None:
+            try:
+                return self._tileIndex.readTile(tileNum)
+            except IndexError:
+                raise InvalidOperationTiffException('Tile number out of range')
+            except (IOError, OSError) as exc:
+                raise IOTiffException('Failed to read raw tile: %s' % exc)
+        with self._tiffLock:
+            # This raises an InvalidOperationTiffException if the tile doesn't
+            # exist
+            rawTileSize = self._getJpegFrameSize(tileNum)
+
+            frameBuffer = ctypes.create_string_buffer(rawTileSize)
+
+            bytesRead = libtiff_ctypes.libtiff.TIFFReadRawTile(
+                self._tiffFile, tileNum,
+                frameBuffer, rawTileSize).value
         if bytesRead == -1:
             raise IOTiffException('Failed to read raw tile')
         elif bytesRead < rawTileSize:
@@ -507,33 +977,201 @@ class TiledTiffDirectory(object):
             # It's unlikely that this will ever occur, but incomplete reads will
             # be checked for by looking for the JPEG end marker
             raise IOTiffException('Buffer overflow when reading tile')
+        return frameBuffer.raw
+
+    def readRawTiles(self, tiles):
+        """
+        Read the raw encoded data of several tiles with as few reads as
+        possible.  Tiles that are near each other in the file are read
+        together if the unused bytes between them are no more than the
+        tiff_coalesce_gap_bytes config value (64 kB by default).
+
+        :param tiles: a list of (x, y) tile positions.
+        :return: a dictionary of raw tile data keyed by internal tile number.
+            Tiles that don't exist are omitted.  If the tile index isn't
+            available or the read fails, this is empty.
+        :rtype: dict
+        """
+        if self._tileIndex is None:
+            return {}
+        tileNums = [self._tileIndex.tileNumber(x, y) for x, y in tiles]
+        return self._readIndexedTiles(
+            [tileNum for tileNum in tileNums if tileNum is not None])
+
+    def _readIndexedTiles(self, tileNums):
+        """
+        Read the raw data of tiles through the tile index, combining reads of
+        nearby tiles (see readRawTiles).
+
+        :param tileNums: a list of internal tile numbers.
+        :return: a dictionary of raw tile data keyed by internal tile number,
+            or an empty dictionary if the read fails.
+        :rtype: dict
+        """
+        try:
+            maxGap = int(getConfig('tiff_coalesce_gap_bytes', 65536))
+        except (TypeError, ValueError):
+            maxGap = 65536
+        try:
+            return self._tileIndex.readTiles(tileNums, maxGap)
+        except (IOError, OSError, IndexError) as exc:
+            logger.debug('Failed to read raw tiles of TIFF directory %d: %s',
+                         self._directoryNum, exc)
+            return {}
+
+    def prefetchRawTiles(self, tiles):
+        """
+        Read the raw data of several tiles with readRawTiles and keep it for
+        getTile calls made by the current thread until
+        clearPrefetchedRawTiles is called.
+
+        :param tiles: a list of (x, y) tile positions.
+        """
+        self._prefetched.rawTiles = self.readRawTiles(tiles)
+
+    def clearPrefetchedRawTiles(self):
+        """
+        Discard the raw tiles read by prefetchRawTiles in the current thread.
+        """
+        self._prefetched.rawTiles = None
+
+    def _getJpegFrame(self, tileNum, entire=False):
+        """
+        Get the raw encoded JPEG image frame from a tile.
+
+        :param tileNum: The internal tile number of the desired tile.
+        :type tileNum: int
+        :param entire: True to return the entire frame.  False to strip off
+            container information.
+        :return: The JPEG image frame, including a JPEG Start Of Frame marker.
+        :rtype: bytes
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        frame = self._readRawTile(tileNum)
         if entire:
-            return frameBuffer.raw[:]
+            return frame
 
-        if frameBuffer.raw[:2] != b'\xff\xd8':
+        if frame[:2] != b'\xff\xd8':
             raise IOTiffException('Missing JPEG Start Of Image marker in frame')
-        if frameBuffer.raw[-2:] != b'\xff\xd9':
+        if frame[-2:] != b'\xff\xd9':
             raise IOTiffException('Missing JPEG End Of Image marker in frame')
-        if frameBuffer.raw[2:4] in (b'\xff\xc0', b'\xff\xc2'):
+        if frame[2:4] in (b'\xff\xc0', b'\xff\xc2'):
             frameStartPos = 2
         else:
             # VIPS may encode TIFFs with the quantization (but not Huffman)
             # tables also at the start of every frame, so locate them for
             # removal
             # VIPS seems to prefer Baseline DCT, so search for that first
-            frameStartPos = frameBuffer.raw.find(b'\xff\xc0', 2, -2)
+            frameStartPos = frame.find(b'\xff\xc0', 2, -2)
             if frameStartPos == -1:
-                frameStartPos = frameBuffer.raw.find(b'\xff\xc2', 2, -2)
+                frameStartPos = frame.find(b'\xff\xc2', 2, -2)
                 if frameStartPos == -1:
                     raise IOTiffException('Missing JPEG Start Of Frame marker')
 
         # Strip the Start / End Of Image markers
-        tileData = frameBuffer.raw[frameStartPos:-2]
+        tileData = frame[frameStartPos:-2]
         return tileData
 
+    @property
+    def hasTileArrays(self):
+        """
+        True if tiles can be read as numpy arrays of the image's own data type
+        with getTileArray.
+        """
+        return self._tiffInfo.get('compression') in ArrayTileCompressions
+
+    @property
+    def tileArrayDtype(self):
+        """
+        The numpy data type of the samples of tiles from getTileArray.
+        """
+        kind = SampleFormatKinds.get(
+            self._tiffInfo.get('sampleformat') or libtiff_ctypes.SAMPLEFORMAT_UINT, 'u')
+        return numpy.dtype('%s%d' % (kind, (self._tiffInfo.get('bitspersample') or 8) // 8))
+
+    def getTileArray(self, x, y):
+        """
+        Get a tile as a numpy array with the image's own data type and samples
+        per pixel.  Uncompressed tiles are a view of the data read from the
+        file; LZW and deflate compressed tiles are a view of the decompressed
+        data.
+
+        :param x: The column index of the desired tile.
+        :type x: int
+        :param y: The row index of the desired tile.
+        :type y: int
+        :return: a tileHeight x tileWidth array for single sample images or a
+            tileHeight x tileWidth x samples per pixel array.
+        :rtype: numpy.ndarray
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        if not self.hasTileArrays:
+            raise InvalidOperationTiffException(
+                'Tiles of this directory cannot be read as arrays')
+        # This raises an InvalidOperationTiffException if the tile doesn't exist
+        return self._getTileArray(self._toTileNum(x, y))
+
+    def _getTileArray(self, tileNum):
+        """
+        Get a tile as a numpy array.  See getTileArray.
+
+        :param tileNum: The internal tile number of the desired tile.
+        :type tileNum: int
+        :return: the tile.
+        :rtype: numpy.ndarray
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        compression = self._tiffInfo.get('compression')
+        samples = self._tiffInfo.get('samplesperpixel') or 1
+        if (self._tileIndex is not None and
+                compression == libtiff_ctypes.COMPRESSION_NONE):
+            data = self._readRawTile(tileNum)
+            byteOrder = self._tileIndex.file.byteOrder
+        elif (self._tileIndex is not None and compression in DeflateCompressions and
+                (self._tiffInfo.get('predictor') or 1) == 1):
+            try:
+                data = zlib.decompress(self._readRawTile(tileNum))
+            except zlib.error as exc:
+                raise IOTiffException('Failed to decompress tile: %s' % exc)
+            byteOrder = self._tileIndex.file.byteOrder
+        else:
+            # libtiff decompresses the tile, undoes any predictor, and swaps
+            # the bytes to the native order.
+            data = self._readEncodedTile(tileNum)
+            byteOrder = '='
+        dtype = self.tileArrayDtype.newbyteorder(byteOrder)
+        count = self._tileWidth * self._tileHeight * samples
+        if len(data) < count * dtype.itemsize:
+            raise IOTiffException('Read an unexpected number of bytes from a tile')
+        array = numpy.frombuffer(data, dtype=dtype, count=count)
+        if samples == 1:
+            return array.reshape((self._tileHeight, self._tileWidth))
+        return array.reshape((self._tileHeight, self._tileWidth, samples))
+
+    def _readEncodedTile(self, tileNum):
+        """
+        Read and decode a tile with libtiff.
+
+        :param tileNum: The internal tile number of the desired tile.
+        :type tileNum: int
+        :return: the decoded tile data.
+        :rtype: a ctypes character array.
+        :raises: IOTiffException
+        """
+        with self._tiffLock:
+            tileSize = libtiff_ctypes.libtiff.TIFFTileSize(self._tiffFile).value
+            imageBuffer = ctypes.create_string_buffer(tileSize)
+
+            readSize = libtiff_ctypes.libtiff.TIFFReadEncodedTile(
+                self._tiffFile, tileNum, imageBuffer, tileSize)
+        if readSize < tileSize:
+            raise IOTiffException('Read an unexpected number of bytes from an encoded tile')
+        return imageBuffer
+
     def _getUncompressedTile(self, tileNum):
         """
-        Get an uncompressed tile.
+        Get an uncompressed, LZW, or deflate compressed tile as an image with
+        8 bits per sample.
 
         :param tileNum: The internal tile number of the desired tile.
         :type tileNum: int
@@ -541,23 +1179,35 @@ class TiledTiffDirectory(object):
         :rtype: PIL.Image
         :raises: IOTiffException
         """
-        tileSize = libtiff_ctypes.libtiff.TIFFTileSize(self._tiffFile).value
-        imageBuffer = ctypes.create_string_buffer(tileSize)
+        return self._arrayToImage(self._getTileArray(tileNum))
 
-        readSize = libtiff_ctypes.libtiff.TIFFReadEncodedTile(
-            self._tiffFile, tileNum, imageBuffer, tileSize)
-        if readSize < tileSize:
-            raise IOTiffException('Read an unexpected number of bytes from an encoded tile')
-        if self._tiffInfo.get('samplesperpixel') == 1:
-            mode = 'L'
-        elif self._tiffInfo.get('samplesperpixel') == 3:
-            mode = ('YCbCr' if self._tiffInfo.get('photometric') ==
-                    libtiff_ctypes.PHOTOMETRIC_YCBCR else 'RGB')
-        if self._tiffInfo.get('bitspersample') == 16:
-            # Just take the high byte
-            imageBuffer = imageBuffer[1::2]
-        image = PIL.Image.frombytes(mode, (self._tileWidth, self._tileHeight), imageBuffer)
-        return image
+    def _arrayToImage(self, array):
+        """
+        Convert an array from getTileArray to an image with 8 bits per sample.
+
+        :param array: a numpy array of the image's own data type.
+        :return: the array as a PIL 8-bit-per-channel image.
+        :rtype: PIL.Image
+        """
+        image = arrayToUint8(array)
+        if len(image.shape) == 3 and image.shape[2] > 4:
+            image = image[:, :, :3]
+        if (len(image.shape) == 3 and image.shape[2] == 3 and
+                self._tiffInfo.get('photometric') == libtiff_ctypes.PHOTOMETRIC_YCBCR):
+            return PIL.Image.frombuffer(
+                'YCbCr', (image.shape[1], image.shape[0]),
+                numpy.ascontiguousarray(image), 'raw', 'YCbCr', 0, 1)
+        return PIL.Image.fromarray(image)
+
+    def _readImage(self):
+        """
+        Read the whole image of this directory with libtiff.
+
+        :return: the image as a numpy array.
+        """
+        # pylibtiff's read_image uses TIFFGetField
+        with self._tiffLock, _getFieldLock:
+            return self._tiffFile.read_image()
 
     @property
     def tileWidth(self):
@@ -642,6 +1292,9 @@ class TiledTiffDirectory(object):
             return
         if not isinstance(meta, six.string_types):
             meta = meta.decode('utf8', 'ignore')
+        if _omeDescriptionPattern.match(meta):
+            self._omeXml = meta if isinstance(meta, bytes) else meta.encode('utf8')
+            return True
         try:
             xml = cElementTree.fromstring(meta)
         except Exception:
@@ -688,3 +1341,414 @@ class TiledTiffDirectory(object):
         except Exception:
             pass
         return True
+
+
+def _halveArray(array):
+    """
+    Reduce an image array to half its width and height by averaging each 2x2
+    block of pixels.  If the width or height is odd, the last column or row
+    is averaged on its own.
+
+    :param array: a height x width x samples numpy array.
+    :returns: a numpy array of the same data type.
+    """
+    height, width, samples = array.shape
+    total = numpy.zeros(((height + 1) // 2, (width + 1) // 2, samples), dtype=numpy.float64)
+    counts = numpy.zeros(((height + 1) // 2, (width + 1) // 2, 1))
+    for dy in (0, 1):
+        for dx in (0, 1):
+            part = array[dy::2, dx::2]
+            total[:part.shape[0], :part.shape[1]] += part
+            counts[:part.shape[0], :part.shape[1]] += 1
+    total /= counts
+    if array.dtype.kind != 'f':
+        total = numpy.rint(total)
+    return total.astype(array.dtype)
+
+
+class StrippedTiffDirectory(TiledTiffDirectory):
+    """
+    A reader for an image file directory in a TIFF file whose image is stored
+    in strips rather than tiles.  The image is presented as a grid of virtual
+    tiles.  Only the strips that intersect a tile are read, and decoded
+    strips are kept in the decoded tile cache so that neighboring tiles reuse
+    them.  Lower resolutions of the image are made from the strips by
+    getReducedTileArray.
+    """
+    # Images whose strips decode to more than this many bytes are not read as
+    # virtual tiles.
+    maxStripBytes = 256 * 1024 ** 2
+    # The number of full resolution rows that are decoded at once when making
+    # a half resolution image.  This must be even.
+    reduceRowChunk = 64
+
+    def __init__(self, filePath, directoryNum, tileSize=256, metadata=None,
+                 sharedFile=None):
+        """
+        Create a new reader for a stripped image file directory in a TIFF
+        file.
+
+        :param filePath: A path to a TIFF file on disk, an http or https URL,
+            or a ByteSource.
+        :param directoryNum: The number of the TIFF image file directory to
+        open.
+        :type directoryNum: int
+        :param tileSize: the width and height of the virtual tiles.  This must
+            be even.
+        :param metadata: if not None, the result of getMetadataIndex from a
+            previous reader of this directory of an unchanged file.
+        :param sharedFile: the SharedTiffFile used to read this file.  If
+            None, this directory uses its own.
+        :raises: InvalidOperationTiffException or IOTiffException or
+        ValidationTiffException
+        """
+        self._virtualTileSize = int(tileSize)
+        super(StrippedTiffDirectory, self).__init__(
+            filePath, directoryNum, True, metadata, sharedFile)
+        if metadata is None:
+            self._openTileIndex(filePath)
+
+    def _setVirtualTiles(self):
+        """
+        Set the virtual tile size and strip layout from the directory's tags.
+        """
+        height = self._imageHeight or 0
+        rowsPerStrip = self._tiffInfo.get('rowsperstrip') or 0
+        self._rowsPerStrip = min(rowsPerStrip, height) if rowsPerStrip else height
+        self._tileWidth = self._tileHeight = self._virtualTileSize
+        self._tilesAcross = ((self._imageWidth or 0) + self._tileWidth - 1) // self._tileWidth
+
+    def _loadMetadata(self):
+        super(StrippedTiffDirectory, self)._loadMetadata()
+        self._setVirtualTiles()
+
+    def _restoreMetadata(self, metadata):
+        super(StrippedTiffDirectory, self)._restoreMetadata(metadata)
+        self._setVirtualTiles()
+
+    def getMetadataIndex(self):
+        """
+        Get the information that was read from this directory.  See
+        TiledTiffDirectory.getMetadataIndex.
+
+        :returns: a picklable dictionary.  This includes the virtual tile
+            size.
+        """
+        index = super(StrippedTiffDirectory, self).getMetadataIndex()
+        index['virtualTileSize'] = self._virtualTileSize
+        return index
+
+    def _validateLayout(self):
+        """
+        Validate that the image is stored in strips that can be read as
+        virtual tiles.
+
+        :raises: ValidationTiffException
+        """
+        if self._tiffInfo.get('istiled'):
+            raise ValidationTiffException('Expected a stripped TIFF file')
+        if not self._imageWidth or not self._imageHeight or not self._rowsPerStrip:
+            raise ValidationTiffException('Only TIFF files with a known image size are supported')
+        if self._tiffInfo.get('compression') not in ArrayTileCompressions:
+            raise ValidationTiffException(
+                'Only uncompressed, LZW, and deflate compressed stripped TIFF files '
+                'are supported')
+        if (self._rowsPerStrip * self._imageWidth * (self._tiffInfo.get('samplesperpixel') or 1) *
+                self.tileArrayDtype.itemsize > self.maxStripBytes):
+            raise ValidationTiffException(
+                'The strips of this TIFF file are too large to read as tiles')
+        try:
+            tags = self._sharedFile.tiffFile().directory(self._directoryNum).tags
+        except (IOError, OSError, ValueError):
+            tags = {}
+        if GeoTiffTags & set(tags):
+            raise ValidationTiffException(
+                'Geospatial TIFF files are not read as virtual tiles')
+
+    def _openTileIndex(self, filePath):
+        """
+        Read the locations of this directory's strips so that they can be
+        read without libtiff.  If the index can't be read or doesn't agree
+        with libtiff, libtiff is used to read strips instead.
+
+        :param filePath: The TIFF file, used in messages.
+        """
+        try:
+            stripIndex = self._sharedFile.tiffFile().directory(self._directoryNum)
+        except (IOError, OSError, ValueError) as exc:
+            logger.debug('Cannot index TIFF directory %d of %s: %s',
+                         self._directoryNum, filePath, exc)
+            return
+        if self._sharedFile.isLocal:
+            with self._tiffLock:
+                numberOfStrips = libtiff_ctypes.libtiff.TIFFNumberOfStrips(self._tiffFile)
+            numberOfStrips = getattr(numberOfStrips, 'value', numberOfStrips)
+        else:
+            numberOfStrips = len(stripIndex.tileOffsets)
+        if (not stripIndex.stripped or
+                stripIndex.tileHeight != self._rowsPerStrip or
+                stripIndex.imageWidth != self._imageWidth or
+                stripIndex.imageHeight != self._imageHeight or
+                len(stripIndex.tileOffsets) != numberOfStrips):
+            logger.debug('TIFF directory %d of %s has an inconsistent strip index',
+                         self._directoryNum, filePath)
+            return
+        self._tileIndex = stripIndex
+
+    def _toTileNum(self, x, y):
+        """
+        Get the number of a virtual tile from its row and column index.
+
+        :param x: The column index of the desired tile.
+        :type x: int
+        :param y: The row index of the desired tile.
+        :type y: int
+        :return: The number of the virtual tile.
+        :rtype int
+        :raises: InvalidOperationTiffException
+        """
+        if (x < 0 or y < 0 or x * self._tileWidth >= self._imageWidth or
+                y * self._tileHeight >= self._imageHeight):
+            raise InvalidOperationTiffException(
+                'Tile x=%d, y=%d does not exist' % (x, y))
+        return int(y) * self._tilesAcross + int(x)
+
+    def _stripRange(self, top, bottom):
+        """
+        Get the strips that contain a range of rows.
+
+        :param top: the first row.
+        :param bottom: the row after the last row.
+        :returns: a range of strip numbers.
+        """
+        return range(top // self._rowsPerStrip, (bottom - 1) // self._rowsPerStrip + 1)
+
+    def readRawTiles(self, tiles):
+        """
+        Read the raw encoded data of the strips used by several virtual tiles
+        with as few reads as possible.  Strips that have already been decoded
+        and cached are not read.
+
+        :param tiles: a list of (x, y) virtual tile positions.
+        :return: a dictionary of raw strip data keyed by strip number.
+        :rtype: dict
+        """
+        if self._tileIndex is None:
+            return {}
+        stripNums = set()
+        for x, y in tiles:
+            top = int(y) * self._tileHeight
+            if x < 0 or y < 0 or top >= self._imageHeight:
+                continue
+            stripNums.update(self._stripRange(
+                top, min(top + self._tileHeight, self._imageHeight)))
+        cache, lock = getDecodedTileCache()
+        with lock:
+            stripNums = [stripNum for stripNum in stripNums
+                         if self._stripCacheKey(stripNum) not in cache]
+        return self._readIndexedTiles(stripNums)
+
+    def _stripCacheKey(self, stripNum):
+        return ('tiffstrip', self._filePath, self._directoryNum, stripNum)
+
+    def _getStripArray(self, stripNum):
+        """
+        Get a decoded strip.  These are kept in the decoded tile cache.
+
+        :param stripNum: the strip number.
+        :return: a read-only rows x imageWidth x samples per pixel array.
+        :rtype: numpy.ndarray
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        key = self._stripCacheKey(stripNum)
+        cache, lock = getDecodedTileCache()
+        try:
+            with lock:
+                return cache[key]
+        except KeyError:
+            pass
+        strip = self._readStripArray(stripNum)
+        strip.flags.writeable = False
+        try:
+            with lock:
+                cache[key] = strip
+        except ValueError:
+            pass  # value too large
+        return strip
+
+    def _readStripArray(self, stripNum):
+        """
+        Read and decode a strip.  Uncompressed strips are a view of the data
+        read from the file.
+
+        :param stripNum: the strip number.
+        :return: a rows x imageWidth x samples per pixel array.
+        :rtype: numpy.ndarray
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        rows = min(self._rowsPerStrip, self._imageHeight - stripNum * self._rowsPerStrip)
+        if stripNum < 0 or rows <= 0:
+            raise InvalidOperationTiffException('Strip number out of range')
+        compression = self._tiffInfo.get('compression')
+        samples = self._tiffInfo.get('samplesperpixel') or 1
+        count = rows * self._imageWidth * samples
+        if (self._tileIndex is not None and
+                compression == libtiff_ctypes.COMPRESSION_NONE):
+            data = self._readRawTile(stripNum)
+            byteOrder = self._tileIndex.file.byteOrder
+        elif (self._tileIndex is not None and compression in DeflateCompressions and
+                (self._tiffInfo.get('predictor') or 1) == 1):
+            try:
+                data = zlib.decompress(self._readRawTile(stripNum))
+            except zlib.error as exc:
+                raise IOTiffException('Failed to decompress strip: %s' % exc)
+            byteOrder = self._tileIndex.file.byteOrder
+        else:
+            data = self._readEncodedStrip(stripNum, count * self.tileArrayDtype.itemsize)
+            byteOrder = '='
+        dtype = self.tileArrayDtype.newbyteorder(byteOrder)
+        if len(data) < count * dtype.itemsize:
+            raise IOTiffException('Read an unexpected number of bytes from a strip')
+        return numpy.frombuffer(data, dtype=dtype, count=count).reshape(
+            (rows, self._imageWidth, samples))
+
+    def _readEncodedStrip(self, stripNum, size):
+        """
+        Read and decode a strip with libtiff.
+
+        :param stripNum: the strip number.
+        :param size: the number of bytes of the decoded strip.
+        :return: the decoded strip data.
+        :rtype: a ctypes character array.
+        :raises: IOTiffException
+        """
+        with self._tiffLock:
+            imageBuffer = ctypes.create_string_buffer(size)
+            readSize = libtiff_ctypes.libtiff.TIFFReadEncodedStrip(
+                self._tiffFile, stripNum, imageBuffer, size)
+        readSize = getattr(readSize, 'value', readSize)
+        if readSize < size:
+            raise IOTiffException('Read an unexpected number of bytes from an encoded strip')
+        return imageBuffer
+
+    def _readRows(self, top, bottom, left, right):
+        """
+        Get part of the full resolution image from the strips.
+
+        :param top: the first row.
+        :param bottom: the row after the last row.
+        :param left: the first column.
+        :param right: the column after the last column.
+        :return: a rows x columns x samples per pixel array.
+        :rtype: numpy.ndarray
+        """
+        result = numpy.empty(
+            (bottom - top, right - left, self._tiffInfo.get('samplesperpixel') or 1),
+            dtype=self.tileArrayDtype)
+        for stripNum in self._stripRange(top, bottom):
+            strip = self._getStripArray(stripNum)
+            stripTop = stripNum * self._rowsPerStrip
+            y0 = max(top, stripTop)
+            y1 = min(bottom, stripTop + strip.shape[0])
+            result[y0 - top:y1 - top] = strip[y0 - stripTop:y1 - stripTop, left:right]
+        return result
+
+    def _getReducedBand(self, y, scale):
+        """
+        Get a row of virtual tiles across the whole width of the image at a
+        reduced resolution.  Half resolution rows are made from the strips;
+        each lower resolution is made from two rows of the resolution above
+        it.  These are kept in the decoded tile cache.
+
+        :param y: the row index of the virtual tiles at the reduced
+            resolution.
+        :param scale: the reduction factor.  This is a power of two that is
+            at least 2.
+        :return: a read-only array of up to tileHeight rows and the reduced
+            width of the image.
+        :rtype: numpy.ndarray
+        """
+        key = ('tiffband', self._filePath, self._directoryNum, y, scale)
+        cache, lock = getDecodedTileCache()
+        try:
+            with lock:
+                return cache[key]
+        except KeyError:
+            pass
+        tileHeight = self._tileHeight
+        if scale == 2:
+            top = y * tileHeight * 2
+            bottom = min(top + tileHeight * 2, self._imageHeight)
+            parts = [
+                _halveArray(self._readRows(
+                    start, min(start + self.reduceRowChunk, bottom), 0, self._imageWidth))
+                for start in range(top, bottom, self.reduceRowChunk)]
+        else:
+            parts = [_halveArray(self._getReducedBand(y * 2, scale // 2))]
+            if (y * 2 + 1) * tileHeight * (scale // 2) < self._imageHeight:
+                parts.append(_halveArray(self._getReducedBand(y * 2 + 1, scale // 2)))
+        band = numpy.concatenate(parts)
+        band.flags.writeable = False
+        try:
+            with lock:
+                cache[key] = band
+        except ValueError:
+            pass  # value too large
+        return band
+
+    def getReducedTileArray(self, x, y, scale=1):
+        """
+        Get a virtual tile of the image at full resolution or at a reduced
+        resolution.  Tiles at the edge of the image are padded with zeros.
+
+        :param x: The column index of the desired tile.
+        :type x: int
+        :param y: The row index of the desired tile.
+        :type y: int
+        :param scale: the reduction factor.  1 is full resolution, 2 is half
+            resolution, 4 is quarter resolution, etc.
+        :return: a tileHeight x tileWidth array for single sample images or a
+            tileHeight x tileWidth x samples per pixel array.
+        :rtype: numpy.ndarray
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        width = (self._imageWidth + scale - 1) // scale
+        height = (self._imageHeight + scale - 1) // scale
+        if (x < 0 or y < 0 or x * self._tileWidth >= width or
+                y * self._tileHeight >= height):
+            raise InvalidOperationTiffException(
+                'Tile x=%d, y=%d does not exist' % (x, y))
+        samples = self._tiffInfo.get('samplesperpixel') or 1
+        tile = numpy.zeros((self._tileHeight, self._tileWidth, samples), dtype=self.tileArrayDtype)
+        left = int(x) * self._tileWidth
+        right = min(left + self._tileWidth, width)
+        if scale == 1:
+            top = int(y) * self._tileHeight
+            bottom = min(top + self._tileHeight, height)
+            tile[:bottom - top, :right - left] = self._readRows(top, bottom, left, right)
+        else:
+            band = self._getReducedBand(int(y), scale)
+            tile[:band.shape[0], :right - left] = band[:, left:right]
+        if samples == 1:
+            return tile[:, :, 0]
+        return tile
+
+    def getReducedTile(self, x, y, scale=1):
+        """
+        Get a virtual tile at full or reduced resolution as an image with 8
+        bits per sample.  See getReducedTileArray.
+
+        :param x: The column index of the desired tile.
+        :type x: int
+        :param y: The row index of the desired tile.
+        :type y: int
+        :param scale: the reduction factor.
+        :return: the tile as a PIL 8-bit-per-channel images.
+        :rtype: PIL.Image
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        return self._arrayToImage(self.getReducedTileArray(x, y, scale))
+
+    def _getTileArray(self, tileNum):
+        return self.getReducedTileArray(
+            tileNum % self._tilesAcross, tileNum // self._tilesAcross)
@@ -113,22 +113,24 @@ var ImageViewerSelectWidget = View.extend({
      * this initial render to expose frame controls.
      *
      * @param {object} metadata A dictionary of metadata that might contain a
-     *      list of frames.
+     *      frameCount or a list of frames.
      * @param {function} frameUpdate a function to call with the current frame
      *      number when it changes.  This is called with an initial frame
      *      number if the frame controls are available.  It is never called if
      *      there is only one frame.
      */
     setFrames: function (metadata, frameUpdate) {
-        if (metadata.frames && metadata.frames.length > 1) {
+        var frameCount = metadata.frameCount !== undefined ? metadata.frameCount
+            : (metadata.frames ? metadata.frames.length : 0);
+        if (frameCount > 1) {
             this._frameUpdate = frameUpdate;
             this.$('.image-controls-frame').removeClass('hidden');
             var ctrl = this.$('#image-frame'),
                 ctrlnum = this.$('#image-frame-number');
-            ctrl.attr('max', metadata.frames.length - 1);
-            ctrlnum.attr('max', metadata.frames.length - 1);
+            ctrl.attr('max', frameCount - 1);
+            ctrlnum.attr('max', frameCount - 1);
             var frame = +ctrl.val();
-            if (frame >= metadata.frames.length) {
+            if (frame >= frameCount) {
                 ctrl.val(0);
                 frame = 0;
             }
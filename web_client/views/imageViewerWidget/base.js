@@ -9,7 +9,10 @@ var ImageViewerWidget = View.extend({
 
         return restRequest({
             type: 'GET',
-            url: 'item/' + this.itemId + '/tiles'
+            url: 'item/' + this.itemId + '/tiles',
+            // Only the number of frames is used, so don't ask for the list of
+            // frames or the OME metadata.
+            data: {framesLimit: 0, omeinfo: false}
         }).done((resp) => {
             this.levels = resp.levels;
             this.tileWidth = resp.tileWidth;